@@ -1,21 +1,24 @@
+import functools
+import hashlib
+import json
 import logging
 import os
 import sys
+import time
 
 from collections import defaultdict
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
-import boto3
-from botocore.exceptions import ClientError
-
-from jinja2 import Environment, FileSystemLoader
-
-import summarize_charges
+import async_tasks
+import attachment_policy
+import output_plan
 from QueryData import QueryData
-from helpers import query_org_accounts, get_sts_credentials, send_email
-
-jinja_env = Environment(loader=FileSystemLoader("."))
-jinja_template = jinja_env.get_template("./templates/email_body.jinja2")
+from helpers import query_org_accounts, send_email, merge_csv_parts
+from timings import StageTimer
+import work_queue
+from work_queue import FileWorkQueue
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -24,22 +27,49 @@ handler = logging.StreamHandler(sys.stdout)
 handler.setFormatter(formatter)
 logger.addHandler(handler)
 
+template_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "templates")
+
+
+@functools.lru_cache(maxsize=None)
+def email_template():
+    from jinja2 import Environment, FileSystemLoader
+
+    jinja_env = Environment(loader=FileSystemLoader(template_dir))
+    return jinja_env.get_template("email_body.jinja2")
+
 
 class BillingManager:
-    def __init__(self, query_parameters):
+    def __init__(self, query_parameters, settings=None, landing_zone=None, org_accounts_loader=None):
         self.query_parameters = query_parameters
+        # per landing zone settings (roles, buckets, database...); the environment unless
+        # the run covers several landing zones (see landing_zones)
+        self.settings = os.environ if settings is None else settings
+        self.landing_zone = landing_zone
+        # query_org_accounts unless the caller keeps the account metadata warm (see service)
+        self.org_accounts_loader = org_accounts_loader or query_org_accounts
         self.sts_endpoint = "https://sts.ca-central-1.amazonaws.com"
-        self.athena_query_role_to_assume = os.environ["ATHENA_QUERY_ROLE_TO_ASSUME_ARN"]
-        self.athena_query_output_bucket = os.environ["ATHENA_QUERY_OUTPUT_BUCKET"]
-        self.athena_query_output_bucket_name = os.environ["ATHENA_QUERY_OUTPUT_BUCKET"]
-        self.athena_query_database = os.environ["ATHENA_QUERY_DATABASE"]
+        # Athena settings are only required by the Athena query backend (see QueryData)
+        self.athena_query_role_to_assume = self.settings.get("ATHENA_QUERY_ROLE_TO_ASSUME_ARN")
+        self.athena_query_output_bucket = self.settings.get("ATHENA_QUERY_OUTPUT_BUCKET", "")
+        self.athena_query_output_bucket_name = self.settings.get("ATHENA_QUERY_OUTPUT_BUCKET", "")
+        self.athena_query_database = self.settings.get("ATHENA_QUERY_DATABASE")
         self.container_creds_uri = os.environ.get(
             "AWS_CONTAINER_CREDENTIALS_RELATIVE_URI"
         )
 
-        self.quarterly_report_config = os.environ.get("REPORT_TYPE") == "Quarterly"
+        self.quarterly_report_config = (
+            os.environ.get("REPORT_TYPE") == "Quarterly"
+            or query_parameters.get("report_type") == "quarterly"
+        )
+        # the artifacts this run has to produce, see output_plan
+        self.output_plan = output_plan.resolve(
+            "quarterly" if self.quarterly_report_config else query_parameters.get("report_type")
+        )
+        # BATCH_DELIVERY sends a single email per recipient/CC list covering all of their billing groups
+        self.batch_delivery = os.environ.get("BATCH_DELIVERY", "false").lower() == "true"
+        self.split_query_by_month = os.environ.get("SPLIT_QUERY_BY_MONTH", "false").lower() == "true"
 
-        if os.environ["AWS_DEFAULT_REGION"]:
+        if os.environ.get("AWS_DEFAULT_REGION"):
             self.aws_default_region = os.environ["AWS_DEFAULT_REGION"]
         else:
             self.aws_default_region = "ca-central-1"
@@ -51,13 +81,64 @@ class BillingManager:
         # make sure the local output directory exists, creating if necessary
         current_dir = os.path.dirname(os.path.realpath(__file__))
         self.output_dir = f"{current_dir}/output"
+        if landing_zone:
+            self.output_dir = f"{self.output_dir}/{landing_zone}"
         Path(self.output_dir).mkdir(parents=True, exist_ok=True)
 
+        # shared by RUN_MODE=coordinator and RUN_MODE=worker; EFS when they run as separate
+        # tasks. Each report window has its own queue under WORK_QUEUE_DIR, so consecutive
+        # runs don't collide
+        self.work_queue_dir = os.environ.get("WORK_QUEUE_DIR", f"{self.output_dir}/work_queue")
+        if query_parameters.get("start_date") and query_parameters.get("end_date"):
+            self.work_queue_dir = os.path.join(
+                self.work_queue_dir,
+                work_queue.run_name(query_parameters["start_date"], query_parameters["end_date"]),
+            )
+
         self.query_results_dir_name = "query_results"
         self.summarized_dir_name = "summarized"
         self.reports_dir_name = "reports"
 
-        self.org_accounts = query_org_accounts()
+        self.timer = StageTimer()
+
+        # org account metadata is loaded by do(), concurrently with the Athena query where possible
+        self.org_accounts = None
+        # the query results the run was computed from, when kept on disk
+        self.query_results_file = None
+
+    def load_org_accounts(self):
+        org_accounts = self.org_accounts_loader(self.settings)
+        if self.query_parameters.get("billing_groups"):
+            org_accounts = self.select_billing_groups(org_accounts)
+        return self.index_org_accounts(org_accounts)
+
+    def select_billing_groups(self, org_accounts):
+        """
+        Narrows the org accounts to the billing groups selected for a targeted run. Every
+        later stage works off these accounts: the query filters on their ids and only
+        their groups are summarized, reported on and delivered.
+        """
+        group_type = "account_coding" if os.environ.get("GROUP_TYPE") == "account_coding" else "billing_group"
+        billing_groups = set(self.query_parameters["billing_groups"])
+
+        selected_accounts = [
+            account for account in org_accounts if account.get(group_type) in billing_groups
+        ]
+        unknown_groups = billing_groups - set(account.get(group_type) for account in selected_accounts)
+        if unknown_groups:
+            logger.warning(f"No accounts found for billing groups {sorted(unknown_groups)}")
+        if not selected_accounts:
+            raise Exception(
+                f"None of the selected billing groups {sorted(billing_groups)} match any account"
+            )
+
+        logger.info(
+            f"Targeted run for {len(billing_groups - unknown_groups)} billing groups ({len(selected_accounts)} accounts)"
+        )
+        return selected_accounts
+
+    def index_org_accounts(self, org_accounts):
+        self.org_accounts = org_accounts
 
         # create a lookup to allow us to easily derive the "owner" email address
         # for a given billing group
@@ -71,6 +152,9 @@ class BillingManager:
             self.additional_contacts_for_billing_groups[account[group_type]] = list(set(self.additional_contacts_for_billing_groups[account[group_type]]).union(set(additional_contacts)))
             admin_contact_name = account.get("admin_contact_name", "Unnamed")  # Unnamed is the default value
             self.names_for_billing_groups[account[group_type]].add(admin_contact_name)
+
+        return self.org_accounts
+
     @staticmethod
     def extract_name_from_email(email_address):
         #p.m@gov.bc.ca P M
@@ -112,7 +196,7 @@ class BillingManager:
 
     def __deliver_reports(self, billing_group_totals):
         logger.info("Delivering Cloud Consumption Reports...")
-        if os.environ.get("REPORT_TYPE") == "Quarterly":
+        if self.quarterly_report_config:
             recipient_email = self.query_parameters.get("recipient_override")
             recipient_name = self.extract_name_from_email(recipient_email.strip())
             carbon_copy = self.query_parameters.get("carbon_copy")
@@ -140,6 +224,7 @@ class BillingManager:
 
             logger.debug(f"Email result: {email_result}.")
         else:
+            deliveries = []
             for billing_group, attachments in self.delivery_outbox.items():
                 billing_group_total = billing_group_totals.get(billing_group, 0.00)
                 if billing_group_total <= 0.00:
@@ -170,90 +255,240 @@ class BillingManager:
                 # Append carbon copy value to additional contacts
                 if carbon_copy and carbon_copy.strip() != "":
                     additional_contacts.append(carbon_copy.lower())
-                cc_email_address = ",".join(additional_contacts) if additional_contacts else None
-                   
 
-
-                subject = (
-                    f"Cloud Consumption Report for {billing_group} - "
-                    f"${billing_group_total} "
-                    f"from {self.query_parameters['start_date'].strftime('%d-%m-%Y')} to "
-                    f"{self.query_parameters['end_date'].strftime('%d-%m-%Y')}."
-                )
-
-                body_text = jinja_template.render(
+                deliveries.append(
                     {
-                        "billing_group_email": recipient_email,
-                        "admin_name":recipient_name,
-                        "start_date": self.query_parameters.get("start_date"),
-                        "end_date": self.query_parameters.get("end_date"),
+                        "billing_group": billing_group,
                         "billing_group_total": billing_group_total,
-                        "list_of_accounts": self.format_account_info_for_email(
-                            billing_group
-                        ),
+                        "recipient_email": recipient_email,
+                        "recipient_name": recipient_name,
+                        "additional_contacts": additional_contacts,
+                        "attachments": attachments,
                     }
                 )
-                print(f"Sending email to '{recipient_email}' and CC to '{cc_email_address}' with subject '{subject}'")
-            
-                logger.debug(f"Sending email to '{recipient_email}' and CC to '{cc_email_address}' with subject '{subject}'")
-
-                email_result = send_email(
-                    sender="info@cloud.gov.bc.ca",
-                    recipient=recipient_email,
-                    cc=cc_email_address,
-                    subject=subject,
-                    body_text=body_text,
-                    attachments=attachments,
-                )
 
-                logger.debug(f"Email result: {email_result}.")
+            # SES sends are independent, so they go out concurrently (MAX_CONCURRENT_SES)
+            if self.batch_delivery:
+                self.__send_batched_reports(deliveries)
+            else:
+                async_tasks.map_calls("ses", self.__send_report, deliveries)
+
+    def __send_report(self, delivery):
+        billing_group = delivery["billing_group"]
+        billing_group_total = delivery["billing_group_total"]
+        recipient_email = delivery["recipient_email"]
+        additional_contacts = delivery["additional_contacts"]
+        cc_email_address = ",".join(additional_contacts) if additional_contacts else None
+
+        subject = (
+            f"Cloud Consumption Report for {billing_group} - "
+            f"${billing_group_total} "
+            f"from {self.query_parameters['start_date'].strftime('%d-%m-%Y')} to "
+            f"{self.query_parameters['end_date'].strftime('%d-%m-%Y')}."
+        )
+
+        attachments, report_links = self.__prepare_attachments(
+            billing_group, delivery["attachments"]
+        )
+
+        body_text = email_template().render(
+            {
+                "billing_group_email": recipient_email,
+                "admin_name": delivery["recipient_name"],
+                "start_date": self.query_parameters.get("start_date"),
+                "end_date": self.query_parameters.get("end_date"),
+                "billing_group_total": billing_group_total,
+                "list_of_accounts": self.format_account_info_for_email(
+                    billing_group
+                ),
+                **report_links,
+            }
+        )
+        print(f"Sending email to '{recipient_email}' and CC to '{cc_email_address}' with subject '{subject}'")
+
+        logger.debug(f"Sending email to '{recipient_email}' and CC to '{cc_email_address}' with subject '{subject}'")
+
+        email_result = send_email(
+            sender="info@cloud.gov.bc.ca",
+            recipient=recipient_email,
+            cc=cc_email_address,
+            subject=subject,
+            body_text=body_text,
+            attachments=attachments,
+        )
+
+        logger.debug(f"Email result: {email_result}.")
+
+    def __prepare_attachments(self, name, attachments):
+        """
+        Applies the attachment size policy (see attachment_policy) to the files for one
+        email. Returns the files to attach and the template variables for any files that
+        are linked instead.
+        """
+        start_date = self.query_parameters["start_date"]
+        end_date = self.query_parameters["end_date"]
+        attachments = sorted(attachments)
+
+        zip_path, key_prefix = attachment_policy.locations(
+            os.path.dirname(attachments[0]),
+            name,
+            start_date,
+            end_date,
+            self.query_parameters.get("report_type"),
+            self.landing_zone,
+        )
+
+        attachments, links = attachment_policy.prepare(attachments, zip_path, key_prefix, self.settings)
+        if not links:
+            return attachments, {}
+
+        return attachments, {
+            "report_links": links,
+            "report_links_expire": attachment_policy.links_expire(),
+        }
+
+    def __send_batched_reports(self, deliveries):
+        """
+        BATCH_DELIVERY: sends one email per recipient and CC list, covering every billing
+        group addressed to them, instead of one email per billing group.
+        """
+        batches = defaultdict(list)
+        for delivery in deliveries:
+            key = (
+                delivery["recipient_email"].strip().lower(),
+                tuple(sorted(set(email.strip().lower() for email in delivery["additional_contacts"]))),
+            )
+            batches[key].append(delivery)
+
+        logger.info(f"Batching {len(deliveries)} billing group reports into {len(batches)} emails")
+
+        async_tasks.run(
+            *(
+                async_tasks.call("ses", self.__send_batch, recipient_email, additional_contacts, batch)
+                for (recipient_email, additional_contacts), batch in batches.items()
+            )
+        )
+
+    def __send_batch(self, recipient_email, additional_contacts, batch):
+        if len(batch) == 1:
+            self.__send_report(batch[0])
+            return
+
+        cc_email_address = ",".join(additional_contacts) if additional_contacts else None
+        total = round(sum(delivery["billing_group_total"] for delivery in batch), 2)
+
+        subject = (
+            f"Cloud Consumption Reports for {len(batch)} billing groups - "
+            f"${total} "
+            f"from {self.query_parameters['start_date'].strftime('%d-%m-%Y')} to "
+            f"{self.query_parameters['end_date'].strftime('%d-%m-%Y')}."
+        )
+
+        # one project list covering every billing group, each headed by its own total
+        list_of_accounts = "".join(
+            f"<br><strong>{delivery['billing_group']}</strong> - ${delivery['billing_group_total']} CAD"
+            + self.format_account_info_for_email(delivery["billing_group"])
+            for delivery in batch
+        )
+        # the recipient can get several batches (one per set of CCs), so the archive is
+        # named after everything that makes up the batch
+        batch_key = hashlib.sha256(
+            json.dumps(
+                [sorted(additional_contacts or []), sorted(delivery["billing_group"] for delivery in batch)]
+            ).encode()
+        ).hexdigest()[:12]
+        attachments, report_links = self.__prepare_attachments(
+            f"{recipient_email.split('@')[0]}-{len(batch)}-billing-groups-{batch_key}",
+            set().union(*(delivery["attachments"] for delivery in batch)),
+        )
+
+        body_text = email_template().render(
+            {
+                "billing_group_email": recipient_email,
+                "admin_name": batch[0]["recipient_name"],
+                "start_date": self.query_parameters.get("start_date"),
+                "end_date": self.query_parameters.get("end_date"),
+                "billing_group_total": total,
+                "list_of_accounts": list_of_accounts,
+                **report_links,
+            }
+        )
+
+        logger.info(f"Sending email to '{recipient_email}' and CC to '{cc_email_address}' with subject '{subject}'")
+
+        email_result = send_email(
+            sender="info@cloud.gov.bc.ca",
+            recipient=recipient_email,
+            cc=cc_email_address,
+            subject=subject,
+            body_text=body_text,
+            attachments=attachments,
+        )
+
+        logger.debug(f"Email result: {email_result}.")
 
     def __run_query(self):
         logger.info("Querying data...")
 
         # if we are querying for specific billing group(s), we need to pass in account_ids
+        # (org_accounts only holds the selected groups' accounts, see select_billing_groups)
         if self.query_parameters.get("billing_groups"):
-            account_ids = set(map(lambda a: a["id"], self.org_accounts))
+            account_ids = sorted(map(lambda a: a["id"], self.org_accounts))
             self.query_parameters["account_ids"] = account_ids
 
             logger.debug(f"Querying for account_ids '{account_ids}'")
 
-        query_data = QueryData(self.query_parameters)
-        return query_data.query_usage_charges()
+        self.query_data = QueryData(self.query_parameters, self.settings)
+
+        # long windows can be split into one query per calendar month, run concurrently;
+        # windows over the scan budget are split or refused (see ATHENA_MAX_SCAN_GB)
+        return self.query_data.query_usage_charges_within_budget(self.split_query_by_month)
+
+    def __timed(self, stage_name, fn, *args):
+        with self.timer.stage(stage_name):
+            return fn(*args)
+
+    def __prefetch_exchange_rates(self):
+        import summarize_charges
 
-    def __download_query_results(self, query_execution_id, output_file_local_path):
-        credentials = get_sts_credentials(
-            self.athena_query_role_to_assume,
-            self.aws_default_region,
-            self.sts_endpoint,
-            self.role_session_name,
+        # warms the cached rates used later by enhance_with_metadata
+        return summarize_charges.prefetch_exchange_rates(
+            self.query_parameters["start_date"], self.query_parameters["end_date"]
         )
 
-        # Use the temporary credentials that AssumeRole returns to make a connection
-        # to S3 in Operations account
-        try:
-            s3_resource = boto3.resource(
-                "s3",
-                aws_access_key_id=credentials["AccessKeyId"],
-                aws_secret_access_key=credentials["SecretAccessKey"],
-                aws_session_token=credentials["SessionToken"],
+    def __run_query_with_metadata(self):
+        if self.query_parameters.get("billing_groups"):
+            # the account ids for the selected groups come from the org metadata, so the
+            # query has to wait for it
+            self.__timed("org_accounts", self.load_org_accounts)
+            return self.__timed("query", self.__run_query)
+
+        # the org metadata and the exchange rate don't depend on the query, so fetch them
+        # while Athena is busy and join once everything is ready
+        with self.timer.stage("query_and_metadata"):
+            query_execution_ids, _, _ = async_tasks.run(
+                async_tasks.call("athena", self.__timed, "query", self.__run_query),
+                async_tasks.call("organizations", self.__timed, "org_accounts", self.load_org_accounts),
+                async_tasks.call("http", self.__timed, "exchange_rate", self.__prefetch_exchange_rates),
             )
-        except ClientError as err:
-            logger.error(f"A boto3 client error has occurred: {err}")
-            return err
 
+        return query_execution_ids
+
+    def __download_query_results(self, query_execution_ids, output_file_local_path):
         logger.info("Downloading query results...")
 
-        output_file_name = f"cur/{query_execution_id}.csv"
-        s3_output_file = s3_resource.Object(
-            self.athena_query_output_bucket_name, output_file_name
-        )
-        s3_output_file.download_file(f"{output_file_local_path}")
-        # s3_output_file.delete()
+        download = self.query_data.download_results
 
-        # metadata_file = f"cur/{query_execution_id}.metadata"
-        # s3_output_metadata_file = s3_resource.Object(self.athena_query_output_bucket_name, metadata_file)
-        # s3_output_metadata_file.delete()
+        if len(query_execution_ids) == 1:
+            download(query_execution_ids[0], output_file_local_path)
+        else:
+            part_paths = [
+                f"{output_file_local_path}.part-{index}"
+                for index in range(len(query_execution_ids))
+            ]
+            with ThreadPoolExecutor(max_workers=len(query_execution_ids)) as executor:
+                list(executor.map(download, query_execution_ids, part_paths))
+            merge_csv_parts(part_paths, output_file_local_path)
 
         logger.info(f"Downloaded output file to '{output_file_local_path}'")
 
@@ -261,40 +496,113 @@ class BillingManager:
         # we will queue up the attachments generated in the processing step and deliver to recipients after processing
         self.delivery_outbox[billing_group].add(attachment)
 
-    def summarize(self, query_results_output_file_local_path, summary_output_path):
+    def summarize(self, charges, summary_output_path):
+        # summarize_charges (pandas, numpy, openpyxl) is only imported by the stages that use it
+        import summarize_charges
+
         logger.info("Summarizing query results...")
 
         summarize_charges.aggregate(
-            query_results_output_file_local_path,
+            charges,
             summary_output_path,
             self.org_accounts,
             self.query_parameters,
             self.queue_attachment,
+            billing_groups=None if "group_workbooks" in self.output_plan else [],
+            include_all=self.__include_all_workbook(),
         )
 
         logger.info(f"Summarized data stored at '{summary_output_path}'")
 
-    def reports(self, query_results_output_file_local_path, report_output_dir):
+    def __include_all_workbook(self):
+        # a targeted run only covers some groups, so there is no "-ALL" workbook to refresh
+        return "all_workbook" in self.output_plan and not self.query_parameters.get("billing_groups")
+
+    def reports(self, charges, report_output_dir):
+        import summarize_charges
+
+        if "group_reports" not in self.output_plan:
+            # nothing to render, e.g. quarterly runs only need the totals
+            return summarize_charges.group_totals(charges, self.org_accounts)
+
         logger.info("Generating reports...")
 
         billing_group_totals = summarize_charges.report(
-            query_results_output_file_local_path,
+            charges,
             report_output_dir,
             self.org_accounts,
             self.query_parameters,
             self.queue_attachment,
-            self.quarterly_report_config,
+            False,
+            aggregate_store_location=self.settings.get("AGGREGATE_STORE"),
         )
 
         return billing_group_totals
 
-    def do(self, existing_file=None):
+    def quarterly(self, billing_group_totals, report_output_dir, charges):
+        import summarize_charges
+
+        logger.info("Generating quarterly report...")
+
+        summarize_charges.quarterly_report(
+            billing_group_totals,
+            report_output_dir,
+            self.org_accounts,
+            self.query_parameters,
+            self.queue_attachment,
+            s3_bucket=self.settings.get("QR_S3_Bucket"),
+            charges=charges,
+        )
+
+    def __stream_query_results(self, query_execution_ids, tee_file_local_path=None):
+        import summarize_charges
+
+        logger.info("Streaming query results...")
+
+        # the S3 bodies are parsed as they arrive, so download and parse overlap and the
+        # raw file only touches the disk when a copy is explicitly requested
+        tee_paths = [None] * len(query_execution_ids)
+        if tee_file_local_path:
+            tee_paths = (
+                [tee_file_local_path]
+                if len(query_execution_ids) == 1
+                else [f"{tee_file_local_path}.part-{index}" for index in range(len(query_execution_ids))]
+            )
 
+        streams = [
+            self.query_data.open_results_stream(query_execution_id, tee_path)
+            for query_execution_id, tee_path in zip(query_execution_ids, tee_paths)
+        ]
+
+        try:
+            charges = summarize_charges.load_charges(
+                streams if len(streams) > 1 else streams[0], self.org_accounts
+            )
+        finally:
+            for stream in streams:
+                stream.close()
+
+        if tee_file_local_path and len(query_execution_ids) > 1:
+            merge_csv_parts(tee_paths, tee_file_local_path)
+
+        logger.info(f"Loaded {len(charges)} grouped rows from query results")
+
+        return charges
+
+    def __load_charges(self, existing_file=None):
+        """
+        Runs the query (unless reprocessing `existing_file`) and returns the charges
+        frame together with the base output path for the run.
+        """
         query_results_output_file_local_path = existing_file
+        stream_query_results = os.environ.get("STREAM_QUERY_RESULTS", "false").lower() == "true"
 
         if not query_results_output_file_local_path:
-            query_execution_id = self.__run_query()
-            logger.debug(f"query_execution_id = '{query_execution_id}'")
+            query_execution_ids = self.__run_query_with_metadata()
+            logger.debug(f"query_execution_ids = '{query_execution_ids}'")
+
+            # output for split queries is kept under the first execution id
+            query_execution_id = query_execution_ids[0]
 
             output_file_name = "query_results.csv"
             output_local_path = (
@@ -304,15 +612,29 @@ class BillingManager:
             query_results_output_file_local_path = (
                 f"{output_local_path}/{output_file_name}"
             )
-
-            self.__download_query_results(
-                query_execution_id, query_results_output_file_local_path
+            self.query_data.write_cost_ledger(
+                f"{self.output_dir}/{query_execution_id}/query_cost_ledger.json"
             )
 
+            if stream_query_results:
+                keep_raw_file = os.environ.get("STREAM_KEEP_RAW_FILE", "false").lower() == "true"
+                with self.timer.stage("stream_and_load"):
+                    charges = self.__stream_query_results(
+                        query_execution_ids,
+                        query_results_output_file_local_path if keep_raw_file else None,
+                    )
+            else:
+                with self.timer.stage("download"):
+                    self.__download_query_results(
+                        query_execution_ids, query_results_output_file_local_path
+                    )
+
         else:
             logger.info(
                 f"Skipping query. Processing local file '{query_results_output_file_local_path}'"
             )
+            stream_query_results = False
+            self.__timed("org_accounts", self.load_org_accounts)
 
         logger.debug(
             f"query_results_output_file_local_path = '{query_results_output_file_local_path}'"
@@ -321,16 +643,275 @@ class BillingManager:
         base_output_path = "/".join(
             query_results_output_file_local_path.split("/")[:-2]
         )
+        if os.path.isfile(query_results_output_file_local_path):
+            self.query_results_file = query_results_output_file_local_path
+
+        if not stream_query_results:
+            import summarize_charges
+
+            # parse and enhance once; both the summary and the reports work off the same frame
+            with self.timer.stage("load"):
+                charges = summarize_charges.load_charges(
+                    query_results_output_file_local_path,
+                    self.org_accounts,
+                    cache_path=f"{base_output_path}/charges.arrow",
+                )
 
-        summary_local_path = f"{base_output_path}/{self.summarized_dir_name}"
-        Path(summary_local_path).mkdir(parents=True, exist_ok=True)
-        self.summarize(query_results_output_file_local_path, summary_local_path)
+        if self.settings.get("AGGREGATE_STORE"):
+            self.__timed("history", self.record_history, charges)
+
+        return charges, base_output_path
+
+    def record_history(self, charges):
+        # keeps this period's aggregates for trend reporting (pandas and pyarrow are only
+        # imported when a store is configured)
+        import aggregate_store
+
+        group_type = "account_coding" if os.environ.get("GROUP_TYPE") == "account_coding" else "billing_group"
+        group_column = "Account_Coding" if group_type == "account_coding" else "Billing_Group"
+        aggregate_store.append(
+            charges,
+            self.query_parameters,
+            group_column,
+            set(account[group_type] for account in self.org_accounts),
+            self.settings.get("AGGREGATE_STORE"),
+        )
+
+    def __log_timings(self):
+        self.timer.log_summary(
+            logger,
+            {"query_and_metadata": ["query", "org_accounts", "exchange_rate"]},
+        )
+
+    def do(self, existing_file=None):
+        charges, base_output_path = self.__load_charges(existing_file)
+
+        if self.output_plan & {"all_workbook", "group_workbooks"}:
+            summary_local_path = f"{base_output_path}/{self.summarized_dir_name}"
+            Path(summary_local_path).mkdir(parents=True, exist_ok=True)
+            self.__timed("summarize", self.summarize, charges, summary_local_path)
 
         reports_local_path = f"{base_output_path}/{self.reports_dir_name}"
         Path(reports_local_path).mkdir(parents=True, exist_ok=True)
-        billing_group_totals = self.reports(
-            query_results_output_file_local_path, reports_local_path
+        billing_group_totals = self.__timed(
+            "reports", self.reports, charges, reports_local_path
         )
 
+        if "quarterly_workbook" in self.output_plan:
+            self.__timed("quarterly", self.quarterly, billing_group_totals, reports_local_path, charges)
+
         if self.query_parameters.get("deliver"):
-            self.__deliver_reports(billing_group_totals)
+            self.__timed("deliver", self.__deliver_reports, billing_group_totals)
+
+        self.__log_timings()
+
+        return billing_group_totals
+
+    def coordinate(self, existing_file=None):
+        """
+        Coordinator side of RUN_MODE=coordinator. Runs the query, writes the "-ALL"
+        workbook, then writes one partition and one task per billing group to the work
+        queue for RUN_MODE=worker invocations to render and deliver. Waits for every
+        group to be completed and returns the collected billing group totals.
+        """
+        import summarize_charges
+
+        queue = FileWorkQueue(self.work_queue_dir)
+        if queue.manifest_path.exists():
+            if not queue.finished():
+                raise Exception(
+                    f"Work queue '{self.work_queue_dir}' holds an unfinished run of this window; "
+                    f"wait for it to finish or remove the directory"
+                )
+            # a rerun of the same window; the earlier run's queue is kept for reference
+            logger.info(f"Archiving the finished run in '{self.work_queue_dir}'")
+            queue = queue.archive()
+
+        charges, base_output_path = self.__load_charges(existing_file)
+
+        if self.__include_all_workbook():
+            summary_local_path = f"{base_output_path}/{self.summarized_dir_name}"
+            Path(summary_local_path).mkdir(parents=True, exist_ok=True)
+            with self.timer.stage("summarize"):
+                summarize_charges.aggregate(
+                    charges,
+                    summary_local_path,
+                    self.org_accounts,
+                    self.query_parameters,
+                    self.queue_attachment,
+                    billing_groups=[],
+                )
+
+        group_key = "account_coding" if os.environ.get("GROUP_TYPE") == "account_coding" else "billing_group"
+        group_column = "Account_Coding" if group_key == "account_coding" else "Billing_Group"
+        billing_groups = sorted(set(account[group_key] for account in self.org_accounts))
+
+        # the manifest goes first so any worker that sees a task can also read it. Plans
+        # without per group artifacts (quarterly) leave the workers nothing to do
+        tasks = []
+        if self.output_plan & output_plan.per_group_artifacts:
+            tasks = [
+                {"task_id": f"group-{index:05d}", "billing_group": billing_group}
+                for index, billing_group in enumerate(billing_groups)
+            ]
+        queue.write_manifest(
+            {
+                "run_id": os.path.basename(base_output_path),
+                "start_date": self.query_parameters["start_date"].isoformat(),
+                "end_date": self.query_parameters["end_date"].isoformat(),
+                "exchange_rate": charges.attrs.get("exchange_rate"),
+                "org_accounts": self.org_accounts,
+                "output_plan": sorted(self.output_plan),
+                "tasks": tasks,
+            }
+        )
+
+        with self.timer.stage("partition"):
+            for task in tasks:
+                partition_path = queue.partitions_dir / f"{task['task_id']}.parquet"
+                charges[charges[group_column] == task["billing_group"]].to_parquet(
+                    partition_path, index=False
+                )
+                queue.put(task["task_id"], dict(task, partition=str(partition_path)))
+
+        logger.info(f"Queued {len(tasks)} billing groups in '{self.work_queue_dir}'")
+
+        if tasks:
+            with self.timer.stage("wait_for_workers"):
+                results = queue.wait_for_results(
+                    len(tasks),
+                    int(os.environ.get("WORK_QUEUE_TIMEOUT_SECONDS", 3600)),
+                    int(os.environ.get("WORK_QUEUE_STALE_CLAIM_SECONDS", 900)),
+                    int(os.environ.get("WORK_QUEUE_POLL_SECONDS", 5)),
+                )
+
+            billing_group_totals = {
+                result["billing_group"]: result["total"] for result in results.values()
+            }
+        else:
+            billing_group_totals = self.__timed(
+                "reports", summarize_charges.group_totals, charges, self.org_accounts
+            )
+        queue.finish()
+
+        # the quarterly workbook needs every group's total, so it is built here
+        if "quarterly_workbook" in self.output_plan:
+            reports_local_path = f"{base_output_path}/{self.reports_dir_name}"
+            Path(reports_local_path).mkdir(parents=True, exist_ok=True)
+            self.__timed("quarterly", self.quarterly, billing_group_totals, reports_local_path, charges)
+            if self.query_parameters.get("deliver"):
+                self.__timed("deliver", self.__deliver_reports, billing_group_totals)
+
+        self.__log_timings()
+
+        return billing_group_totals
+
+    def work(self):
+        """
+        Worker side of RUN_MODE=worker. Waits for the coordinator's manifest, then claims
+        billing groups from the work queue until every task has a result and, for each
+        one, writes the group workbook and HTML report and delivers them.
+        """
+        timeout_seconds = int(os.environ.get("WORK_QUEUE_TIMEOUT_SECONDS", 3600))
+        stale_claim_seconds = int(os.environ.get("WORK_QUEUE_STALE_CLAIM_SECONDS", 900))
+        poll_seconds = int(os.environ.get("WORK_QUEUE_POLL_SECONDS", 5))
+
+        queue = FileWorkQueue(self.work_queue_dir)
+        manifest = queue.wait_for_manifest(timeout_seconds, poll_seconds)
+        task_count = len(manifest["tasks"])
+
+        # the coordinator's window and account metadata win over anything derived locally
+        self.query_parameters["start_date"] = datetime.fromisoformat(manifest["start_date"])
+        self.query_parameters["end_date"] = datetime.fromisoformat(manifest["end_date"])
+        self.index_org_accounts(manifest["org_accounts"])
+        self.output_plan = set(manifest["output_plan"])
+
+        base_output_path = f"{self.output_dir}/{manifest['run_id']}"
+        summary_local_path = f"{base_output_path}/{self.summarized_dir_name}"
+        reports_local_path = f"{base_output_path}/{self.reports_dir_name}"
+        Path(summary_local_path).mkdir(parents=True, exist_ok=True)
+        Path(reports_local_path).mkdir(parents=True, exist_ok=True)
+
+        deadline = time.time() + timeout_seconds
+        completed = 0
+        while True:
+            task_id, task = queue.claim()
+            if not task_id:
+                # an empty pending/ is not the end of the run: tasks still being
+                # partitioned, or requeued from a worker that died, show up later
+                if len(queue.results()) >= task_count:
+                    break
+                if time.time() > deadline:
+                    logger.warning(f"Stopping after {timeout_seconds}s with tasks still unfinished")
+                    break
+                queue.requeue_stale(stale_claim_seconds)
+                time.sleep(poll_seconds)
+                continue
+
+            with queue.heartbeat(task_id, max(stale_claim_seconds // 3, 1)):
+                self.__work_on(queue, manifest, task_id, task, summary_local_path, reports_local_path)
+            completed += 1
+
+        logger.info(f"Worker finished after completing {completed} billing groups")
+        self.__log_timings()
+
+    def __work_on(self, queue, manifest, task_id, task, summary_local_path, reports_local_path):
+        import pandas as pd
+        import summarize_charges
+
+        billing_group = task["billing_group"]
+        logger.info(f"Processing billing group '{billing_group}' ({task_id})")
+
+        charges = pd.read_parquet(task["partition"])
+        charges.attrs["exchange_rate"] = manifest["exchange_rate"]
+
+        self.delivery_outbox.clear()
+        if "group_workbooks" in self.output_plan:
+            with self.timer.stage("summarize"):
+                summarize_charges.aggregate(
+                    charges,
+                    summary_local_path,
+                    self.org_accounts,
+                    self.query_parameters,
+                    self.queue_attachment,
+                    billing_groups=[billing_group],
+                    include_all=False,
+                )
+        with self.timer.stage("reports"):
+            if "group_reports" in self.output_plan:
+                billing_group_totals = summarize_charges.report(
+                    charges,
+                    reports_local_path,
+                    self.org_accounts,
+                    self.query_parameters,
+                    self.queue_attachment,
+                    False,
+                    billing_groups=[billing_group],
+                    aggregate_store_location=self.settings.get("AGGREGATE_STORE"),
+                )
+            else:
+                billing_group_totals = summarize_charges.group_totals(
+                    charges, self.org_accounts, [billing_group]
+                )
+
+        # quarterly delivery is a single workbook sent by the coordinator. A task that
+        # runs twice (requeued from a stalled worker) must not email the group twice
+        if self.query_parameters.get("deliver") and not self.quarterly_report_config:
+            delivered_marker = f"delivered-{task_id}"
+            if queue.mark_once(delivered_marker):
+                try:
+                    self.__timed("deliver", self.__deliver_reports, billing_group_totals)
+                except Exception:
+                    queue.unmark(delivered_marker)
+                    raise
+            else:
+                logger.info(f"Reports for '{billing_group}' were already delivered, not sending them again")
+
+        queue.complete(
+            task_id,
+            {
+                "billing_group": billing_group,
+                "total": billing_group_totals[billing_group],
+                "files": sorted(self.delivery_outbox.get(billing_group, [])),
+            },
+        )
@@ -1,13 +1,14 @@
+import json
 import logging
+import math
 import os
 import sys
 from datetime import datetime
 
-import boto3
-from botocore.exceptions import ClientError
-from retrying import retry
+from dateutil.relativedelta import relativedelta
 
-from helpers import get_sts_credentials
+import async_tasks
+from query_backends import query_backends
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -16,133 +17,79 @@ handler = logging.StreamHandler(sys.stdout)
 handler.setFormatter(formatter)
 logger.addHandler(handler)
 
+GB = 1024 ** 3
+TB = 1024 ** 4
 
-class QueryData:
-    def __init__(self, query_parameters):
-        self.query_parameters = query_parameters
-        self.sts_endpoint = "https://sts.ca-central-1.amazonaws.com"
-        self.athena_query_role_to_assume = os.environ["ATHENA_QUERY_ROLE_TO_ASSUME_ARN"]
-        self.athena_query_output_bucket_name = os.environ["ATHENA_QUERY_OUTPUT_BUCKET"]
-        self.athena_query_database = os.environ["ATHENA_QUERY_DATABASE"]
-        self.cmk_sse_kms_alias = os.environ["CMK_SSE_KMS_ALIAS"]
-
-        self.s3_output = "s3://" + self.athena_query_output_bucket_name + "/cur/"
-
-        if os.environ["AWS_DEFAULT_REGION"]:
-            self.aws_default_region = os.environ["AWS_DEFAULT_REGION"]
-        else:
-            self.aws_default_region = "ca-central-1"
-
-        self.role_session_name = "AthenaQuery"
-
-        self.credentials = get_sts_credentials(
-            self.athena_query_role_to_assume,
-            self.aws_default_region,
-            self.sts_endpoint,
-            self.role_session_name,
-        )
+# Athena bills at least 10 MB per query, rounded up to the next MB
+min_billed_bytes = 10 * 1024 ** 2
 
-        logger.info(f"\nQueryData Locals: {locals()}\n")
-
-    @retry(
-        stop_max_attempt_number=10,
-        wait_exponential_multiplier=300,
-        wait_exponential_max=1 * 60 * 1000,
-    )
-    def __poll_status(self, _id):
-
-        # Use the temporary credentials that AssumeRole returns to make a connection
-        # to Amazon Athena
-        try:
-            athena = boto3.client(
-                "athena",
-                aws_access_key_id=self.credentials["AccessKeyId"],
-                aws_secret_access_key=self.credentials["SecretAccessKey"],
-                aws_session_token=self.credentials["SessionToken"],
-            )
-        except ClientError as err:
-            logger.error(f"A boto3 client error has occurred: {err}")
-            return err
 
-        result = athena.get_query_execution(QueryExecutionId=_id)
-        state = result["QueryExecution"]["Status"]["State"]
+class ScanBudgetExceeded(Exception):
+    pass
 
-        logging.debug(
-            f"execution_id={_id}, state={state}, time={datetime.now().time()}"
-        )
 
-        if state == "SUCCEEDED" or state == "FAILED":
-            return
-        else:
-            raise Exception
-
-    def __run_query(self, query):
-
-        # Use the temporary credentials that AssumeRole returns to make a connection
-        # to Amazon Athena
-        try:
-            athena = boto3.client(
-                "athena",
-                aws_access_key_id=self.credentials["AccessKeyId"],
-                aws_secret_access_key=self.credentials["SecretAccessKey"],
-                aws_session_token=self.credentials["SessionToken"],
-            )
-        except ClientError as err:
-            logger.error(f"A boto3 client error has occurred: {err}")
-            return err
-
-        query_execution_id = []
-        logger.info(f"Query output location: {self.s3_output}")
-        try:
-            response = athena.start_query_execution(
-                QueryString=query,
-                QueryExecutionContext={"Database": self.athena_query_database},
-                ResultConfiguration={
-                    "OutputLocation": self.s3_output,
-                    "EncryptionConfiguration": {
-                        "EncryptionOption": "SSE_KMS",
-                        "KmsKey": self.cmk_sse_kms_alias,
-                    },
-                },
-            )
-            query_execution_id = response["QueryExecutionId"]
-        except ClientError as err:
-            logger.error(f"Start query error: {err}")
-            return err
+def scan_budget_bytes():
+    # ATHENA_MAX_SCAN_GB caps the bytes any single query may scan; unset means no limit
+    budget = os.environ.get("ATHENA_MAX_SCAN_GB")
+    return float(budget) * GB if budget else None
 
-        # block until the query execution completes
-        self.__poll_status(query_execution_id)
 
-        # check the result
-        result = athena.get_query_execution(QueryExecutionId=query_execution_id)[
-            "QueryExecution"
-        ]["Status"]["State"]
+def allow_unestimated_scans():
+    # with ATHENA_MAX_SCAN_GB set, queries the planner can't estimate (e.g. tables without
+    # statistics) are refused unless ATHENA_ALLOW_UNESTIMATED_SCANS=true
+    return os.environ.get("ATHENA_ALLOW_UNESTIMATED_SCANS", "false").lower() == "true"
 
-        if result == "SUCCEEDED":
-            logging.info(f"Query SUCCEEDED: {query_execution_id}")
 
-            return query_execution_id
-        else:
-            raise Exception
+def query_cost(data_scanned_bytes):
+    # ATHENA_PRICE_PER_TB is the on-demand price in USD per TB scanned
+    price_per_tb = float(os.environ.get("ATHENA_PRICE_PER_TB", 5))
+    if not data_scanned_bytes:
+        return 0.0
+    billed_bytes = max(math.ceil(data_scanned_bytes / 1024 ** 2) * 1024 ** 2, min_billed_bytes)
+    return billed_bytes / TB * price_per_tb
 
-    def query_usage_charges(self):
+
+class QueryData:
+    def __init__(self, query_parameters, settings=None):
+        self.query_parameters = query_parameters
+        settings = os.environ if settings is None else settings
+
+        # QUERY_BACKEND=local runs the generated SQL against CUR files on disk instead of Athena
+        self.query_backend_name = settings.get("QUERY_BACKEND", "athena").lower()
+        self.backend = query_backends[self.query_backend_name](settings)
+
+        # (query execution id, billing period window) for every query run, for the cost ledger
+        self.executions = []
+
+        # settings (the environment or a landing zone's) are left out of the log
+        logger.info(f"\nQueryData Locals: {dict(query_parameters=query_parameters)}\n")
+
+    def build_usage_charges_query(self, start_date, end_date, billing_period=None):
         format_string = "%Y-%m-%dT%H:%M:%S"
-        start_date_string = datetime.strftime(
-            self.query_parameters["start_date"], format_string
-        )
-        end_date_string = datetime.strftime(
-            self.query_parameters["end_date"], format_string
-        )
+        start_date_string = datetime.strftime(start_date, format_string)
+        end_date_string = datetime.strftime(end_date, format_string)
 
         # SQL Query to execute
         query = f"""
 		   SELECT
-			line_item_usage_account_id, line_item_product_code, product_product_name, line_item_blended_cost, year, month
+			line_item_usage_account_id, line_item_product_code, product_product_name, line_item_blended_cost, year, month,
+			CAST(line_item_usage_start_date AS date) AS usage_date
 			FROM cost_and_usage_report
 			WHERE line_item_usage_start_date > CAST(From_iso8601_timestamp('{start_date_string}') AS timestamp)
 			AND line_item_usage_end_date <= CAST(From_iso8601_timestamp('{end_date_string}') AS timestamp)
 		"""
 
+        if billing_period:
+            # restricts the query to one billing period, the CUR table's partition (year,
+            # month; month is not zero padded), so each monthly query reads only its own
+            # partition. The usage dates are deliberately left alone: credits, refunds,
+            # fees and adjustments can start in another month than the one they are
+            # billed in, and every line item has exactly one billing period, so the
+            # monthly queries add up to the single query (as long as the window's line
+            # items are billed within the window's months)
+            period_start, _ = billing_period
+            query += f" AND year = '{period_start.year}' AND month = '{period_start.month}'"
+
         if "account_ids" in self.query_parameters:
             account_ids = ", ".join(
                 f"'{id}'" for id in self.query_parameters.get("account_ids")
@@ -154,4 +101,165 @@ class QueryData:
 
         logging.debug(query)
 
-        return self.__run_query(query)
+        return query
+
+    @staticmethod
+    def monthly_windows(start_date, end_date):
+        # calendar month boundaries covering [start_date, end_date]
+        window_start = datetime.combine(start_date.replace(day=1), datetime.min.time())
+        windows = []
+        while window_start <= end_date:
+            window_end = window_start + relativedelta(months=1)
+            windows.append((window_start, window_end))
+            window_start = window_end
+        return windows
+
+    def query_usage_charges(self):
+        query = self.build_usage_charges_query(
+            self.query_parameters["start_date"], self.query_parameters["end_date"]
+        )
+
+        query_execution_id = self.backend.run_query(query)
+        self.executions.append((query_execution_id, None))
+        return query_execution_id
+
+    def query_usage_charges_by_month(self):
+        """
+        Issues one query per billing period (calendar month) in the report window and
+        runs them concurrently. Returns the list of query execution ids, one per month.
+        """
+        start_date = self.query_parameters["start_date"]
+        end_date = self.query_parameters["end_date"]
+
+        queries = [
+            self.build_usage_charges_query(start_date, end_date, window)
+            for window in self.monthly_windows(start_date, end_date)
+        ]
+        logger.info(f"Splitting report window into {len(queries)} monthly queries")
+
+        query_execution_ids = self.backend.run_queries(queries)
+        self.executions.extend(
+            zip(query_execution_ids, self.monthly_windows(start_date, end_date))
+        )
+        return query_execution_ids
+
+    def __estimate(self, queries, description):
+        # pre-flight estimates for `queries`, None where the planner has none
+        estimates = async_tasks.map_calls("athena", self.backend.estimate_scan_bytes, queries)
+        logger.info(
+            f"Estimated scan per {description}: "
+            + ", ".join("unknown" if e is None else f"{e / GB:.2f} GB" for e in estimates)
+        )
+        return estimates
+
+    @staticmethod
+    def __within_budget(estimates, budget):
+        return all(estimate is not None and estimate <= budget for estimate in estimates)
+
+    def __check_budget(self, estimates, budget):
+        start_date = self.query_parameters["start_date"]
+        end_date = self.query_parameters["end_date"]
+
+        over = [estimate for estimate in estimates if estimate is not None and estimate > budget]
+        if over:
+            raise ScanBudgetExceeded(
+                f"Query for {start_date} - {end_date} would scan {max(over) / GB:.2f} GB, "
+                f"over the ATHENA_MAX_SCAN_GB budget of {budget / GB:.2f} GB"
+            )
+
+        # a query without an estimate could scan anything, e.g. the whole CUR history
+        if None in estimates:
+            if not allow_unestimated_scans():
+                raise ScanBudgetExceeded(
+                    f"No scan estimate for the query for {start_date} - {end_date}, so the "
+                    f"ATHENA_MAX_SCAN_GB budget can't be checked; set ATHENA_ALLOW_UNESTIMATED_SCANS=true to run it anyway"
+                )
+            logger.warning("Running queries without a scan estimate (ATHENA_ALLOW_UNESTIMATED_SCANS)")
+
+    def query_usage_charges_within_budget(self, split_by_month=False):
+        """
+        Runs the usage charges query, as one query or one per calendar month, after
+        checking the planner's scan estimates against ATHENA_MAX_SCAN_GB. A single query
+        over the budget, or without an estimate, is split by month when every monthly
+        query fits; otherwise ScanBudgetExceeded is raised before anything is scanned.
+        Returns the list of query execution ids.
+        """
+        start_date = self.query_parameters["start_date"]
+        end_date = self.query_parameters["end_date"]
+        if start_date > end_date:
+            raise ValueError(f"Report window starts after it ends: {start_date} > {end_date}")
+
+        windows = self.monthly_windows(start_date, end_date)
+        split = split_by_month and len(windows) > 1
+        budget = scan_budget_bytes()
+
+        if budget:
+            if split:
+                estimates = self.__estimate(
+                    [self.build_usage_charges_query(start_date, end_date, window) for window in windows],
+                    "monthly query",
+                )
+            else:
+                estimates = self.__estimate([self.build_usage_charges_query(start_date, end_date)], "query")
+
+            if not split and len(windows) > 1 and not self.__within_budget(estimates, budget):
+                logger.info(
+                    f"The query for the whole window is not known to fit the {budget / GB:.2f} GB budget; trying monthly queries"
+                )
+                split = True
+                # each monthly query only reads its own partition (see
+                # build_usage_charges_query), so the parts are estimated again before
+                # any of them runs
+                estimates = self.__estimate(
+                    [self.build_usage_charges_query(start_date, end_date, window) for window in windows],
+                    "monthly query",
+                )
+
+            self.__check_budget(estimates, budget)
+
+        if split:
+            return self.query_usage_charges_by_month()
+
+        return [self.query_usage_charges()]
+
+    def cost_ledger(self):
+        """
+        One entry per query run: its window, the bytes it scanned, engine and total time
+        as reported by the backend, and the estimated cost in USD.
+        """
+        entries = []
+        for query_execution_id, window in self.executions:
+            statistics = self.backend.statistics.get(query_execution_id, {})
+            data_scanned_bytes = statistics.get("DataScannedInBytes", 0)
+            entries.append(
+                {
+                    "query_execution_id": query_execution_id,
+                    "backend": self.query_backend_name,
+                    "start_date": self.query_parameters["start_date"].isoformat(),
+                    "end_date": self.query_parameters["end_date"].isoformat(),
+                    "billing_period": [boundary.isoformat() for boundary in window] if window else None,
+                    "data_scanned_bytes": data_scanned_bytes,
+                    "engine_execution_time_ms": statistics.get("EngineExecutionTimeInMillis"),
+                    "total_execution_time_ms": statistics.get("TotalExecutionTimeInMillis"),
+                    "estimated_cost_usd": round(query_cost(data_scanned_bytes), 6),
+                }
+            )
+        return entries
+
+    def write_cost_ledger(self, path):
+        entries = self.cost_ledger()
+        with open(path, "w") as ledger_file:
+            json.dump(entries, ledger_file, indent=2)
+
+        data_scanned_bytes = sum(entry["data_scanned_bytes"] for entry in entries)
+        cost = sum(entry["estimated_cost_usd"] for entry in entries)
+        logger.info(
+            f"{len(entries)} queries scanned {data_scanned_bytes / GB:.3f} GB "
+            f"(about ${cost:.4f} USD); ledger written to '{path}'"
+        )
+
+    def download_results(self, query_execution_id, local_path):
+        self.backend.download_results(query_execution_id, local_path)
+
+    def open_results_stream(self, query_execution_id, tee_path=None):
+        return self.backend.open_results_stream(query_execution_id, tee_path)
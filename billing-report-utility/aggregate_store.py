@@ -0,0 +1,262 @@
+import fcntl
+import io
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+from contextlib import contextmanager
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import aws_sessions
+import money
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+handler = logging.StreamHandler(sys.stdout)
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+
+# Per-period aggregates kept across runs, so trends don't need a new CUR scan for every
+# period. AGGREGATE_STORE is a local directory or an s3://bucket/prefix:
+#
+#   <store>/period=<start>_<end>/aggregates.parquet   one row per group, account and product
+#   <store>/index.json                                 CAD total per group for every period
+#
+# The index answers "totals for group X over the last N periods" without touching the
+# Parquet files, which are only read for account or product detail.
+
+index_name = "index.json"
+aggregates_name = "aggregates.parquet"
+
+# bump whenever the columns or units of the stored aggregates change
+store_format_version = "1"
+
+key_columns = [
+    "group",
+    "line_item_usage_account_id",
+    "Account_Name",
+    "line_item_product_code",
+    "product_product_name",
+]
+
+# int64 micro-dollars, see money.py
+value_columns = ["line_item_blended_cost", "CAD"]
+
+# append() reads, merges and rewrites the period partition and the index, so updates of
+# one store are serialized: between threads of this process (see service,
+# landing_zones) with these locks, and between processes with a lock file (local stores)
+_lock = threading.Lock()
+_store_locks = {}
+
+
+def store_location():
+    return os.environ.get("AGGREGATE_STORE")
+
+
+def period_key(start_date, end_date):
+    return f"{start_date.strftime('%Y-%m-%d')}_{end_date.strftime('%Y-%m-%d')}"
+
+
+class LocalStore:
+    def __init__(self, root):
+        self.root = root
+
+    def read(self, name):
+        path = f"{self.root}/{name}"
+        if not os.path.isfile(path):
+            return None
+        with open(path, "rb") as f:
+            return f.read()
+
+    def write(self, name, data):
+        path = f"{self.root}/{name}"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # written under a unique temporary name so readers never see a partial file
+        with tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(path), prefix=f".{os.path.basename(path)}.", suffix=".tmp", delete=False
+        ) as f:
+            f.write(data)
+        os.replace(f.name, path)
+
+    @contextmanager
+    def lock(self):
+        # also held by RUN_MODE=worker processes sharing the store
+        os.makedirs(self.root, exist_ok=True)
+        with open(f"{self.root}/.lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class S3Store:
+    def __init__(self, uri):
+        bucket_and_prefix = uri[len("s3://"):].rstrip("/")
+        self.bucket, _, self.prefix = bucket_and_prefix.partition("/")
+        # S3_ENDPOINT_URL points this at a local S3 stand-in (e.g. moto server) for testing
+        self.s3_client = aws_sessions.get_client("s3", endpoint_url=os.environ.get("S3_ENDPOINT_URL"))
+
+    def key(self, name):
+        return f"{self.prefix}/{name}" if self.prefix else name
+
+    def read(self, name):
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket, Key=self.key(name))
+        except self.s3_client.exceptions.NoSuchKey:
+            return None
+        return response["Body"].read()
+
+    def write(self, name, data):
+        self.s3_client.put_object(Bucket=self.bucket, Key=self.key(name), Body=data)
+
+    @contextmanager
+    def lock(self):
+        # S3 has no locks; updates are only serialized within this process
+        yield
+
+
+def open_store(location=None):
+    location = location or store_location()
+    if not location:
+        return None
+    if location.startswith("s3://"):
+        return S3Store(location)
+    return LocalStore(location)
+
+
+@contextmanager
+def locked(location, store):
+    with _lock:
+        store_lock = _store_locks.setdefault(location, threading.Lock())
+    with store_lock, store.lock():
+        yield
+
+
+def read_index(store):
+    data = store.read(index_name)
+    if data is None:
+        return {"format_version": store_format_version, "periods": {}}
+    return json.loads(data)
+
+
+def to_parquet_bytes(df):
+    sink = io.BytesIO()
+    pq.write_table(pa.Table.from_pandas(df, preserve_index=False), sink, compression="zstd")
+    return sink.getvalue()
+
+
+def read_parquet_bytes(data):
+    return pq.read_table(io.BytesIO(data)).to_pandas()
+
+
+def append(charges, query_parameters, group_column, billing_groups, location=None):
+    """
+    Stores the aggregates of one report period: `charges` (see
+    summarize_charges.load_charges) summed per group, account and product. Rows for
+    `billing_groups` replace whatever was stored for them in the same period, so reruns
+    and targeted runs (BILLING_GROUPS) update the period without losing other groups.
+    """
+    location = location or store_location()
+    store = open_store(location)
+    if store is None:
+        return
+
+    start_date = query_parameters["start_date"]
+    end_date = query_parameters["end_date"]
+    period = period_key(start_date, end_date)
+    partition_name = f"period={period}/{aggregates_name}"
+
+    aggregates = (
+        charges.rename(columns={group_column: "group"})
+        .groupby(key_columns, dropna=False)[value_columns]
+        .sum()
+        .reset_index()
+    )
+    billing_groups = set(billing_groups)
+    aggregates = aggregates[aggregates["group"].isin(billing_groups)]
+
+    with locked(location, store):
+        existing = store.read(partition_name)
+        if existing is not None:
+            kept = read_parquet_bytes(existing)
+            kept = kept[~kept["group"].isin(billing_groups)]
+            aggregates = pd.concat([kept, aggregates], ignore_index=True)
+
+        store.write(partition_name, to_parquet_bytes(aggregates))
+
+        index = read_index(store)
+        cad_by_group = aggregates.groupby("group")["CAD"].sum()
+        index["periods"][period] = {
+            "start_date": start_date.isoformat(),
+            "end_date": end_date.isoformat(),
+            "report_type": query_parameters.get("report_type"),
+            "totals": {str(group): int(micros) for group, micros in cad_by_group.items()},
+        }
+        store.write(index_name, json.dumps(index, indent=2, sort_keys=True).encode("utf-8"))
+
+    logger.info(f"Stored {len(aggregates)} aggregate rows for period '{period}'")
+
+
+class AggregateReader:
+    """
+    Read side of the store, also handed to the report template. The index is read once
+    when the reader is opened.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.index = read_index(store)
+
+    def periods(self, report_type=None, before=None):
+        # (period key, entry), oldest first. Weekly, monthly and quarterly windows
+        # overlap, so comparisons should stick to one report type
+        periods = sorted(
+            self.index["periods"].items(), key=lambda item: item[1]["start_date"]
+        )
+        return [
+            (period, entry)
+            for period, entry in periods
+            if (report_type is None or entry.get("report_type") == report_type)
+            and (before is None or entry["start_date"] < before.isoformat())
+        ]
+
+    def group_totals(self, billing_group, periods=12, report_type=None, before=None):
+        """
+        CAD total of `billing_group` for each of the last `periods` stored periods,
+        oldest first, as dicts with start_date, end_date and total (dollars).
+        """
+        return [
+            {
+                "start_date": entry["start_date"],
+                "end_date": entry["end_date"],
+                "total": money.total_in_dollars(entry["totals"].get(billing_group, 0)),
+            }
+            for _, entry in self.periods(report_type, before)[-periods:]
+        ]
+
+    def group_detail(self, billing_group, periods=12, report_type=None):
+        # per account and product rows of `billing_group` over the last `periods` periods
+        frames = []
+        for period, entry in self.periods(report_type)[-periods:]:
+            data = self.store.read(f"period={period}/{aggregates_name}")
+            if data is None:
+                continue
+            df = read_parquet_bytes(data)
+            df = df[df["group"] == billing_group]
+            frames.append(df.assign(start_date=entry["start_date"], end_date=entry["end_date"]))
+        if not frames:
+            return pd.DataFrame(columns=["start_date", "end_date"] + key_columns + value_columns)
+        return pd.concat(frames, ignore_index=True)
+
+
+def open_reader(location=None):
+    # None when no store is configured
+    store = open_store(location)
+    return AggregateReader(store) if store is not None else None
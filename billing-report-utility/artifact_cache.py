@@ -0,0 +1,91 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+handler = logging.StreamHandler(sys.stdout)
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+
+
+def cache_enabled():
+    return os.environ.get("ARTIFACT_CACHE", "true").lower() == "true"
+
+
+def cache_dir():
+    # defaults to a sibling of the per-query output directories so reruns for the same
+    # window (which get a new query execution id) can still find earlier artifacts
+    current_dir = os.path.dirname(os.path.realpath(__file__))
+    return os.environ.get("ARTIFACT_CACHE_DIR", f"{current_dir}/output/artifact_cache")
+
+
+def hash_dataframe(df):
+    # imported here so callers that only need the key helpers don't pay for pandas
+    import pandas as pd
+
+    digest = hashlib.sha256()
+    digest.update(",".join(map(str, df.columns)).encode("utf-8"))
+    digest.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    return digest.hexdigest()
+
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def artifact_key(*parts):
+    """
+    Builds a content address for an artifact from its inputs. Parts can be anything
+    json serializable (account metadata, exchange rate, template version...) and are
+    hashed together with the artifact kind so an xlsx and an html built from the same
+    slice never collide.
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(json.dumps(part, sort_keys=True, default=str).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def fetch(key, output_file):
+    """
+    Copies a previously rendered artifact to `output_file`. Returns True on a cache hit.
+    """
+    if not cache_enabled():
+        return False
+
+    cached_file = Path(cache_dir()) / key / os.path.basename(output_file)
+    if not cached_file.is_file():
+        return False
+
+    shutil.copyfile(cached_file, output_file)
+    logger.debug(f"Artifact cache hit for '{output_file}' ({key})")
+    return True
+
+
+def store(key, output_file):
+    if not cache_enabled():
+        return
+
+    key_dir = Path(cache_dir()) / key
+    key_dir.mkdir(parents=True, exist_ok=True)
+
+    # write to a temporary name first so a crash mid-copy never leaves a partial artifact
+    # that a later run would treat as a hit. The name is unique, as concurrent runs
+    # (see service, landing_zones) can store the same artifact at the same time
+    name = os.path.basename(output_file)
+    with tempfile.NamedTemporaryFile(dir=key_dir, prefix=f".{name}.", suffix=".tmp", delete=False) as tmp_file:
+        with open(output_file, "rb") as source:
+            shutil.copyfileobj(source, tmp_file)
+    os.replace(tmp_file.name, key_dir / name)
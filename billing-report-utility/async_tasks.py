@@ -0,0 +1,92 @@
+import asyncio
+import functools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# default number of calls in flight per service; MAX_CONCURRENT_<SERVICE> overrides them,
+# e.g. MAX_CONCURRENT_SES=4. Organizations in particular throttles aggressively.
+default_limits = {
+    "organizations": 4,
+    "ses": 8,
+    "ssm": 4,
+    "sts": 4,
+    "athena": 5,
+    "s3": 8,
+    "http": 4,
+}
+
+# one semaphore per service for the whole process, shared by every run() (nested ones,
+# and ones on other threads, included) so MAX_CONCURRENT_<SERVICE> caps all of them together
+_semaphores = {}
+_semaphores_lock = threading.Lock()
+
+# the service whose slot the call running on this thread holds, if any
+_current_call = threading.local()
+
+
+def limit_for(service):
+    return int(os.environ.get(f"MAX_CONCURRENT_{service.upper()}", default_limits.get(service, 4)))
+
+
+def semaphore(service):
+    with _semaphores_lock:
+        if service not in _semaphores:
+            _semaphores[service] = threading.BoundedSemaphore(limit_for(service))
+        return _semaphores[service]
+
+
+def _limited(service, fn, *args, **kwargs):
+    # runs on an executor thread, holding one of the service's slots
+    with semaphore(service):
+        _current_call.service = service
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _current_call.service = None
+
+
+async def call(service, fn, *args, **kwargs):
+    """
+    Runs the blocking call `fn` (a boto3 client method, a requests call...) as an
+    awaitable, with at most limit_for(service) calls to the same service in flight.
+    boto3 clients are thread-safe, so the shared clients from aws_sessions can be used.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(_limited, service, fn, *args, **kwargs))
+
+
+def run(*awaitables):
+    """
+    Runs the awaitables concurrently from synchronous code and returns their results in
+    order. The first failure is raised once every call has finished.
+    """
+
+    async def gather():
+        # the blocking calls run on these threads; the semaphores decide how many of
+        # them are busy with a given service at any time, across runs
+        asyncio.get_running_loop().set_default_executor(
+            ThreadPoolExecutor(max_workers=sum(limit_for(service) for service in default_limits))
+        )
+        results = await asyncio.gather(*awaitables, return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        return results
+
+    # a run started from inside a call (e.g. the Athena query estimating its parts) gives
+    # that call's slot back while its own calls are in flight, so a parent waiting on
+    # its children can't hold up the slots they need
+    parent_service = getattr(_current_call, "service", None)
+    if parent_service:
+        semaphore(parent_service).release()
+    try:
+        return asyncio.run(gather())
+    finally:
+        if parent_service:
+            semaphore(parent_service).acquire()
+
+
+def map_calls(service, fn, items):
+    # fn(item) for every item, concurrently within the service's limit
+    return run(*(call(service, fn, item) for item in items))
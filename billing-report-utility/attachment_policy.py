@@ -0,0 +1,136 @@
+import logging
+import os
+import sys
+import zipfile
+from datetime import datetime, timedelta
+
+import aws_sessions
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+handler = logging.StreamHandler(sys.stdout)
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+
+MB = 1024 * 1024
+
+# SigV4 pre-signed URLs can't outlive 7 days
+max_link_expiry_seconds = 7 * 24 * 3600
+
+
+def zip_threshold():
+    return float(os.environ.get("ATTACHMENT_ZIP_THRESHOLD_MB", 1)) * MB
+
+
+def link_threshold():
+    # SES rejects raw messages over 10 MB and base64 adds a third, so 7 MB of files is
+    # about as much as can safely go inline
+    return float(os.environ.get("ATTACHMENT_LINK_THRESHOLD_MB", 7)) * MB
+
+
+def link_expiry_seconds():
+    return min(
+        int(os.environ.get("REPORT_LINK_EXPIRY_SECONDS", max_link_expiry_seconds)),
+        max_link_expiry_seconds,
+    )
+
+
+def reports_bucket(settings=None):
+    # settings default to the environment; LANDING_ZONES runs pass each landing zone's own
+    settings = os.environ if settings is None else settings
+    return settings.get("REPORTS_S3_BUCKET") or settings.get("QR_S3_Bucket")
+
+
+def total_size(paths):
+    return sum(os.path.getsize(path) for path in paths)
+
+
+def zip_attachments(attachments, zip_path):
+    with zipfile.ZipFile(zip_path, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for attachment in attachments:
+            archive.write(attachment, arcname=os.path.basename(attachment))
+    return zip_path
+
+
+def upload_and_sign(path, bucket, key_prefix):
+    # S3_ENDPOINT_URL points this at a local S3 stand-in (e.g. moto server) for testing
+    s3_client = aws_sessions.get_client("s3", endpoint_url=os.environ.get("S3_ENDPOINT_URL"))
+    key = f"{key_prefix}/{os.path.basename(path)}"
+
+    s3_client.upload_file(path, bucket, key)
+    logger.info(f"Uploaded '{path}' to 's3://{bucket}/{key}'")
+
+    return s3_client.generate_presigned_url(
+        "get_object",
+        Params={"Bucket": bucket, "Key": key},
+        ExpiresIn=link_expiry_seconds(),
+    )
+
+
+def locations(directory, name, start_date, end_date, report_type, landing_zone=None):
+    """
+    The archive path (in `directory`) and the reports bucket key prefix for the files of
+    one email. The landing zone keeps archives and uploads of same-named billing groups
+    in different landing zones (see landing_zones) apart.
+    """
+    landing_zone_prefix = f"{landing_zone}-" if landing_zone else ""
+    zip_path = (
+        f"{directory}/{landing_zone_prefix}"
+        f"{start_date.strftime('%Y-%m-%d')}-{end_date.strftime('%Y-%m-%d')}-{name}.zip"
+    )
+    key_prefix = f"reports/{report_type}/{start_date.strftime('%Y')}"
+    if landing_zone:
+        key_prefix = f"{key_prefix}/{landing_zone}"
+    return zip_path, key_prefix
+
+
+def prepare(attachments, zip_path, key_prefix, settings=None):
+    """
+    Decides how the files for one email are delivered. Returns the files to attach and a
+    list of (file name, pre-signed url) for the files that are linked instead:
+
+    - over ATTACHMENT_ZIP_THRESHOLD_MB the files are zipped into `zip_path`, provided
+      the archive is actually smaller;
+    - still over ATTACHMENT_LINK_THRESHOLD_MB they are uploaded under `key_prefix` in
+      the reports bucket (REPORTS_S3_BUCKET, or QR_S3_Bucket, from `settings`) and
+      linked.
+
+    Runs covering several landing zones must pass a `zip_path` and `key_prefix` unique
+    to the landing zone (see locations), as billing group names repeat across landing
+    zones.
+    """
+    attachments = sorted(attachments)
+    size = total_size(attachments)
+
+    if size > zip_threshold():
+        zip_attachments(attachments, zip_path)
+        zip_size = os.path.getsize(zip_path)
+        if zip_size < size:
+            logger.info(
+                f"Zipped {len(attachments)} attachments from {size / MB:.1f} MB to {zip_size / MB:.1f} MB"
+            )
+            attachments, size = [zip_path], zip_size
+        else:
+            os.remove(zip_path)
+
+    if size <= link_threshold():
+        return attachments, []
+
+    bucket = reports_bucket(settings)
+    if not bucket:
+        logger.warning(
+            f"Attachments total {size / MB:.1f} MB but no reports bucket is configured; sending them inline"
+        )
+        return attachments, []
+
+    links = [
+        (os.path.basename(attachment), upload_and_sign(attachment, bucket, key_prefix))
+        for attachment in attachments
+    ]
+    return [], links
+
+
+def links_expire():
+    # shown next to the links in the email
+    return datetime.now() + timedelta(seconds=link_expiry_seconds())
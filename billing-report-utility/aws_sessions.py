@@ -0,0 +1,122 @@
+import logging
+import os
+import sys
+import threading
+
+import boto3
+from botocore.credentials import RefreshableCredentials
+from botocore.session import get_session as get_botocore_session
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+handler = logging.StreamHandler(sys.stdout)
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+
+sts_endpoint = "https://sts.ca-central-1.amazonaws.com"
+assume_role_duration_seconds = 3600
+
+# boto3 sessions are not thread-safe, clients are. All session/client creation happens
+# under this lock and the resulting clients are shared freely between threads.
+_lock = threading.Lock()
+_sessions = {}
+_session_locks = {}
+_clients = {}
+
+
+def default_region():
+    return os.environ.get("AWS_DEFAULT_REGION") or "ca-central-1"
+
+
+def _assume_role_fetcher(role_arn, role_session_name):
+    def fetch_credentials():
+        logger.info(f"Assuming role: {role_arn}")
+        sts_client = get_client("sts", endpoint_url=sts_endpoint)
+        credentials = sts_client.assume_role(
+            DurationSeconds=assume_role_duration_seconds,
+            RoleArn=role_arn,
+            RoleSessionName=role_session_name,
+        )["Credentials"]
+        logger.info(f"Successfully assumed role: {role_arn}")
+
+        return {
+            "access_key": credentials["AccessKeyId"],
+            "secret_key": credentials["SecretAccessKey"],
+            "token": credentials["SessionToken"],
+            "expiry_time": credentials["Expiration"].isoformat(),
+        }
+
+    return fetch_credentials
+
+
+def get_session(role_arn=None, role_session_name=None):
+    """
+    Returns a boto3 session for the given role, assuming it on first use. The assumed
+    role credentials are refreshed by botocore shortly before they expire, so a single
+    session can be used for the whole run no matter how long it takes. Without a role
+    the default credential chain (task role, local profile...) is used.
+    """
+    key = (role_arn, role_session_name)
+
+    with _lock:
+        session = _sessions.get(key)
+        if session:
+            return session
+        session_lock = _session_locks.setdefault(key, threading.Lock())
+
+    # assume each role once even when several threads ask for it at the same time, while
+    # still letting different roles be assumed concurrently
+    with session_lock:
+        with _lock:
+            session = _sessions.get(key)
+        if session:
+            return session
+
+        if role_arn is None:
+            session = boto3.Session(region_name=default_region())
+        else:
+            fetch_credentials = _assume_role_fetcher(role_arn, role_session_name)
+            credentials = RefreshableCredentials.create_from_metadata(
+                metadata=fetch_credentials(),
+                refresh_using=fetch_credentials,
+                method="sts-assume-role",
+            )
+            botocore_session = get_botocore_session()
+            botocore_session._credentials = credentials
+            session = boto3.Session(
+                botocore_session=botocore_session, region_name=default_region()
+            )
+
+        with _lock:
+            _sessions[key] = session
+
+    return session
+
+
+def get_client(service_name, role_arn=None, role_session_name=None, region_name=None, endpoint_url=None):
+    """
+    Returns a shared, thread-safe client for `service_name`, created once per role,
+    region and endpoint.
+    """
+    region_name = region_name or default_region()
+    key = (service_name, role_arn, role_session_name, region_name, endpoint_url)
+
+    with _lock:
+        client = _clients.get(key)
+    if client:
+        return client
+
+    session = get_session(role_arn, role_session_name)
+
+    with _lock:
+        if key not in _clients:
+            _clients[key] = session.client(
+                service_name, region_name=region_name, endpoint_url=endpoint_url
+            )
+        return _clients[key]
+
+
+def get_credentials(role_arn=None, role_session_name=None):
+    # a frozen snapshot, for the few places that need raw keys rather than a client
+    return get_session(role_arn, role_session_name).get_credentials().get_frozen_credentials()
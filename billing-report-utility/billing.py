@@ -6,12 +6,8 @@ import logging
 from datetime import date, datetime, timezone, timedelta, tzinfo
 from dateutil.relativedelta import *
 
-import requests
-
 from fiscalyear import FiscalMonth, FiscalQuarter, setup_fiscal_calendar
 
-from BillingManager import BillingManager
-
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
@@ -22,6 +18,43 @@ logger.addHandler(handler)
 setup_fiscal_calendar(start_month=4)
 
 
+def run_report(event_bridge_params):
+    # BillingManager pulls in boto3, pandas, openpyxl... so it is only imported once the
+    # report parameters have been resolved and we know there is work to do
+    from BillingManager import BillingManager
+    import landing_zones
+
+    # LANDING_ZONES runs the report for several landing zones in this process
+    configured_landing_zones = landing_zones.load_landing_zones()
+    if configured_landing_zones:
+        landing_zones.run(event_bridge_params, configured_landing_zones)
+        return
+
+    bill_manager = BillingManager(event_bridge_params)
+
+    # RUN_MODE=coordinator queues one task per billing group for RUN_MODE=worker tasks
+    # sharing WORK_QUEUE_DIR; the default runs the whole report in this process
+    run_mode = os.environ.get("RUN_MODE", "single").lower()
+    if run_mode == "coordinator":
+        bill_manager.coordinate()
+    elif run_mode == "worker":
+        bill_manager.work()
+    else:
+        bill_manager.do()
+
+
+def selected_billing_groups():
+    """
+    BILLING_GROUPS="Group A,Group B" restricts a run to the named billing groups (or
+    account codings when GROUP_TYPE=account_coding): only their accounts are queried,
+    reported on and delivered to. Unset or empty runs the report for every group.
+    """
+    billing_groups = [
+        group.strip() for group in os.environ.get("BILLING_GROUPS", "").split(",") if group.strip()
+    ]
+    return billing_groups or None
+
+
 def weekly(event_bridge_params):
     """
     Fiscal week begins Wednesday at 00:00:00 and ends the following Tuesday night
@@ -47,7 +80,6 @@ def weekly(event_bridge_params):
 
     event_bridge_params.update(
         {
-            "billing_groups": None,
             "start_date": start_date,
             "end_date": end_date,
         }
@@ -55,8 +87,7 @@ def weekly(event_bridge_params):
 
     logger.info(f"event_bridge_params_updated: {event_bridge_params}\n")
 
-    bill_manager = BillingManager(event_bridge_params)
-    bill_manager.do()
+    run_report(event_bridge_params)
 
 
 def monthly(event_bridge_params):
@@ -83,15 +114,13 @@ def monthly(event_bridge_params):
 
     event_bridge_params.update(
         {
-            "billing_groups": None,
             "start_date": start_date,
             "end_date": end_date,
         }
     )
     logger.info(f"event_bridge_params_updated: {event_bridge_params}\n")
 
-    bill_manager = BillingManager(event_bridge_params)
-    bill_manager.do()
+    run_report(event_bridge_params)
 
 
 def quarterly(event_bridge_params):
@@ -131,15 +160,13 @@ def quarterly(event_bridge_params):
 
     event_bridge_params.update(
         {
-            "billing_groups": None,
             "start_date": start_date,
             "end_date": end_date,
         }
     )
     logger.info(f"event_bridge_params_updated: {event_bridge_params}\n")
 
-    bill_manager = BillingManager(event_bridge_params)
-    bill_manager.do()
+    run_report(event_bridge_params)
 
 
 def manual(event_bridge_params):
@@ -172,15 +199,13 @@ def manual(event_bridge_params):
 
     event_bridge_params.update(
         {
-            "billing_groups": None,
             "start_date": start_date,
             "end_date": end_date,
         }
     )
     logger.info(f"event_bridge_params_updated: {event_bridge_params}\n")
 
-    bill_manager = BillingManager(event_bridge_params)
-    bill_manager.do()
+    run_report(event_bridge_params)
 
 
 def main():
@@ -189,6 +214,8 @@ def main():
     logger.debug(f"Environment Variables: {json.dumps(dict(os.environ))}")
 
     if os.environ.get("AWS_EXECUTION_ENV"):
+        import requests
+
         metadata_uri_v4 = os.environ["ECS_CONTAINER_METADATA_URI_V4"]
         get_v4_metadata = requests.get(format(metadata_uri_v4))
         v4_metadata = get_v4_metadata.json()
@@ -199,6 +226,7 @@ def main():
         "deliver": os.environ["DELIVER"].lower() == "true",  # env vars cannot be boolean so we have to evaluate the string here
         "recipient_override": os.environ["RECIPIENT_OVERRIDE"].lower(),
         "carbon_copy": os.environ["CARBON_COPY"].lower(),
+        "billing_groups": selected_billing_groups(),
     }
     logger.info(f"event_bridge_payload: {json.dumps(dict(event_bridge_payload))}")
 
@@ -0,0 +1,99 @@
+import json
+import logging
+import os
+import sys
+import tempfile
+
+import pyarrow as pa
+import pyarrow.feather as feather
+
+import artifact_cache
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+handler = logging.StreamHandler(sys.stdout)
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+
+fingerprint_metadata_key = b"charges_fingerprint"
+exchange_rate_metadata_key = b"exchange_rate"
+
+# bump whenever the layout of the loaded charges frame changes (columns, money units...)
+charges_format_version = "2"
+
+
+def cache_enabled():
+    return os.environ.get("CHARGES_CACHE", "true").lower() == "true"
+
+
+def fingerprint(query_results_file, accounts, exchange_rate, columns):
+    """
+    Identifies the loaded charges by everything they are derived from. The results file
+    is identified by its path, size and modification time rather than its content, which
+    would take almost as long to hash as it takes to parse.
+    """
+    stat = os.stat(query_results_file)
+    return artifact_cache.artifact_key(
+        "charges.arrow",
+        charges_format_version,
+        os.path.realpath(query_results_file),
+        stat.st_size,
+        stat.st_mtime_ns,
+        accounts,
+        exchange_rate,
+        columns,
+    )
+
+
+def read(cache_path, key):
+    """
+    Returns the charges stored at `cache_path` when they were built from the same
+    inputs (see fingerprint), otherwise None. The file is memory mapped, so only the
+    pages that are actually used are read from disk, and numeric columns (the int64
+    money columns, year, month) come out as read-only pandas views of the mapped pages
+    rather than copies. String columns are always materialized as Python objects.
+    """
+    if not cache_enabled() or not os.path.isfile(cache_path):
+        return None
+
+    with pa.memory_map(cache_path) as source:
+        table = pa.ipc.open_file(source).read_all()
+
+    cached_key = (table.schema.metadata or {}).get(fingerprint_metadata_key, b"").decode()
+    if cached_key != key:
+        logger.info(f"Ignoring stale charges cache '{cache_path}'")
+        return None
+
+    logger.info(f"Loaded charges from cache '{cache_path}'")
+    # the rate(s) the CAD amounts were converted with
+    exchange_rate = json.loads(table.schema.metadata.get(exchange_rate_metadata_key, b"null"))
+    # one block per column, so columns are not consolidated (copied) into 2D blocks, and
+    # each Arrow column is released as soon as it has been converted
+    df = table.to_pandas(split_blocks=True, self_destruct=True)
+    del table
+    df.attrs["exchange_rate"] = exchange_rate
+    return df
+
+
+def write(cache_path, key, df):
+    if not cache_enabled():
+        return
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    table = table.replace_schema_metadata(
+        {
+            **(table.schema.metadata or {}),
+            fingerprint_metadata_key: key.encode(),
+            exchange_rate_metadata_key: json.dumps(df.attrs.get("exchange_rate")).encode(),
+        }
+    )
+
+    # uncompressed so the file can be memory mapped as is; written under a unique
+    # temporary name so an interrupted run never leaves a truncated cache behind and
+    # concurrent runs over the same results never write into each other's file
+    cache_dir, cache_name = os.path.split(os.path.abspath(cache_path))
+    with tempfile.NamedTemporaryFile(dir=cache_dir, prefix=f".{cache_name}.", suffix=".tmp", delete=False) as tmp_file:
+        pass
+    feather.write_feather(table, tmp_file.name, compression="uncompressed")
+    os.replace(tmp_file.name, cache_path)
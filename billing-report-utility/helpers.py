@@ -1,16 +1,23 @@
+import json
 import logging
 import os
 import sys
 import re
+import shutil
+import threading
+from collections import OrderedDict
 
 from email import encoders
+from email.generator import BytesGenerator
 from email.mime.base import MIMEBase
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 
-import boto3
 from botocore.exceptions import ClientError
 
+import async_tasks
+import aws_sessions
+
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
@@ -19,30 +26,6 @@ handler.setFormatter(formatter)
 logger.addHandler(handler)
 
 
-def get_sts_credentials(role_to_assume, aws_region, sts_endpoint, role_session_name):
-
-    # Assume cross account role needed to perform org level  account queries
-    logger.info(f"Assuming role: {role_to_assume}")
-    sts_client = boto3.client("sts", region_name=aws_region, endpoint_url=sts_endpoint)
-
-    try:
-        assumed_role_object = sts_client.assume_role(
-            DurationSeconds=3600,
-            RoleArn=role_to_assume,
-            RoleSessionName=role_session_name,
-        )
-    except ClientError as err:
-        if err.response["Error"]:
-            logger.error("STS Assume Role Error: ", err)
-        return err
-
-    logger.info(f"Successfully assumed role: {role_to_assume}")
-
-    # From the response that contains the assumed role, get the temporary
-    # credentials that can be used to make subsequent API calls
-    return assumed_role_object["Credentials"]
-
-
 def get_account_name_element(account_details, element_index):
     account_email = account_details["email"]
     account_name = account_details["name"]
@@ -52,36 +35,26 @@ def get_account_name_element(account_details, element_index):
         return account_name
 
 
-def query_org_accounts():
-    query_org_account_role_to_assume = os.environ[
+def query_org_accounts(settings=None):
+    # ORG_ACCOUNTS_FILE lets offline runs (e.g. QUERY_BACKEND=local) use a JSON export of
+    # the list this function returns instead of calling Organizations. `settings` default
+    # to the environment (see landing_zones)
+    settings = os.environ if settings is None else settings
+    org_accounts_file = settings.get("ORG_ACCOUNTS_FILE")
+    if org_accounts_file:
+        logger.info(f"Loading org accounts from '{org_accounts_file}'")
+        with open(org_accounts_file) as f:
+            return json.load(f)
+
+    query_org_account_role_to_assume = settings[
         "QUERY_ORG_ACCOUNTS_ROLE_TO_ASSUME_ARN"
     ]
-    sts_endpoint = "https://sts.ca-central-1.amazonaws.com"
     role_session_name = "QueryOrgAccounts"
 
-    if os.environ["AWS_DEFAULT_REGION"]:
-        aws_default_region = os.environ["AWS_DEFAULT_REGION"]
-    else:
-        aws_default_region = "ca-central-1"
-
-    credentials = get_sts_credentials(
-        query_org_account_role_to_assume,
-        aws_default_region,
-        sts_endpoint,
-        role_session_name,
+    org_client = aws_sessions.get_client(
+        "organizations", query_org_account_role_to_assume, role_session_name
     )
 
-    try:
-        org_client = boto3.client(
-            "organizations",
-            aws_access_key_id=credentials["AccessKeyId"],
-            aws_secret_access_key=credentials["SecretAccessKey"],
-            aws_session_token=credentials["SessionToken"],
-        )
-    except ClientError as err:
-        logger.error(f"A boto3 client error has occurred: {err}")
-        return err
-
     # we have lots of accounts - use a Paginator
     paginator = org_client.get_paginator("list_accounts")
     page_iterator = paginator.paginate()
@@ -95,47 +68,131 @@ def query_org_accounts():
         "Environment": "Core",
     }
 
+    # paging is sequential, but the tags of every account can then be fetched concurrently
+    org_accounts = [account for page in page_iterator for account in page["Accounts"]]
+    tags_responses = async_tasks.map_calls(
+        "organizations",
+        lambda account: org_client.list_tags_for_resource(ResourceId=account["Id"]),
+        org_accounts,
+    )
+
     accounts = []
-    for page in page_iterator:
-        for account in page["Accounts"]:
-            tags_response = org_client.list_tags_for_resource(ResourceId=account["Id"])
-            transposed_tags = {}
-            for tag in tags_response["Tags"]:
-                transposed_tag = {tag["Key"]: tag["Value"]}
-                transposed_tags.update(transposed_tag)
-
-            account_details = {
-                "arn": account["Arn"],
-                "email": account["Email"],
-                "id": account["Id"],
-                "name": account["Name"],
-                "status": account["Status"],
-            }
-
-            account_details.update(transposed_tags)
-
-            billing_group_missing = not transposed_tags.get("billing_group")
-            account_coding_missing = not transposed_tags.get("account_coding")
-            group_type_account_coding = os.environ.get("GROUP_TYPE") == "account_coding"
-
-            if billing_group_missing or (account_coding_missing and group_type_account_coding):
-                logger.debug(
-                    f"Account '{account_details['id']}' missing metadata tags; applying defaults."
-                )
-                account_details.update(core_billing_group_tags)
-
-            account_details["license_plate"] = get_account_name_element(
-                account_details, 0
+    for account, tags_response in zip(org_accounts, tags_responses):
+        transposed_tags = {}
+        for tag in tags_response["Tags"]:
+            transposed_tag = {tag["Key"]: tag["Value"]}
+            transposed_tags.update(transposed_tag)
+
+        account_details = {
+            "arn": account["Arn"],
+            "email": account["Email"],
+            "id": account["Id"],
+            "name": account["Name"],
+            "status": account["Status"],
+        }
+
+        account_details.update(transposed_tags)
+
+        billing_group_missing = not transposed_tags.get("billing_group")
+        account_coding_missing = not transposed_tags.get("account_coding")
+        group_type_account_coding = os.environ.get("GROUP_TYPE") == "account_coding"
+
+        if billing_group_missing or (account_coding_missing and group_type_account_coding):
+            logger.debug(
+                f"Account '{account_details['id']}' missing metadata tags; applying defaults."
             )
-            accounts.append(account_details)
+            account_details.update(core_billing_group_tags)
+
+        account_details["license_plate"] = get_account_name_element(
+            account_details, 0
+        )
+        accounts.append(account_details)
 
     return accounts
 
 
+def merge_csv_parts(part_paths, output_path):
+    # concatenates CSV files that share a header, keeping the header of the first one only
+    with open(output_path, "wb") as output_file:
+        for index, part_path in enumerate(part_paths):
+            with open(part_path, "rb") as part_file:
+                header = part_file.readline()
+                if index == 0:
+                    output_file.write(header)
+                shutil.copyfileobj(part_file, output_file, 1024 * 1024)
+            os.remove(part_path)
+
+
+# encoded attachment parts, reused when the same file goes out in several messages
+_attachment_parts = OrderedDict()
+_attachment_parts_size = 0
+_attachment_parts_lock = threading.Lock()
+
+
+def attachment_part(attachment):
+    """
+    Returns the MIME part for the file at `attachment`, base64 encoded and flattened to
+    bytes. Parts are cached for the run, keyed by path, size and modification time so a
+    rewritten file is encoded again, and evicted least recently used beyond
+    ATTACHMENT_CACHE_MB.
+    """
+    global _attachment_parts_size
+
+    stat = os.stat(attachment)
+    key = (os.path.realpath(attachment), stat.st_size, stat.st_mtime_ns)
+
+    with _attachment_parts_lock:
+        part_bytes = _attachment_parts.get(key)
+        if part_bytes is not None:
+            _attachment_parts.move_to_end(key)
+            return part_bytes
+
+    with open(attachment, "rb") as my_attachment:
+        part = MIMEBase("application", "octet-stream")
+        part.set_payload(my_attachment.read())
+
+    # Encode file in ASCII characters to send by email
+    encoders.encode_base64(part)
+
+    # header wants just the filename sans path, so extract that
+    filename = attachment.split("/")[::-1][0]
+
+    # Add header as key/value pair to attachment part
+    part.add_header(
+        "Content-Disposition",
+        f'attachment; filename= "{filename}"',
+    )
+
+    part_buffer = _RawMessageBuffer()
+    BytesGenerator(part_buffer, mangle_from_=False).flatten(part)
+    part_bytes = bytes(part_buffer.data)
+
+    max_cache_size = int(os.environ.get("ATTACHMENT_CACHE_MB", 256)) * 1024 * 1024
+    with _attachment_parts_lock:
+        if key not in _attachment_parts:
+            _attachment_parts[key] = part_bytes
+            _attachment_parts_size += len(part_bytes)
+        while _attachment_parts_size > max_cache_size and len(_attachment_parts) > 1:
+            _, evicted = _attachment_parts.popitem(last=False)
+            _attachment_parts_size -= len(evicted)
+
+    return part_bytes
+
+
+class _RawMessageBuffer:
+    # BytesGenerator target. SES accepts the bytearray as is, so the flattened message
+    # is held in memory exactly once
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, chunk):
+        self.data += chunk
+
+
 def send_email(
     sender, recipient, cc=None, bcc=None, subject=None, body_text=None, attachments=None
 ):
-    ses_client = boto3.client("ses", region_name="ca-central-1")
+    ses_client = aws_sessions.get_client("ses", region_name="ca-central-1")
 
     if attachments is None:
         attachments = []
@@ -159,27 +216,21 @@ def send_email(
     body = MIMEText(body_text, "html")
     msg.attach(body)
 
+    # Flatten the headers and body, then splice the already encoded attachment parts in
+    # before the closing delimiter, exactly where the generator would have written them.
+    # Base64 never contains "-", so the generated boundary can't clash with them
+    raw_message = _RawMessageBuffer()
+    BytesGenerator(raw_message, mangle_from_=False).flatten(msg)
+
     if attachments:
+        boundary = msg.get_boundary().encode("ascii")
+        closing_delimiter = b"\n--" + boundary + b"--\n"
+        del raw_message.data[-len(closing_delimiter):]
         for attachment in attachments:
-            with open(attachment, "rb") as my_attachment:
-                part = MIMEBase("application", "octet-stream")
-                part.set_payload(my_attachment.read())
-
-            # Encode file in ASCII characters to send by email
-            encoders.encode_base64(part)
-
-            # header wants just the filename sans path, so extract that
-            filename = attachment.split("/")[::-1][0]
-
-            # Add header as key/value pair to attachment part
-            part.add_header(
-                "Content-Disposition",
-                f'attachment; filename= "{filename}"',
-            )
-
-            msg.attach(part)
+            raw_message.write(b"\n--" + boundary + b"\n")
+            raw_message.write(attachment_part(attachment))
+        raw_message.write(closing_delimiter)
 
-    # Convert message to string and send
     return ses_client.send_raw_email(
-        Source=sender, Destinations=destinations, RawMessage={"Data": msg.as_string()}
+        Source=sender, Destinations=destinations, RawMessage={"Data": raw_message.data}
     )
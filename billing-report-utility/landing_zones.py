@@ -0,0 +1,125 @@
+import json
+import logging
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+handler = logging.StreamHandler(sys.stdout)
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+
+# settings a landing zone can set for itself; everything else (report type, dates,
+# delivery, GROUP_TYPE...) is shared by every landing zone in the run
+landing_zone_settings = {
+    "ATHENA_QUERY_ROLE_TO_ASSUME_ARN",
+    "ATHENA_QUERY_OUTPUT_BUCKET",
+    "ATHENA_QUERY_DATABASE",
+    "CMK_SSE_KMS_ALIAS",
+    "QUERY_ORG_ACCOUNTS_ROLE_TO_ASSUME_ARN",
+    "ORG_ACCOUNTS_FILE",
+    "QUERY_BACKEND",
+    "LOCAL_CUR_PATH",
+    "LOCAL_CUR_FORMAT",
+    "QR_S3_Bucket",
+    "REPORTS_S3_BUCKET",
+    "AGGREGATE_STORE",
+}
+
+
+def load_landing_zones():
+    """
+    LANDING_ZONES is a JSON object, or the path of a file holding one, mapping each
+    landing zone's name to its settings, e.g.
+    {"lz1": {"ATHENA_QUERY_ROLE_TO_ASSUME_ARN": "...", ...}, "lz2": {...}}.
+    Returns None when it is not set.
+    """
+    value = os.environ.get("LANDING_ZONES")
+    if not value:
+        return None
+
+    if os.path.isfile(value):
+        with open(value) as f:
+            landing_zones = json.load(f)
+    else:
+        landing_zones = json.loads(value)
+
+    for name, settings in landing_zones.items():
+        unknown_settings = set(settings) - landing_zone_settings
+        if unknown_settings:
+            logger.warning(
+                f"Ignoring settings {sorted(unknown_settings)} for landing zone '{name}'; they apply to the whole run"
+            )
+    return landing_zones
+
+
+def settings_for(name, landing_zone):
+    settings = dict(os.environ)
+    # a shared aggregate store keeps each landing zone under its own prefix, as billing
+    # groups such as "SEA Core" exist in every landing zone
+    if settings.get("AGGREGATE_STORE"):
+        settings["AGGREGATE_STORE"] = f"{settings['AGGREGATE_STORE'].rstrip('/')}/{name}"
+    settings.update(
+        {key: value for key, value in landing_zone.items() if key in landing_zone_settings}
+    )
+    return settings
+
+
+def run(query_parameters, landing_zones):
+    """
+    Runs the report for several landing zones in this process. Each landing zone gets
+    its own BillingManager, settings and output directory (output/<name>), and their
+    queries, Organizations calls and processing run concurrently, at most
+    MAX_CONCURRENT_LANDING_ZONES at a time. The exchange rates and the report template
+    are loaded once and shared. Writes a workbook with every landing zone's billing
+    group totals, and raises once all of them have finished if any failed.
+    """
+    # BillingManager and summarize_charges pull in boto3, pandas... see billing.run_report
+    from BillingManager import BillingManager
+    import summarize_charges
+
+    start_date = query_parameters["start_date"]
+    end_date = query_parameters["end_date"]
+
+    # fetched once here, then served from the process-wide cache to every landing zone
+    summarize_charges.prefetch_exchange_rates(start_date, end_date)
+    summarize_charges.report_template()
+
+    def run_landing_zone(name):
+        logger.info(f"Running report for landing zone '{name}'")
+        bill_manager = BillingManager(
+            dict(query_parameters), settings_for(name, landing_zones[name]), landing_zone=name
+        )
+        return bill_manager.do()
+
+    max_workers = int(os.environ.get("MAX_CONCURRENT_LANDING_ZONES", len(landing_zones)))
+    with ThreadPoolExecutor(max_workers=max(max_workers, 1)) as executor:
+        futures = {name: executor.submit(run_landing_zone, name) for name in landing_zones}
+
+    totals_by_landing_zone = {}
+    failed = []
+    for name, future in futures.items():
+        try:
+            totals_by_landing_zone[name] = future.result()
+        except Exception:
+            logger.exception(f"Report failed for landing zone '{name}'")
+            failed.append(name)
+
+    if totals_by_landing_zone:
+        current_dir = os.path.dirname(os.path.realpath(__file__))
+        summary_dir = f"{current_dir}/output/landing_zones"
+        Path(summary_dir).mkdir(parents=True, exist_ok=True)
+        format_string = "%Y-%m-%d"
+        summary_file = (
+            f"{summary_dir}/landing_zones-{start_date.strftime(format_string)}-{end_date.strftime(format_string)}.xlsx"
+        )
+        summarize_charges.create_landing_zone_summary_excel(totals_by_landing_zone, summary_file)
+        logger.info(f"Landing zone summary stored at '{summary_file}'")
+
+    if failed:
+        raise Exception(f"Reports failed for landing zones {failed}")
+
+    return totals_by_landing_zone
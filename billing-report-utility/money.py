@@ -0,0 +1,27 @@
+import numpy as np
+
+# Money columns (line_item_blended_cost, CAD) are held as int64 micro-dollars from the moment
+# they are parsed. Integer addition is associative, so totals are identical whatever the
+# summation order (chunked, parallel or split queries); values are only converted back to
+# dollars for display.
+MICROS_PER_DOLLAR = 1_000_000
+
+
+def to_micros(dollars):
+    # round half to even, same as DuckDB's round_even (see duckdb_aggregation)
+    return np.rint(dollars.fillna(0).astype("float64") * MICROS_PER_DOLLAR).astype("int64")
+
+
+def convert_micros(micros, exchange_rate):
+    # one vectorized conversion per column; each row is rounded to the micro-dollar once.
+    # exchange_rate is a single rate or one rate per row
+    return np.rint(micros.astype("float64") * np.asarray(exchange_rate, dtype="float64")).astype("int64")
+
+
+def to_dollars(micros):
+    return micros / MICROS_PER_DOLLAR
+
+
+def total_in_dollars(micros):
+    # totals shown to people (email subjects, quarterly workbook) are whole cents
+    return round(int(micros) / MICROS_PER_DOLLAR, 2)
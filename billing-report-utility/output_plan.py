@@ -0,0 +1,33 @@
+# Artifacts a run can produce, and the artifacts each of them is computed from.
+artifact_dependencies = {
+    "all_workbook": (),  # charges-<dates>-ALL.xlsx
+    "group_workbooks": (),  # charges-<dates>-<group>.xlsx
+    "group_reports": ("group_totals",),  # <dates>-<group>.html, delivered with each group's total
+    "group_totals": (),  # CAD total per billing group
+    "quarterly_workbook": ("group_totals",),  # quarterly_report-<dates>.xlsx
+}
+
+# What each report type needs to deliver. Weekly, monthly and manual runs send every
+# billing group its workbook and report; quarterly runs only send the quarterly workbook.
+output_plans = {
+    "quarterly": ("quarterly_workbook",),
+    "default": ("all_workbook", "group_workbooks", "group_reports"),
+}
+
+# artifacts produced once per billing group (and so worth fanning out to workers)
+per_group_artifacts = {"group_workbooks", "group_reports"}
+
+
+def resolve(report_type):
+    """
+    Returns the set of artifacts a run of `report_type` has to compute: the plan's
+    targets and everything they depend on.
+    """
+    pending = list(output_plans.get(report_type, output_plans["default"]))
+    resolved = set()
+    while pending:
+        artifact = pending.pop()
+        if artifact not in resolved:
+            resolved.add(artifact)
+            pending.extend(artifact_dependencies[artifact])
+    return resolved
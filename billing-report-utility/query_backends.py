@@ -0,0 +1,377 @@
+import glob
+import json
+import logging
+import math
+import os
+import shutil
+import sys
+import time
+import uuid
+from datetime import datetime
+
+from botocore.exceptions import ClientError
+from retrying import retry
+
+import aws_sessions
+from s3_download import (
+    DownloadIntegrityError,
+    count_csv_rows,
+    download_object,
+    open_object_stream,
+    split_s3_uri,
+    verify_row_count,
+)
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+handler = logging.StreamHandler(sys.stdout)
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+
+
+class AthenaQueryBackend:
+    """
+    Runs queries on Amazon Athena. Results are written by Athena to the output bucket
+    and fetched from S3.
+    """
+
+    def __init__(self, settings=None):
+        # settings default to the environment; LANDING_ZONES runs pass each landing
+        # zone's own (see landing_zones)
+        settings = os.environ if settings is None else settings
+        self.athena_query_role_to_assume = settings["ATHENA_QUERY_ROLE_TO_ASSUME_ARN"]
+        self.athena_query_output_bucket_name = settings["ATHENA_QUERY_OUTPUT_BUCKET"]
+        self.athena_query_database = settings["ATHENA_QUERY_DATABASE"]
+        self.cmk_sse_kms_alias = settings["CMK_SSE_KMS_ALIAS"]
+
+        self.s3_output = "s3://" + self.athena_query_output_bucket_name + "/cur/"
+
+        if os.environ["AWS_DEFAULT_REGION"]:
+            self.aws_default_region = os.environ["AWS_DEFAULT_REGION"]
+        else:
+            self.aws_default_region = "ca-central-1"
+
+        self.role_session_name = "AthenaQuery"
+
+        # shared client from the session pool; the assumed role is refreshed automatically
+        self.athena = aws_sessions.get_client(
+            "athena",
+            self.athena_query_role_to_assume,
+            self.role_session_name,
+            self.aws_default_region,
+        )
+
+        # S3 output location and statistics (bytes scanned, engine time...) reported by
+        # Athena for each query execution
+        self.output_locations = {}
+        self.statistics = {}
+
+    @retry(
+        stop_max_attempt_number=10,
+        wait_exponential_multiplier=300,
+        wait_exponential_max=1 * 60 * 1000,
+    )
+    def __poll_status(self, _id):
+        result = self.athena.get_query_execution(QueryExecutionId=_id)
+        state = result["QueryExecution"]["Status"]["State"]
+
+        logging.debug(
+            f"execution_id={_id}, state={state}, time={datetime.now().time()}"
+        )
+
+        if state == "SUCCEEDED" or state == "FAILED":
+            return
+        else:
+            raise Exception
+
+    def __start_query(self, query):
+        logger.info(f"Query output location: {self.s3_output}")
+        response = self.athena.start_query_execution(
+            QueryString=query,
+            QueryExecutionContext={"Database": self.athena_query_database},
+            ResultConfiguration={
+                "OutputLocation": self.s3_output,
+                "EncryptionConfiguration": {
+                    "EncryptionOption": "SSE_KMS",
+                    "KmsKey": self.cmk_sse_kms_alias,
+                },
+            },
+        )
+        return response["QueryExecutionId"]
+
+    def run_query(self, query):
+        athena = self.athena
+
+        try:
+            query_execution_id = self.__start_query(query)
+        except ClientError as err:
+            logger.error(f"Start query error: {err}")
+            return err
+
+        # block until the query execution completes
+        self.__poll_status(query_execution_id)
+
+        # check the result
+        query_execution = athena.get_query_execution(QueryExecutionId=query_execution_id)[
+            "QueryExecution"
+        ]
+        result = query_execution["Status"]["State"]
+
+        if result == "SUCCEEDED":
+            logging.info(f"Query SUCCEEDED: {query_execution_id}")
+
+            self.output_locations[query_execution_id] = query_execution[
+                "ResultConfiguration"
+            ]["OutputLocation"]
+            self.statistics[query_execution_id] = query_execution.get("Statistics", {})
+
+            return query_execution_id
+        else:
+            raise Exception
+
+    def estimate_scan_bytes(self, query):
+        """
+        Pre-flight estimate of the bytes `query` would read, from the planner's IO
+        estimates (EXPLAIN (TYPE IO), which plans the query without reading table data).
+        Returns None when the planner has no estimate, e.g. tables without statistics.
+
+        The bytes read are the sum over the table scans in inputTableColumnInfos, after
+        partition pruning; the plan's top level estimate is the size of the query's
+        output, after filtering and projection, and says little about the scan.
+        """
+        query_execution_id = self.__start_query(f"EXPLAIN (TYPE IO, FORMAT JSON) {query}")
+        self.__poll_status(query_execution_id)
+
+        rows = self.athena.get_query_results(QueryExecutionId=query_execution_id)["ResultSet"]["Rows"]
+        plan_text = "\n".join(
+            data.get("VarCharValue", "") for row in rows for data in row["Data"]
+        )
+        try:
+            plan = json.loads(plan_text[plan_text.index("{"):])
+            estimates = [
+                float(table_scan["estimate"]["outputSizeInBytes"])
+                for table_scan in plan["inputTableColumnInfos"]
+            ]
+        except (ValueError, KeyError, TypeError):
+            logger.warning(f"Could not read a scan estimate from the query plan: {plan_text[:500]}")
+            return None
+
+        if not estimates or any(math.isnan(estimate) for estimate in estimates):
+            return None
+        return int(sum(estimates))
+
+    def s3_client(self):
+        # reuses the credentials the queries were run with; S3_ENDPOINT_URL allows pointing
+        # the download at a local S3 stand-in (e.g. moto server)
+        return aws_sessions.get_client(
+            "s3",
+            self.athena_query_role_to_assume,
+            self.role_session_name,
+            self.aws_default_region,
+            os.environ.get("S3_ENDPOINT_URL"),
+        )
+
+    def output_location(self, query_execution_id):
+        return self.output_locations.get(
+            query_execution_id, f"{self.s3_output}{query_execution_id}.csv"
+        )
+
+    def run_queries(self, queries):
+        """
+        Runs several queries, keeping at most ATHENA_MAX_CONCURRENT_QUERIES of them in
+        flight and polling all running executions with a single batch call. Returns the
+        execution ids in the same order as `queries`.
+        """
+        max_concurrent = int(os.environ.get("ATHENA_MAX_CONCURRENT_QUERIES", 5))
+        pending = list(enumerate(queries))
+        running = {}
+        query_execution_ids = [None] * len(queries)
+        poll_interval = 1
+
+        while pending or running:
+            while pending and len(running) < max_concurrent:
+                index, query = pending.pop(0)
+                query_execution_id = self.__start_query(query)
+                running[query_execution_id] = index
+                query_execution_ids[index] = query_execution_id
+
+            time.sleep(poll_interval)
+            poll_interval = min(poll_interval * 2, 30)
+
+            executions = self.athena.batch_get_query_execution(
+                QueryExecutionIds=list(running)
+            )["QueryExecutions"]
+            for execution in executions:
+                query_execution_id = execution["QueryExecutionId"]
+                state = execution["Status"]["State"]
+
+                logging.debug(
+                    f"execution_id={query_execution_id}, state={state}, time={datetime.now().time()}"
+                )
+
+                if state == "SUCCEEDED":
+                    logging.info(f"Query SUCCEEDED: {query_execution_id}")
+                    self.output_locations[query_execution_id] = execution[
+                        "ResultConfiguration"
+                    ]["OutputLocation"]
+                    self.statistics[query_execution_id] = execution.get("Statistics", {})
+                    del running[query_execution_id]
+                elif state in ("FAILED", "CANCELLED"):
+                    reason = execution["Status"].get("StateChangeReason")
+                    raise Exception(f"Query {query_execution_id} {state}: {reason}")
+
+        return query_execution_ids
+
+    def result_row_count(self, query_execution_id, s3_client, bucket, key):
+        """
+        What Athena itself recorded about the result, to check the object against: the
+        .metadata file it writes next to the CSV once the result is complete, and the
+        number of rows it output (query runtime statistics). Returns that row count, or
+        None when Athena has no statistics for the query.
+        """
+        try:
+            s3_client.head_object(Bucket=bucket, Key=f"{key}.metadata")
+        except ClientError as err:
+            raise DownloadIntegrityError(
+                f"No result metadata next to s3://{bucket}/{key}; the result may be incomplete"
+            ) from err
+
+        try:
+            statistics = self.athena.get_query_runtime_statistics(QueryExecutionId=query_execution_id)
+        except ClientError as err:
+            logger.warning(f"No runtime statistics for query {query_execution_id}, row count not checked: {err}")
+            return None
+        return statistics["QueryRuntimeStatistics"].get("Rows", {}).get("OutputRows")
+
+    def download_results(self, query_execution_id, local_path):
+        # verify against the output location Athena reported for this execution
+        bucket, key = split_s3_uri(self.output_location(query_execution_id))
+        s3_client = self.s3_client()
+        expected_rows = self.result_row_count(query_execution_id, s3_client, bucket, key)
+        download_object(s3_client, bucket, key, local_path)
+        verify_row_count(count_csv_rows(local_path), expected_rows, f"s3://{bucket}/{key}")
+
+    def open_results_stream(self, query_execution_id, tee_path=None):
+        bucket, key = split_s3_uri(self.output_location(query_execution_id))
+        s3_client = self.s3_client()
+        expected_rows = self.result_row_count(query_execution_id, s3_client, bucket, key)
+        return open_object_stream(s3_client, bucket, key, tee_path, expected_rows)
+
+
+# file patterns of each local CUR format, searched recursively in a LOCAL_CUR_PATH directory
+local_cur_patterns = {
+    "parquet": ["*.parquet"],
+    "csv": ["*.csv", "*.csv.gz"],
+}
+
+
+def local_cur_files(cur_path, cur_format=None):
+    """
+    Resolves LOCAL_CUR_PATH to its format and the DuckDB path pattern(s) to read. A file
+    or glob is recognised by its extension. A directory is searched for Parquet files,
+    then CSV (optionally gzipped) ones, unless LOCAL_CUR_FORMAT says which to read.
+    """
+    if not os.path.isdir(cur_path):
+        name = cur_path.lower()
+        if cur_format is None:
+            cur_format = "csv" if name.endswith((".csv", ".csv.gz")) else "parquet"
+        return cur_format, [cur_path]
+
+    formats = [cur_format] if cur_format else list(local_cur_patterns)
+    for candidate in formats:
+        patterns = [
+            os.path.join(cur_path, "**", pattern)
+            for pattern in local_cur_patterns[candidate]
+            if glob.glob(os.path.join(cur_path, "**", pattern), recursive=True)
+        ]
+        if patterns:
+            return candidate, patterns
+
+    raise FileNotFoundError(
+        f"No {' or '.join(formats)} CUR files found under LOCAL_CUR_PATH '{cur_path}'"
+    )
+
+
+class LocalQueryBackend:
+    """
+    Runs the same SQL against Cost and Usage Report exports on disk with DuckDB, for
+    offline reruns, tests and experiments. LOCAL_CUR_PATH is a file, directory or glob
+    of Parquet (e.g. the year=/month= partitioned Athena CUR layout) or CSV files with
+    the Athena column names. Each query writes a CSV shaped like Athena's output.
+    """
+
+    def __init__(self, settings=None):
+        import duckdb
+
+        settings = os.environ if settings is None else settings
+        cur_path = settings["LOCAL_CUR_PATH"]
+        # LOCAL_CUR_FORMAT=parquet|csv, for directories holding both
+        cur_format = settings.get("LOCAL_CUR_FORMAT", "").lower() or None
+        if cur_format not in (None, *local_cur_patterns):
+            raise ValueError(f"LOCAL_CUR_FORMAT must be one of {sorted(local_cur_patterns)}")
+        cur_format, cur_files = local_cur_files(cur_path, cur_format)
+
+        current_dir = os.path.dirname(os.path.realpath(__file__))
+        self.results_dir = os.environ.get(
+            "LOCAL_QUERY_RESULTS_DIR", f"{current_dir}/output/local_query_results"
+        )
+        os.makedirs(self.results_dir, exist_ok=True)
+
+        paths = "[" + ", ".join("'" + path.replace("'", "''") + "'" for path in cur_files) + "]"
+        if cur_format == "csv":
+            source = (
+                f"read_csv({paths}, header=true, hive_partitioning=true, union_by_name=true, "
+                f"types={{'line_item_usage_account_id': 'VARCHAR'}})"
+            )
+        else:
+            source = f"read_parquet({paths}, hive_partitioning=true, union_by_name=true)"
+
+        self.statistics = {}
+
+        self.con = duckdb.connect()
+        self.con.execute(f"CREATE VIEW cost_and_usage_report AS SELECT * FROM {source}")
+        # Athena (Trino) function used by the generated SQL
+        self.con.execute("CREATE MACRO From_iso8601_timestamp(s) AS CAST(s AS TIMESTAMP)")
+
+        logger.info(f"Querying local {cur_format} CUR files at '{cur_path}'")
+
+    def results_path(self, query_execution_id):
+        return f"{self.results_dir}/{query_execution_id}.csv"
+
+    def run_query(self, query):
+        query_execution_id = f"local-{uuid.uuid4()}"
+        results_path = self.results_path(query_execution_id).replace("'", "''")
+
+        start = time.perf_counter()
+        self.con.execute(f"COPY ({query}) TO '{results_path}' (HEADER, DELIMITER ',')")
+        # same keys as Athena's statistics; nothing is billed for local files
+        self.statistics[query_execution_id] = {
+            "DataScannedInBytes": 0,
+            "EngineExecutionTimeInMillis": int((time.perf_counter() - start) * 1000),
+        }
+
+        logger.info(f"Query SUCCEEDED: {query_execution_id}")
+        return query_execution_id
+
+    def estimate_scan_bytes(self, query):
+        # local files cost nothing to scan, so there is no budget to check
+        return None
+
+    def run_queries(self, queries):
+        # DuckDB already parallelises each query across all cores
+        return [self.run_query(query) for query in queries]
+
+    def download_results(self, query_execution_id, local_path):
+        shutil.copyfile(self.results_path(query_execution_id), local_path)
+
+    def open_results_stream(self, query_execution_id, tee_path=None):
+        if tee_path:
+            shutil.copyfile(self.results_path(query_execution_id), tee_path)
+        return open(self.results_path(query_execution_id), "rb")
+
+
+query_backends = {
+    "athena": AthenaQueryBackend,
+    "local": LocalQueryBackend,
+}
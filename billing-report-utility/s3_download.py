@@ -0,0 +1,243 @@
+import io
+import logging
+import os
+import queue
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+handler = logging.StreamHandler(sys.stdout)
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+
+default_part_size_mb = 64
+default_max_workers = 8
+default_stream_chunk_size = 1024 * 1024
+default_stream_prefetch_chunks = 16
+
+
+class DownloadIntegrityError(Exception):
+    pass
+
+
+def split_s3_uri(s3_uri):
+    parsed = urlparse(s3_uri)
+    return parsed.netloc, parsed.path.lstrip("/")
+
+
+def download_settings():
+    part_size = int(os.environ.get("DOWNLOAD_PART_SIZE_MB", default_part_size_mb)) * 1024 * 1024
+    max_workers = int(os.environ.get("DOWNLOAD_THREADS", default_max_workers))
+    return part_size, max_workers
+
+
+def download_object(s3_client, bucket, key, local_path, part_size=None, max_workers=None):
+    """
+    Downloads an S3 object using concurrent ranged GETs written straight into their
+    offset in `local_path`.
+
+    Every range is requested with `IfMatch` set to the ETag returned by the initial
+    HEAD, so a result file that is rewritten mid download fails loudly instead of
+    producing a file stitched together from two different objects. Once all parts are
+    written the local size is checked against the size S3 reported for the object.
+    """
+    default_part_size, default_workers = download_settings()
+    part_size = part_size or default_part_size
+    max_workers = max_workers or default_workers
+
+    head = s3_client.head_object(Bucket=bucket, Key=key)
+    expected_size = head["ContentLength"]
+    etag = head["ETag"]
+
+    logger.info(
+        f"Downloading s3://{bucket}/{key} ({expected_size} bytes) in {part_size} byte parts using {max_workers} threads"
+    )
+
+    # pre-size the file so each worker can write its range independently
+    with open(local_path, "wb") as f:
+        f.truncate(expected_size)
+
+    def download_part(offset):
+        end = min(offset + part_size, expected_size) - 1
+        response = s3_client.get_object(
+            Bucket=bucket, Key=key, Range=f"bytes={offset}-{end}", IfMatch=etag
+        )
+        body = response["Body"]
+        written = 0
+        with open(local_path, "r+b") as f:
+            f.seek(offset)
+            for chunk in iter(lambda: body.read(1024 * 1024), b""):
+                f.write(chunk)
+                written += len(chunk)
+        if written != end - offset + 1:
+            raise DownloadIntegrityError(
+                f"Range {offset}-{end} of s3://{bucket}/{key} returned {written} bytes"
+            )
+        return written
+
+    offsets = range(0, expected_size, part_size)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        downloaded = sum(executor.map(download_part, offsets))
+
+    local_size = os.path.getsize(local_path)
+    if downloaded != expected_size or local_size != expected_size:
+        raise DownloadIntegrityError(
+            f"Downloaded {downloaded} bytes ({local_size} on disk) for s3://{bucket}/{key}, expected {expected_size}"
+        )
+
+    logger.info(f"Verified {local_size} bytes for s3://{bucket}/{key} (ETag {etag})")
+
+    return head
+
+
+def count_csv_rows(path):
+    """
+    Data rows (header excluded) in an Athena CSV result. Counts line breaks, which is
+    exact for the usage charges query: none of its columns can contain one.
+    """
+    line_breaks = 0
+    last_chunk = b""
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(default_stream_chunk_size), b""):
+            line_breaks += chunk.count(b"\n")
+            last_chunk = chunk
+    # Athena terminates every line, the last one included
+    lines = line_breaks if last_chunk.endswith(b"\n") or not last_chunk else line_breaks + 1
+    return max(lines - 1, 0)
+
+
+def verify_row_count(rows, expected_rows, description):
+    # expected_rows comes from Athena (see AthenaQueryBackend.result_row_count), not from
+    # the object itself, so a result object that was cut short fails here
+    if expected_rows is None:
+        return
+    if rows != expected_rows:
+        raise DownloadIntegrityError(
+            f"{description} holds {rows} rows, Athena reported {expected_rows}"
+        )
+    logger.info(f"Verified {rows} rows for {description} against Athena's runtime statistics")
+
+
+class PrefetchingStream(io.RawIOBase):
+    """
+    Raw stream over an S3 object body that reads ahead on a background thread, so the
+    network transfer keeps going while the consumer (e.g. the CSV parser) is busy with
+    the previous chunk. Optionally tees every chunk to `tee_path` for auditing.
+
+    Closing the stream before it is fully consumed (the parser raised, or the caller
+    stopped early) stops the read-ahead thread and releases the S3 body.
+
+    With `expected_rows` the CSV rows streamed are checked against it at the end, like
+    count_csv_rows does for downloaded files.
+    """
+
+    def __init__(self, body, expected_size, description, tee_path=None, expected_rows=None):
+        self.body = body
+        self.expected_size = expected_size
+        self.expected_rows = expected_rows
+        self.line_breaks = 0
+        self.ends_with_line_break = True
+        self.description = description
+        self.tee_path = tee_path
+        self.chunks = queue.Queue(maxsize=default_stream_prefetch_chunks)
+        self.buffer = b""
+        self.bytes_received = 0
+        self.finished = False
+        self.stopped = threading.Event()
+        self.reader = threading.Thread(target=self.__prefetch, daemon=True)
+        self.reader.start()
+
+    def __put(self, item):
+        # waits for room in the queue, unless the consumer has gone away
+        while not self.stopped.is_set():
+            try:
+                self.chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def __prefetch(self):
+        tee_file = open(self.tee_path, "wb") if self.tee_path else None
+        complete = False
+        try:
+            for chunk in iter(lambda: self.body.read(default_stream_chunk_size), b""):
+                if tee_file:
+                    tee_file.write(chunk)
+                if not self.__put(chunk):
+                    break
+            else:
+                complete = True
+                self.__put(None)
+        except Exception as err:
+            self.__put(err)
+        finally:
+            if tee_file:
+                tee_file.close()
+                # a copy of part of the object is no use to anyone
+                if not complete:
+                    os.remove(self.tee_path)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.buffer and not self.finished:
+            chunk = self.chunks.get()
+            if isinstance(chunk, Exception):
+                raise chunk
+            if chunk is None:
+                self.finished = True
+                # make sure the tee file is flushed and closed before reporting EOF
+                self.reader.join()
+                if self.bytes_received != self.expected_size:
+                    raise DownloadIntegrityError(
+                        f"Streamed {self.bytes_received} bytes for {self.description}, expected {self.expected_size}"
+                    )
+                logger.info(f"Verified {self.bytes_received} bytes streamed for {self.description}")
+                lines = self.line_breaks + (0 if self.ends_with_line_break else 1)
+                verify_row_count(max(lines - 1, 0), self.expected_rows, self.description)
+            else:
+                self.buffer = memoryview(chunk)
+                self.bytes_received += len(chunk)
+                if self.expected_rows is not None:
+                    self.line_breaks += chunk.count(b"\n")
+                    self.ends_with_line_break = chunk.endswith(b"\n")
+
+        size = min(len(b), len(self.buffer))
+        b[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return size
+
+    def close(self):
+        if not self.closed:
+            self.stopped.set()
+            if not self.finished:
+                # unblocks a read in progress on the reader thread
+                self.body.close()
+            self.reader.join()
+            self.buffer = b""
+        super().close()
+
+
+def open_object_stream(s3_client, bucket, key, tee_path=None, expected_rows=None):
+    """
+    Returns a buffered binary stream over an S3 object suitable for passing straight
+    to pd.read_csv. The size (and row count) checks happen when the stream is fully
+    consumed.
+    """
+    response = s3_client.get_object(Bucket=bucket, Key=key)
+
+    logger.info(
+        f"Streaming s3://{bucket}/{key} ({response['ContentLength']} bytes)"
+        + (f", saving a copy to '{tee_path}'" if tee_path else "")
+    )
+
+    raw = PrefetchingStream(
+        response["Body"], response["ContentLength"], f"s3://{bucket}/{key}", tee_path, expected_rows
+    )
+    return io.BufferedReader(raw, buffer_size=default_stream_chunk_size)
@@ -0,0 +1,340 @@
+import argparse
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+import urllib.request
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+handler = logging.StreamHandler(sys.stdout)
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+
+# report types a request can ask for; quarterly requests only build the quarterly workbook
+report_types = {"manual", "weekly", "monthly", "quarterly"}
+
+# finished requests kept for GET /reports/<id>
+max_finished_requests = 200
+
+
+class TimedCache:
+    """
+    Values computed on demand and kept for `ttl_seconds`. Concurrent requests for the
+    same missing key wait for a single computation.
+    """
+
+    def __init__(self, ttl_seconds):
+        self.ttl_seconds = ttl_seconds
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.key_locks = {}
+
+    def get(self, key, compute):
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            with self.lock:
+                entry = self.entries.get(key)
+            if entry and time.monotonic() - entry[0] < self.ttl_seconds:
+                return entry[1]
+            value = compute()
+            with self.lock:
+                self.entries[key] = (time.monotonic(), value)
+            return value
+
+    def peek(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry and time.monotonic() - entry[0] < self.ttl_seconds:
+            return entry[1]
+        return None
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic(), value)
+
+
+class ReportService:
+    """
+    Runs report requests from a bounded queue on a fixed number of threads, in a
+    process that keeps everything a run needs warm between requests:
+
+    - pandas, boto3 and the rest are imported once;
+    - assumed role sessions and clients stay in the aws_sessions pool;
+    - the report and email templates and the FX rates stay in their process-wide caches;
+    - org account metadata is kept for SERVICE_ORG_ACCOUNTS_TTL_SECONDS;
+    - the query results of a window are reused for SERVICE_QUERY_RESULTS_TTL_SECONDS,
+      so repeated requests for it skip Athena (and the load, see charges_cache).
+    """
+
+    def __init__(self):
+        from BillingManager import BillingManager
+        import summarize_charges
+
+        self.billing_manager_class = BillingManager
+        self.summarize_charges = summarize_charges
+
+        self.concurrency = int(os.environ.get("SERVICE_CONCURRENCY", 2))
+        self.requests = queue.Queue(maxsize=int(os.environ.get("SERVICE_QUEUE_SIZE", 20)))
+        self.org_accounts = TimedCache(int(os.environ.get("SERVICE_ORG_ACCOUNTS_TTL_SECONDS", 3600)))
+        self.query_results = TimedCache(int(os.environ.get("SERVICE_QUERY_RESULTS_TTL_SECONDS", 3600)))
+
+        self.status_lock = threading.Lock()
+        self.statuses = OrderedDict()
+
+        # compiled before the first request
+        summarize_charges.report_template()
+
+        for index in range(self.concurrency):
+            threading.Thread(target=self.__work, name=f"report-worker-{index}", daemon=True).start()
+
+    def load_org_accounts(self, settings):
+        # the loader handed to BillingManager; the cached list is shared, never modified
+        from helpers import query_org_accounts
+
+        key = (settings.get("QUERY_ORG_ACCOUNTS_ROLE_TO_ASSUME_ARN"), settings.get("ORG_ACCOUNTS_FILE"))
+        return list(self.org_accounts.get(key, lambda: query_org_accounts(settings)))
+
+    @staticmethod
+    def query_parameters(request):
+        """
+        Validates a request body and turns it into BillingManager query parameters, the
+        same as billing.manual() builds them from the environment.
+        """
+        if not isinstance(request, dict):
+            raise ValueError("the request body must be a JSON object")
+
+        for field in ("report_type", "start_date", "end_date", "recipient_override", "carbon_copy"):
+            if field in request and not isinstance(request[field], str):
+                raise ValueError(f"{field} must be a string")
+
+        # a JSON boolean only: bool("false") is True and would send the emails
+        deliver = request.get("deliver", False)
+        if not isinstance(deliver, bool):
+            raise ValueError("deliver must be true or false")
+
+        report_type = request.get("report_type", "manual").lower()
+        if report_type not in report_types:
+            raise ValueError(f"report_type must be one of {sorted(report_types)}")
+
+        start_date = datetime.combine(
+            datetime.strptime(request["start_date"], "%Y-%m-%d"), datetime.min.time()
+        )
+        end_date = datetime.combine(
+            datetime.strptime(request["end_date"], "%Y-%m-%d"), datetime.max.time()
+        )
+        if start_date > end_date:
+            raise ValueError("start_date is after end_date")
+
+        billing_groups = request.get("billing_groups") or None
+        if billing_groups is not None and not (
+            isinstance(billing_groups, list) and all(isinstance(group, str) for group in billing_groups)
+        ):
+            raise ValueError("billing_groups must be a list of names")
+
+        return {
+            "report_type": report_type,
+            "deliver": deliver,
+            "recipient_override": request.get("recipient_override", "").lower(),
+            "carbon_copy": request.get("carbon_copy", "").lower(),
+            "billing_groups": billing_groups,
+            "start_date": start_date,
+            "end_date": end_date,
+        }
+
+    def submit(self, request):
+        query_parameters = self.query_parameters(request)
+        request_id = str(uuid.uuid4())
+        self.__set_status(
+            request_id,
+            status="queued",
+            request=request,
+            submitted_at=datetime.now().isoformat(),
+        )
+        try:
+            self.requests.put_nowait((request_id, query_parameters))
+        except queue.Full:
+            self.__set_status(request_id, status="rejected", error="queue is full")
+            raise
+        logger.info(f"Queued report request {request_id}: {request}")
+        return request_id
+
+    def status(self, request_id):
+        with self.status_lock:
+            status = self.statuses.get(request_id)
+            return dict(status) if status else None
+
+    def __set_status(self, request_id, **fields):
+        with self.status_lock:
+            self.statuses.setdefault(request_id, {"id": request_id}).update(fields)
+            finished = [
+                key for key, status in self.statuses.items()
+                if status["status"] in ("succeeded", "failed", "rejected")
+            ]
+            for key in finished[:-max_finished_requests]:
+                del self.statuses[key]
+
+    def __work(self):
+        while True:
+            request_id, query_parameters = self.requests.get()
+            self.__set_status(request_id, status="running", started_at=datetime.now().isoformat())
+            try:
+                result = self.run(query_parameters)
+            except Exception as error:
+                logger.exception(f"Report request {request_id} failed")
+                self.__set_status(
+                    request_id, status="failed", error=str(error), finished_at=datetime.now().isoformat()
+                )
+            else:
+                self.__set_status(
+                    request_id, status="succeeded", finished_at=datetime.now().isoformat(), **result
+                )
+            finally:
+                self.requests.task_done()
+
+    def run(self, query_parameters):
+        # a new day may have published a new latest rate
+        self.summarize_charges.get_exchange_rate.cache_clear()
+
+        bill_manager = self.billing_manager_class(
+            dict(query_parameters), org_accounts_loader=self.load_org_accounts
+        )
+
+        # results of a full run can serve a targeted one for the same window
+        window = (query_parameters["start_date"], query_parameters["end_date"])
+        billing_groups = tuple(sorted(query_parameters["billing_groups"] or ()))
+        query_results_file = self.query_results.peek(window + (billing_groups,)) or self.query_results.peek(
+            window + ((),)
+        )
+        if query_results_file and not os.path.isfile(query_results_file):
+            query_results_file = None
+        if query_results_file:
+            logger.info(f"Reusing query results '{query_results_file}'")
+
+        billing_group_totals = bill_manager.do(query_results_file)
+
+        if bill_manager.query_results_file and not query_results_file:
+            self.query_results.put(window + (billing_groups,), bill_manager.query_results_file)
+
+        return {
+            "billing_group_totals": billing_group_totals,
+            "query_results_file": bill_manager.query_results_file,
+            "timings": {name: round(duration, 3) for name, duration in bill_manager.timer.durations.items()},
+        }
+
+
+class ReportRequestHandler(BaseHTTPRequestHandler):
+    """
+    POST /reports            {"start_date": "2024-01-01", "end_date": "2024-01-31",
+                              "billing_groups": [...], "deliver": false, ...}
+                             -> 202 {"id": ..., "status": "queued"}
+    GET  /reports/<id>       -> the request's status, totals and timings once finished
+    GET  /health             -> queue depth and worker count
+    """
+
+    service = None
+
+    def send_json(self, status_code, body):
+        data = json.dumps(body, default=str).encode("utf-8")
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/health":
+            return self.send_json(
+                200, {"queued": self.service.requests.qsize(), "workers": self.service.concurrency}
+            )
+        if self.path.startswith("/reports/"):
+            status = self.service.status(self.path[len("/reports/"):])
+            if status:
+                return self.send_json(200, status)
+        self.send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        if self.path != "/reports":
+            return self.send_json(404, {"error": "not found"})
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+            request_id = self.service.submit(request)
+        except queue.Full:
+            return self.send_json(503, {"error": "too many queued requests, try again later"})
+        except (ValueError, KeyError) as error:
+            return self.send_json(400, {"error": f"invalid request: {error}"})
+        self.send_json(202, {"id": request_id, "status": "queued"})
+
+    def log_message(self, format, *args):
+        logger.info(f"{self.address_string()} - {format % args}")
+
+
+def serve():
+    host = os.environ.get("SERVICE_HOST", "127.0.0.1")
+    port = int(os.environ.get("SERVICE_PORT", 8080))
+
+    ReportRequestHandler.service = ReportService()
+    server = ThreadingHTTPServer((host, port), ReportRequestHandler)
+    logger.info(f"Report service listening on http://{host}:{port}")
+    server.serve_forever()
+
+
+def request_report(args):
+    # CLI client: submits a request to a running service and waits for it to finish
+    base_url = f"http://{os.environ.get('SERVICE_HOST', '127.0.0.1')}:{os.environ.get('SERVICE_PORT', 8080)}"
+    body = {
+        "report_type": args.report_type,
+        "start_date": args.start_date,
+        "end_date": args.end_date,
+        "billing_groups": [group.strip() for group in args.billing_groups.split(",") if group.strip()],
+        "deliver": args.deliver,
+        "recipient_override": args.recipient_override,
+    }
+    submit = urllib.request.Request(
+        f"{base_url}/reports",
+        data=json.dumps(body).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+        method="POST",
+    )
+    with urllib.request.urlopen(submit) as response:
+        request_id = json.load(response)["id"]
+
+    while True:
+        with urllib.request.urlopen(f"{base_url}/reports/{request_id}") as response:
+            status = json.load(response)
+        if status["status"] not in ("queued", "running"):
+            print(json.dumps(status, indent=2))
+            return 0 if status["status"] == "succeeded" else 1
+        time.sleep(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Billing report service")
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("serve", help="run the report service")
+    request_parser = commands.add_parser("request", help="request a report from a running service")
+    request_parser.add_argument("start_date", help="YYYY-MM-DD")
+    request_parser.add_argument("end_date", help="YYYY-MM-DD")
+    request_parser.add_argument("--report-type", default="manual")
+    request_parser.add_argument("--billing-groups", default="", help="comma separated")
+    request_parser.add_argument("--deliver", action="store_true")
+    request_parser.add_argument("--recipient-override", default="")
+    args = parser.parse_args()
+
+    if args.command == "request":
+        sys.exit(request_report(args))
+    serve()
+
+
+if __name__ == "__main__":
+    main()
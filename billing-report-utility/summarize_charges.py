@@ -1,7 +1,9 @@
+import functools
 import logging
 import os
-import boto3
-from datetime import date
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
 import numpy as np
 import pandas as pd
 import requests
@@ -14,6 +16,12 @@ import json
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 from botocore.exceptions import ClientError
+from dateutil.relativedelta import relativedelta
+
+import artifact_cache
+import async_tasks
+import aws_sessions
+import money
 
 logger = logging.getLogger(__name__)
 
@@ -35,28 +43,149 @@ grouping_columns = [
 if os.environ.get("GROUP_TYPE") == "account_coding":
     grouping_columns.append("Account_Coding")
 
+# dataframe column -> account metadata field it is populated from
+account_metadata_columns = {
+    "Account_Coding": "account_coding",
+    "Billing_Group": "billing_group",
+    "Owner_Name": "admin_contact_name",
+    "Owner_Email": "admin_contact_email",
+    "Additional_Contacts": "additional_contacts",
+    "Project": "Project",
+    "Environment": "Environment",
+    "Account_Name": "name",
+    "License_Plate": "license_plate",
+}
+
+# int64 micro-dollars, see money.py
+value_columns = ["line_item_blended_cost", "CAD"]
+
+# key and value columns of the charges workbooks and HTML reports, which summarize the
+# same columns. Frames are projected onto these before any aggregation, so stray
+# metadata columns (Additional_Contacts...) are never summed and can't shift the layout
+# of the output, whichever frame a caller passes in
+summary_schema = (grouping_columns, value_columns)
+
+
+def project(df):
+    key_columns, summary_value_columns = summary_schema
+    return df[key_columns + summary_value_columns]
+
+
+# "pandas" or "duckdb"; see load_charges
+aggregation_engine = os.environ.get("AGGREGATION_ENGINE", "pandas").lower()
+
+template_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "templates")
+report_template_name = "report.html.jinja2"
+
+
+# compiled once per process and shared by every report (and landing zone) in the run
+@functools.lru_cache(maxsize=None)
+def report_template():
+    env = Environment(loader=FileSystemLoader(template_dir))
+    return (
+        env.get_template(report_template_name),
+        artifact_cache.hash_file(f"{template_dir}/{report_template_name}"),
+    )
+
+# bump whenever create_excel changes the layout of the workbook so cached artifacts are not reused
+excel_layout_version = "4"
+
+# rows per worksheet, header included; longer summaries continue on further sheets
+xlsx_max_rows = 1_048_576
+
+# machine readable copies of the "-ALL" summary (SUMMARY_EXPORT_FORMATS=parquet,csv)
+summary_export_formats = {
+    "parquet": "parquet",  # zstd compressed
+    "csv": "csv.gz",
+}
+
 
 def read_file_into_dataframe(local_file, accounts):
+    # local_file may be a path or a file-like object (e.g. a stream over the S3 result), or
+    # a list of them for results split across several queries
     conver_dict = {"line_item_usage_account_id": str}
     pd.set_option("display.float_format", "${:.2f}".format)
-    df = pd.read_csv(local_file, dtype=conver_dict)
+    if isinstance(local_file, (list, tuple)):
+        # parse the parts concurrently so every stream keeps downloading
+        with ThreadPoolExecutor(max_workers=len(local_file)) as executor:
+            parts = list(executor.map(lambda f: pd.read_csv(f, dtype=conver_dict), local_file))
+        df = pd.concat(parts, ignore_index=True)
+    else:
+        df = pd.read_csv(local_file, dtype=conver_dict)
 
     enhance_with_metadata(df, accounts)
 
     return df
 
 
+def group_charges(df):
+    # Collapses line items to one row per combination of grouping columns. Every artifact
+    # (workbooks, pivots, totals) is a further aggregation of this frame. Rows with empty
+    # keys are kept so that group totals still include them.
+    grouped = (
+        df.groupby(grouping_columns, dropna=False)[value_columns].sum().reset_index()
+    )
+    grouped.attrs = dict(df.attrs)
+    return grouped
+
+
+def load_charges(query_results, accounts, cache_path=None):
+    """
+    Returns the charges enhanced with account metadata and aggregated to the grouping
+    columns. With AGGREGATION_ENGINE=duckdb a results file on disk is aggregated by
+    DuckDB directly, without loading the line items into pandas. Streams (and the
+    default engine) go through pandas.
+
+    With `cache_path`, charges loaded from a results file are kept in an Arrow file there
+    and reused by later runs over the same file, account metadata and exchange rate.
+    """
+    # callers that already loaded the charges pass the dataframe through
+    if isinstance(query_results, pd.DataFrame):
+        return query_results
+
+    is_file = isinstance(query_results, (str, os.PathLike))
+    if cache_path and is_file:
+        import charges_cache
+
+        cache_key = charges_cache.fingerprint(
+            query_results, accounts, exchange_rate_source(), grouping_columns + value_columns
+        )
+        df = charges_cache.read(cache_path, cache_key)
+        # daily rates for recent dates can still be published after the cache was written
+        if df is not None and exchange_rates_unchanged(df.attrs.get("exchange_rate")):
+            return df
+
+    if aggregation_engine == "duckdb" and is_file:
+        import duckdb_aggregation
+
+        df = duckdb_aggregation.grouped_charges(
+            query_results,
+            accounts,
+            as_of_exchange_rates,
+            grouping_columns,
+            account_metadata_columns,
+            value_columns,
+        )
+    else:
+        df = group_charges(read_file_into_dataframe(query_results, accounts))
+
+    if cache_path and is_file:
+        charges_cache.write(cache_path, cache_key, df)
+
+    return df
+
+
+# cached so the rate fetched up front (concurrently with the Athena query) is the one
+# used for every conversion in the run
+@functools.lru_cache(maxsize=None)
 def get_exchange_rate():
+    # FX_RATE pins the rate, e.g. for offline runs or when the Bank of Canada API is down
+    if os.environ.get("FX_RATE"):
+        return float(os.environ["FX_RATE"])
+
     # usd_to_cad_rate= 1
-    AWS_REGION = "ca-central-1"
-    ssm_client = boto3.client("ssm", region_name=AWS_REGION)
     url = "https://www.bankofcanada.ca/valet/observations/FXUSDCAD?recent=1"
 
-    rc_channel = ssm_client.get_parameter(Name='/bcgov/billingutility/rocketchat_alert_webhook', WithDecryption=True)
-    rc_channel_url = rc_channel['Parameter']['Value']
-    teams_channel = ssm_client.get_parameter(Name='/bcgov/billingutility/teams_alert_webhook', WithDecryption=True)
-    teams_channel_url = teams_channel['Parameter']['Value']
-
     requests_session = requests.Session()
     retries = Retry(
         total=3,
@@ -72,63 +201,216 @@ def get_exchange_rate():
         response = requests_session.get(url)
         # print(response.text) # process response
     except Exception as error:
-        print(error)
-        attachment = [
+        alert_failure(error)
+    else:
+        data = response.json()
+        usd_to_cad_rate = float(data['observations'][0]['FXUSDCAD']['v'])
+        # print(usd_to_cad_rate)
+    return usd_to_cad_rate
+
+
+def alert_failure(error):
+    # posts the failure to the Rocket.Chat and Teams alert channels
+    print(error)
+    # the alert webhooks are only looked up when there is something to report
+    AWS_REGION = "ca-central-1"
+    ssm_client = aws_sessions.get_client("ssm", region_name=AWS_REGION)
+    rc_channel, teams_channel = async_tasks.run(
+        async_tasks.call("ssm", ssm_client.get_parameter, Name='/bcgov/billingutility/rocketchat_alert_webhook', WithDecryption=True),
+        async_tasks.call("ssm", ssm_client.get_parameter, Name='/bcgov/billingutility/teams_alert_webhook', WithDecryption=True),
+    )
+    rc_channel_url = rc_channel['Parameter']['Value']
+    teams_channel_url = teams_channel['Parameter']['Value']
+
+    attachment = [
+        {
+            "title": "Billing report utility failed",
+            "text": f"The error occured is {error}",
+            "color": "#764FA5",
+        }
+    ]
+    rocketChatMessage = {
+        "text": "Billing report utility failed with error",
+        "attachments": attachment,
+    }
+    teamsMessage = {
+        "type": "message",
+        "attachments": [
             {
-                "title": "Billing report utility failed",
-                "text": f"The error occured is {error}",
-                "color": "#764FA5",
+                "contentType": "application/vnd.microsoft.card.adaptive",
+                "contentUrl": None,
+                "content": {
+                    "$schema": "http://adaptivecards.io/schemas/adaptive-card.json",
+                    "type": "AdaptiveCard",
+                    "version": "1.2",
+                    "body": [
+                        {
+                            "type": "TextBlock",
+                            "wrap": True,
+                            "text": f"The Billing utility failed due to {error}",
+                        }
+                    ]
+                }
             }
         ]
-        rocketChatMessage = {
-            "text": "Billing report utility failed with error",
-            "attachments": attachment,
-        }
-        teamsMessage = {
-            "type": "message",
-            "attachments": [
-                {
-                    "contentType": "application/vnd.microsoft.card.adaptive",
-                    "contentUrl": None,
-                    "content": {
-                        "$schema": "http://adaptivecards.io/schemas/adaptive-card.json",
-                        "type": "AdaptiveCard",
-                        "version": "1.2",
-                        "body": [
-                            {
-                                "type": "TextBlock",
-                                "wrap": True,
-                                "text": f"The Billing utility failed due to {error}",
-                            }
-                        ]
-                    }
-                }
-            ]
-        }
-        requests.post(
+    }
+    async_tasks.run(
+        async_tasks.call(
+            "http",
+            requests.post,
             rc_channel_url,
             data=json.dumps(rocketChatMessage),
             headers={
                 "Content-Type": "application/json"},
-        )
-        requests.post(
+        ),
+        async_tasks.call(
+            "http",
+            requests.post,
             teams_channel_url,
             data=json.dumps(teamsMessage),
             headers={
                 "Content-Type": "application/json"},
-        )
+        ),
+    )
+
+
+fx_series = "FXUSDCAD"
+
+# rates are only published on business days; usage on weekends and holidays takes the
+# last rate published before it, which can be this many days earlier
+fx_lookback_days = 10
+
+
+def fx_cache_dir():
+    current_dir = os.path.dirname(os.path.realpath(__file__))
+    return os.environ.get("FX_CACHE_DIR", f"{current_dir}/output/fx_rates")
+
+
+def exchange_rate_source():
+    # what the CAD amounts are converted with, for cache keys
+    return os.environ.get("FX_RATE") or f"{fx_series} daily"
+
+
+def exchange_rate_window(first_usage_date, last_usage_date):
+    # whole calendar months, so the rates prefetched for the report window and the ones
+    # looked up for the usage dates in the results are the same request
+    window_start = first_usage_date.replace(day=1)
+    window_end = last_usage_date.replace(day=1) + relativedelta(months=1) - timedelta(days=1)
+    return window_start, min(window_end, date.today())
+
+
+@functools.lru_cache(maxsize=None)
+def daily_exchange_rates(window_start, window_end):
+    """
+    Daily USD to CAD rates covering the dates [window_start, window_end], from a single
+    Bank of Canada Valet request, as a frame of (date, rate) sorted by date. Windows that
+    are entirely in the past don't change any more and are kept in FX_CACHE_DIR.
+    """
+    cache_file = f"{fx_cache_dir()}/{fx_series}-{window_start}-{window_end}.json"
+    if os.path.isfile(cache_file):
+        with open(cache_file) as f:
+            observations = json.load(f)
     else:
-        data = response.json()
-        usd_to_cad_rate = float(data['observations'][0]['FXUSDCAD']['v'])
-        # print(usd_to_cad_rate)
-    return usd_to_cad_rate
+        url = f"https://www.bankofcanada.ca/valet/observations/{fx_series}/json"
+        params = {
+            "start_date": (window_start - timedelta(days=fx_lookback_days)).isoformat(),
+            "end_date": window_end.isoformat(),
+        }
+        requests_session = requests.Session()
+        retries = Retry(total=3, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504, 404])
+        requests_session.mount("https://", HTTPAdapter(max_retries=retries))
+
+        logger.info(f"requesting daily conversion rates from {url} for {params}")
+        try:
+            response = requests_session.get(url, params=params)
+            response.raise_for_status()
+        except Exception as error:
+            alert_failure(error)
+            raise
+
+        observations = {
+            observation["d"]: float(observation[fx_series]["v"])
+            for observation in response.json()["observations"]
+            if observation.get(fx_series, {}).get("v")
+        }
+        if window_end < date.today():
+            os.makedirs(fx_cache_dir(), exist_ok=True)
+            with tempfile.NamedTemporaryFile(
+                "w", dir=fx_cache_dir(), prefix=".fx.", suffix=".tmp", delete=False
+            ) as f:
+                json.dump(observations, f)
+            os.replace(f.name, cache_file)
+
+    if not observations:
+        raise Exception(f"No {fx_series} rates published between {window_start} and {window_end}")
+
+    rates = pd.DataFrame(
+        {"date": pd.to_datetime(list(observations)), "rate": list(observations.values())}
+    )
+    return rates.sort_values("date", ignore_index=True)
+
+
+def prefetch_exchange_rates(start_date, end_date):
+    # warms the rates used later by enhance_with_metadata for the report window
+    if os.environ.get("FX_RATE"):
+        return get_exchange_rate()
+    return daily_exchange_rates(*exchange_rate_window(start_date.date(), end_date.date()))
+
+
+def as_of_exchange_rates(usage_dates=None):
+    """
+    Returns the rate for each of `usage_dates`, as of that date (the last rate published
+    on or before it), and the rates that were used, by date. The as-of join runs on the
+    distinct dates only and rows pick their rate up by index, so the cost is a couple of
+    vectorized passes over the rows.
+
+    Without usage dates (results queried before they were included) or with FX_RATE,
+    a single rate is used for everything and returned as both values.
+    """
+    if usage_dates is None or os.environ.get("FX_RATE"):
+        exchange_rate = get_exchange_rate()
+        return exchange_rate, exchange_rate
+
+    # dates are parsed and matched once per distinct value, rows only index into them
+    codes, distinct_values = pd.factorize(pd.Series(usage_dates))
+    if len(distinct_values) == 0:
+        exchange_rate = get_exchange_rate()
+        return exchange_rate, exchange_rate
+
+    distinct_dates = pd.DataFrame({"date": pd.to_datetime(distinct_values), "code": np.arange(len(distinct_values))})
+    distinct_dates = distinct_dates.dropna().sort_values("date", ignore_index=True)
+    rates = daily_exchange_rates(
+        *exchange_rate_window(distinct_dates["date"].iloc[0].date(), distinct_dates["date"].iloc[-1].date())
+    )
+    matched = pd.merge_asof(distinct_dates, rates, on="date", direction="backward")
+    # dates before the first rate in the window take the earliest one
+    matched["rate"] = matched["rate"].fillna(rates["rate"].iloc[0])
+
+    rate_by_code = np.empty(len(distinct_values) + 1)
+    rate_by_code[matched["code"].values] = matched["rate"].values
+    # rows without a usage date (code -1) take the latest rate used
+    rate_by_code[-1] = matched["rate"].iloc[-1]
+    row_rates = rate_by_code[codes]
+
+    rates_used = {
+        usage_date.strftime("%Y-%m-%d"): rate
+        for usage_date, rate in zip(matched["date"], matched["rate"])
+    }
+    return row_rates, rates_used
+
+
+def exchange_rates_unchanged(rates_used):
+    # True when the daily rates recorded with some charges are still the published ones
+    if not isinstance(rates_used, dict):
+        return True
+    if not rates_used:
+        return True
+    return as_of_exchange_rates(pd.Series(list(rates_used)))[1] == rates_used
 
 
 def enhance_with_metadata(df, accounts):
     account_details_by_account_id = make_account_by_id_lookup(accounts)
 
-    exchange_rate = get_exchange_rate()
-
     def get_account_metadata(account_id, field):
         account_details = account_details_by_account_id.get(account_id)
         if account_details:
@@ -136,34 +418,17 @@ def enhance_with_metadata(df, accounts):
         else:
             return f"Missing Account: {account_id}"
 
-    df["Account_Coding"] = df["line_item_usage_account_id"].apply(
-        lambda x: get_account_metadata(x, "account_coding")
-    )
-    df["Billing_Group"] = df["line_item_usage_account_id"].apply(
-        lambda x: get_account_metadata(x, "billing_group")
-    )
-    df["Owner_Name"] = df["line_item_usage_account_id"].apply(
-        lambda x: get_account_metadata(x, "admin_contact_name")
-    )
-    df["Owner_Email"] = df["line_item_usage_account_id"].apply(
-        lambda x: get_account_metadata(x, "admin_contact_email")
-    )
-    df["Additional_Contacts"] = df["line_item_usage_account_id"].apply(
-    lambda x: get_account_metadata(x, "additional_contacts")
-    )
-    df["Project"] = df["line_item_usage_account_id"].apply(
-        lambda x: get_account_metadata(x, "Project")
-    )
-    df["Environment"] = df["line_item_usage_account_id"].apply(
-        lambda x: get_account_metadata(x, "Environment")
-    )
-    df["Account_Name"] = df["line_item_usage_account_id"].apply(
-        lambda x: get_account_metadata(x, "name")
-    )
-    df["License_Plate"] = df["line_item_usage_account_id"].apply(
-        lambda x: get_account_metadata(x, "license_plate")
+    for column, field in account_metadata_columns.items():
+        df[column] = df["line_item_usage_account_id"].apply(
+            lambda x: get_account_metadata(x, field)
+        )
+    df["line_item_blended_cost"] = money.to_micros(df["line_item_blended_cost"])
+    # each line item is converted at the rate of its usage date (see as_of_exchange_rates)
+    row_rates, exchange_rate = as_of_exchange_rates(
+        df["usage_date"] if "usage_date" in df.columns else None
     )
-    df["CAD"] = df["line_item_blended_cost"].apply(lambda x: x * exchange_rate)
+    df["CAD"] = money.convert_micros(df["line_item_blended_cost"], row_rates)
+    df.attrs["exchange_rate"] = exchange_rate
 
 
 def make_account_by_id_lookup(accounts):
@@ -174,12 +439,16 @@ def make_account_by_id_lookup(accounts):
 
     return team_details_by_account_id
 
+
+def accounts_for_group(accounts, group_key, billing_group):
+    return [account for account in accounts if account.get(group_key) == billing_group]
+
 def upload_file_to_s3(file_name, bucket, object_name=None):
     if object_name is None:
         object_name = file_name
 
     # Initialize S3 client
-    s3_client = boto3.client('s3')
+    s3_client = aws_sessions.get_client('s3')
     try:
         s3_client.upload_file(file_name, bucket, object_name)
     except ClientError as e:
@@ -194,89 +463,193 @@ def report(
     query_parameters,
     cb,
     quarterly_report_config,
+    billing_groups=None,
+    aggregate_store_location=None,
 ):
     # Data frame relates account charges with account tags/ metadata which makes for easy aggregation
-    df = read_file_into_dataframe(query_results_file, accounts)
+    df = load_charges(query_results_file, accounts)
 
-    if os.environ.get("GROUP_TYPE") == "account_coding":
-        billing_groups = set([account["account_coding"] for account in accounts])
-    else:
-        billing_groups = set([account["billing_group"] for account in accounts])
+    # billing_groups restricts the report to a subset of groups (e.g. a worker's share)
+    if billing_groups is None:
+        if os.environ.get("GROUP_TYPE") == "account_coding":
+            billing_groups = set([account["account_coding"] for account in accounts])
+        else:
+            billing_groups = set([account["billing_group"] for account in accounts])
 
     # Total CAD for each billing group
     billing_group_totals = {}
 
+    template, template_version = report_template()
+
+    group_key = "account_coding" if os.environ.get("GROUP_TYPE") == "account_coding" else "billing_group"
+
+    # earlier periods of the same report type from the aggregate store (AGGREGATE_STORE),
+    # shown as a trend in each report (pyarrow is only imported here)
+    import aggregate_store
+
+    history_reader = aggregate_store.open_reader(aggregate_store_location)
+    history_periods = int(os.environ.get("REPORT_HISTORY_PERIODS", 6))
+
     for billing_group in billing_groups:
         group_type = "Account_Coding" if os.environ.get("GROUP_TYPE") == "account_coding" else "Billing_Group"
         group_df = df.query(f'({group_type} == "{billing_group}")')
 
-        sum_all_columns = group_df.sum(axis=0, skipna=True, numeric_only=True)
-        sum_cad = sum_all_columns["CAD"]
-        billing_group_totals[billing_group] = round(sum_cad, 2)
-
-        billing = pd.pivot_table(
-            group_df,
-            index=grouping_columns,
-            values=["line_item_blended_cost", "CAD"],
-            aggfunc=[np.sum],
-            fill_value=0,
-            margins=True,
-            margins_name="Total",
-        )
+        billing_group_totals[billing_group] = money.total_in_dollars(group_df["CAD"].sum())
 
-        # todo pre-render
-        env = Environment(loader=FileSystemLoader("."))
-        template = env.get_template("templates/report.html.jinja2")
-
-        template_vars = {
-            "title": "Cloud Pathfinder Tenant Team Cloud Service Consumption Report (AWS)",
-            "pivot_table": billing.to_html(),
-            "business_unit": billing_group,
-            "start_date": query_parameters["start_date"],
-            "end_date": query_parameters["end_date"],
-        }
-
-        html_out = template.render(template_vars)
+        history = []
+        if history_reader:
+            history = history_reader.group_totals(
+                billing_group,
+                periods=history_periods,
+                report_type=query_parameters.get("report_type"),
+                before=query_parameters["start_date"],
+            )
 
         format_string = "%Y-%m-%d"
         report_name = f"{date.strftime(query_parameters['start_date'], format_string)}-{date.strftime(query_parameters['end_date'], format_string)}-{billing_group}.html"
         report_file_name = f"{report_output_path}/{report_name}"
 
-        with open(report_file_name, "w") as text_file:
-            text_file.write(html_out)
+        cache_key = artifact_cache.artifact_key(
+            "report.html",
+            billing_group,
+            artifact_cache.hash_dataframe(group_df),
+            accounts_for_group(accounts, group_key, billing_group),
+            df.attrs.get("exchange_rate"),
+            template_version,
+            query_parameters["start_date"],
+            query_parameters["end_date"],
+            history,
+        )
+
+        if not artifact_cache.fetch(cache_key, report_file_name):
+            billing = pd.pivot_table(
+                project(group_df),
+                index=grouping_columns,
+                values=["line_item_blended_cost", "CAD"],
+                aggfunc=[np.sum],
+                fill_value=0,
+                margins=True,
+                margins_name="Total",
+            )
+            # summed (including the margins) in micro-dollars, shown in dollars
+            billing = money.to_dollars(billing)
+
+            template_vars = {
+                "title": "Cloud Pathfinder Tenant Team Cloud Service Consumption Report (AWS)",
+                "pivot_table": billing.to_html(),
+                "business_unit": billing_group,
+                "start_date": query_parameters["start_date"],
+                "end_date": query_parameters["end_date"],
+                "history": history,
+            }
+
+            html_out = template.render(template_vars)
+
+            with open(report_file_name, "w") as text_file:
+                text_file.write(html_out)
+
+            artifact_cache.store(cache_key, report_file_name)
 
         # invoke callback to pass back generated file to caller for current billing group
         cb(billing_group, report_file_name)
 
     if quarterly_report_config:
-        format_string = "%Y-%m-%d"
-        report_file_name = f"{report_output_path}/quarterly_report-{date.strftime(query_parameters['start_date'], format_string)}-{date.strftime(query_parameters['end_date'], format_string)}.xlsx"
-        create_quarterly_excel(billing_group_totals, accounts, report_file_name)
-
-        s3_bucket = os.environ.get("QR_S3_Bucket")
-        # Extract the Year 
-        year = date.strftime(query_parameters['start_date'], '%Y')
-        s3_key = f"reports/quarterly/{year}/{os.path.basename(report_file_name)}"
-        if upload_file_to_s3(report_file_name, s3_bucket, s3_key):
-            logging.info(f"Successfully uploaded {report_file_name} to S3 bucket {s3_bucket} as {s3_key}")
-        else:
-            logging.error(f"Failed to upload {report_file_name} to S3.")
-        # invoke callback to pass back generated file to caller for current billing group
-        cb("QUARTERLY_REPORT", report_file_name)
+        quarterly_report(
+            billing_group_totals, report_output_path, accounts, query_parameters, cb, charges=df
+        )
 
     return billing_group_totals
 
 
-def aggregate(query_results_file, summary_output_path, accounts, query_parameters, cb):
-    df = read_file_into_dataframe(query_results_file, accounts)
+def group_totals(query_results_file, accounts, billing_groups=None):
+    """
+    CAD total per billing group, for runs that need the totals without rendering the per
+    group reports (see output_plan). Same values as the totals returned by report().
+    """
+    df = load_charges(query_results_file, accounts)
+
+    group_key = "account_coding" if os.environ.get("GROUP_TYPE") == "account_coding" else "billing_group"
+    group_type = "Account_Coding" if group_key == "account_coding" else "Billing_Group"
+    if billing_groups is None:
+        billing_groups = set([account[group_key] for account in accounts])
+
+    cad_by_group = df.groupby(group_type)["CAD"].sum()
+    return {
+        billing_group: money.total_in_dollars(cad_by_group.get(billing_group, 0))
+        for billing_group in billing_groups
+    }
+
+
+def quarterly_report(billing_group_totals, report_output_path, accounts, query_parameters, cb, s3_bucket=None, charges=None):
+    format_string = "%Y-%m-%d"
+    report_file_name = f"{report_output_path}/quarterly_report-{date.strftime(query_parameters['start_date'], format_string)}-{date.strftime(query_parameters['end_date'], format_string)}.xlsx"
+    create_quarterly_excel(billing_group_totals, accounts, report_file_name, charges)
+
+    s3_bucket = s3_bucket or os.environ.get("QR_S3_Bucket")
+    # Extract the Year 
+    year = date.strftime(query_parameters['start_date'], '%Y')
+    s3_key = f"reports/quarterly/{year}/{os.path.basename(report_file_name)}"
+    if upload_file_to_s3(report_file_name, s3_bucket, s3_key):
+        logging.info(f"Successfully uploaded {report_file_name} to S3 bucket {s3_bucket} as {s3_key}")
+    else:
+        logging.error(f"Failed to upload {report_file_name} to S3.")
+    # invoke callback to pass back generated file to caller for current billing group
+    cb("QUARTERLY_REPORT", report_file_name)
+
+
+def aggregate(
+    query_results_file,
+    summary_output_path,
+    accounts,
+    query_parameters,
+    cb,
+    billing_groups=None,
+    include_all=True,
+):
+    df = load_charges(query_results_file, accounts)
 
     format_string = "%Y-%m-%d"
     filename_prefix = f"{date.strftime(query_parameters['start_date'], format_string)}-{date.strftime(query_parameters['end_date'], format_string)}"
 
-    create_excel(df, f"{summary_output_path}/charges-{filename_prefix}-ALL.xlsx")
+    if include_all:
+        all_output_path = f"{summary_output_path}/charges-{filename_prefix}-ALL.xlsx"
+        all_cache_key = artifact_cache.artifact_key(
+            "charges.xlsx",
+            artifact_cache.hash_dataframe(df),
+            accounts,
+            df.attrs.get("exchange_rate"),
+            excel_layout_version,
+        )
+        if not artifact_cache.fetch(all_cache_key, all_output_path):
+            create_excel(df, all_output_path)
+            artifact_cache.store(all_cache_key, all_output_path)
+
+        export_formats = [
+            export_format.strip().lower()
+            for export_format in os.environ.get("SUMMARY_EXPORT_FORMATS", "").split(",")
+            if export_format.strip()
+        ]
+        for export_format in export_formats:
+            if export_format not in summary_export_formats:
+                logger.warning(f"Unknown SUMMARY_EXPORT_FORMATS entry '{export_format}'")
+                continue
+            export_output_path = (
+                f"{summary_output_path}/charges-{filename_prefix}-ALL.{summary_export_formats[export_format]}"
+            )
+            export_cache_key = artifact_cache.artifact_key(
+                f"charges.{summary_export_formats[export_format]}",
+                artifact_cache.hash_dataframe(df),
+                accounts,
+                df.attrs.get("exchange_rate"),
+            )
+            if not artifact_cache.fetch(export_cache_key, export_output_path):
+                export_summary(df, export_output_path, export_format)
+                artifact_cache.store(export_cache_key, export_output_path)
 
     group_type = "account_coding" if os.environ.get("GROUP_TYPE") == "account_coding" else "billing_group"
-    billing_groups = set([account[group_type] for account in accounts])
+    if billing_groups is None:
+        billing_groups = set([account[group_type] for account in accounts])
+    group_key = group_type
 
     for billing_group in billing_groups:
         group_type = "Account_Coding" if os.environ.get("GROUP_TYPE") == "account_coding" else "Billing_Group"
@@ -285,7 +658,17 @@ def aggregate(query_results_file, summary_output_path, accounts, query_parameter
         excel_output_path = (
             f"{summary_output_path}/charges-{filename_prefix}-{billing_group}.xlsx"
         )
-        create_excel(group_df, excel_output_path)
+        cache_key = artifact_cache.artifact_key(
+            "charges.xlsx",
+            billing_group,
+            artifact_cache.hash_dataframe(group_df),
+            accounts_for_group(accounts, group_key, billing_group),
+            df.attrs.get("exchange_rate"),
+            excel_layout_version,
+        )
+        if not artifact_cache.fetch(cache_key, excel_output_path):
+            create_excel(group_df, excel_output_path)
+            artifact_cache.store(cache_key, excel_output_path)
         logger.debug(f"Done with  billing group '{billing_group}'...")
         # invoke callback to pass back generated file to caller for current billing group
         cb(billing_group, excel_output_path)
@@ -297,13 +680,29 @@ def set_to_formatted_string(some_set):
         formatted_list = formatted_list + item + '; ' 
     return formatted_list.rstrip('; ')
 
+def effective_exchange_rate(charges):
+    # total CAD / total USD: the single rate that converts the period's spend as the
+    # per usage date rates did, None when there is no spend to weight by
+    usd = int(charges["line_item_blended_cost"].sum())
+    return int(charges["CAD"].sum()) / usd if usd else None
+
+
 # ToDo: Add Conversion rate used at the time report is generated
-def create_quarterly_excel(billing_group_totals, accounts, quarterly_output_file):
+def create_quarterly_excel(billing_group_totals, accounts, quarterly_output_file, charges=None):
     wb = Workbook()
     ws = wb.active
-    conversion_rate = get_exchange_rate()
+    # B1 stays a number: the pinned rate (FX_RATE), otherwise the volume weighted rate of
+    # the line items, each converted at its usage date's rate (listed on a second sheet)
+    rates_used = charges.attrs.get("exchange_rate") if charges is not None else None
+    conversion_rate = None
+    if not os.environ.get("FX_RATE") and isinstance(rates_used, dict):
+        conversion_rate = effective_exchange_rate(charges)
+        ws["C1"] = f"Volume weighted (total CAD / total USD) of the daily {fx_series} rates"
+    if conversion_rate is None:
+        conversion_rate = get_exchange_rate()
     ws["A1"] = "USD to CAD Conversion Rate:"
     ws["B1"] = conversion_rate
+    ws["B1"].number_format = "0.0000"
 
     # For Visual representation
     ws["A2"] = ""
@@ -342,48 +741,118 @@ def create_quarterly_excel(billing_group_totals, accounts, quarterly_output_file
               row = (billing_group, total, po_names_formatted, po_emails_formatted)
           ws.append(row)
 
+    if isinstance(rates_used, dict):
+        rates_ws = wb.create_sheet("Exchange Rates")
+        rates_ws.append(["Usage Date", f"{fx_series} Rate"])
+        for usage_date, rate in sorted(rates_used.items()):
+            rates_ws.append([usage_date, rate])
+
     wb.save(f"{quarterly_output_file}")
 
 
+def create_landing_zone_summary_excel(totals_by_landing_zone, summary_output_file):
+    """
+    Cross landing zone summary: the CAD total of every billing group in every landing
+    zone, with a total per landing zone and a grand total.
+    """
+    wb = Workbook()
+    ws = wb.active
+    ws.title = "Landing Zones"
+    ws.append(("Landing Zone", "Billing Group", "Total Spend (CAD)"))
+
+    grand_total = 0
+    for landing_zone, billing_group_totals in sorted(totals_by_landing_zone.items()):
+        for billing_group, total in sorted(billing_group_totals.items()):
+            ws.append((landing_zone, billing_group, total))
+        landing_zone_total = round(sum(billing_group_totals.values()), 2)
+        ws.append((landing_zone, "Total", landing_zone_total))
+        grand_total += landing_zone_total
+    ws.append(("All landing zones", "Total", round(grand_total, 2)))
+
+    for row in ws.iter_rows(min_row=2, min_col=3, max_col=3):
+        for cell in row:
+            cell.number_format = "$#,##0.00"
+    ws.freeze_panes = "A2"
+
+    wb.save(summary_output_file)
+
+
+def summary_frame(df):
+    # the rows of the charges workbook: grouped on its key columns, money in dollars
+    key_columns, money_columns = summary_schema
+    df = project(df).groupby(key_columns).sum().reset_index()
+    df[money_columns] = money.to_dollars(df[money_columns])
+    return df
+
+
+def export_summary(df, output_file, export_format):
+    """
+    Writes the same rows as the charges workbook as zstd Parquet or gzip CSV. Both are
+    written column by column by Arrow, without going through Python objects per cell.
+    """
+    import gzip
+
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    import pyarrow.parquet as pq
+
+    table = pa.Table.from_pandas(summary_frame(df), preserve_index=False)
+    if export_format == "parquet":
+        pq.write_table(table, output_file, compression="zstd")
+    else:
+        # Arrow's own gzip stream always uses the slowest level; level 6 is several
+        # times faster for a few percent more bytes
+        with gzip.open(output_file, "wb", compresslevel=6) as stream:
+            pa_csv.write_csv(table, stream)
+
+
 def create_excel(df, summary_output_file):
-    df = df.groupby(grouping_columns).sum().reset_index()
+    key_columns, money_columns = summary_schema
+    df = summary_frame(df)
 
     wb = Workbook()
-    ws = wb.active
+    # a worksheet holds xlsx_max_rows rows, so large summaries continue on further
+    # sheets, each with the header and its own table
+    rows_per_sheet = xlsx_max_rows - 1
+    sheet_count = max(1, -(-len(df) // rows_per_sheet))
+
+    # columns are located by name, the layout depends on GROUP_TYPE
+    column_letters = {
+        column: get_column_letter(index + 1) for index, column in enumerate(df.columns)
+    }
+    # widest value of each column (header included), computed on the frame
+    column_widths = [
+        max([len(str(column))] + ([df[column].astype(str).str.len().max()] if len(df) else []))
+        for column in df.columns
+    ]
+
+    for sheet_index in range(sheet_count):
+        if sheet_index == 0:
+            ws = wb.active
+        else:
+            ws = wb.create_sheet(f"Charges ({sheet_index + 1})")
+        sheet_df = df.iloc[sheet_index * rows_per_sheet:(sheet_index + 1) * rows_per_sheet]
+
+        for r in dataframe_to_rows(sheet_df, index=False, header=True):
+            ws.append(r)
+
+        for column in money_columns:
+            for cell in ws[column_letters[column]]:
+                cell.number_format = "$#,##0.00"
+
+        last_row = ws.max_row
+        last_column = get_column_letter(ws.max_column)
+        range_end = f"{last_column}{last_row}"
+
+        table_name = "Charges" if sheet_index == 0 else f"Charges_{sheet_index + 1}"
+        table = Table(displayName=table_name, ref=f"A1:{range_end}")
+        ws.add_table(table)
+
+        for i, column_width in enumerate(column_widths):
+            ws.column_dimensions[get_column_letter(i + 1)].width = column_width + 4
+        # keep the header and everything up to the project visible while scrolling
+        ws.freeze_panes = ws[f"{get_column_letter(df.columns.get_loc('Project') + 2)}2"]
 
-    for r in dataframe_to_rows(df, index=True, header=True):
-        ws.append(r)
-
-    ws.delete_rows(2)
-    ws.delete_cols(1)
-
-    # todo refactor to remove use of "magic" column letters (should find column by name instead)
-    blended_cost_column = ws["M"]
-    cad_cost_col = ws["N"]
-
-    for cell in blended_cost_column:
-        cell.number_format = "$#,##0.00"
-
-    for cell in cad_cost_col:
-        cell.number_format = "$#,##0.00"
-
-    last_row = ws.max_row
-    last_column = get_column_letter(ws.max_column)
-    range_end = f"{last_column}{last_row}"
-
-    table = Table(displayName="Charges", ref=f"A1:{range_end}")
-    ws.add_table(table)
-
-    column_widths = []
-    for row in ws.rows:
-        for i, cell in enumerate(row):
-            if len(column_widths) > i:
-                if len(str(cell.value)) > column_widths[i]:
-                    column_widths[i] = len(str(cell.value))
-            else:
-                column_widths += [len(str(cell.value))]
-    for i, column_width in enumerate(column_widths):
-        ws.column_dimensions[get_column_letter(i + 1)].width = column_width + 4
-    # todo refactor to remove use of "magic" column letters (should find column by name instead)
-    ws.freeze_panes = ws["F2"]
+    if sheet_count > 1:
+        logger.info(f"Split {len(df)} rows across {sheet_count} sheets of '{summary_output_file}'")
     wb.save(f"{summary_output_file}")
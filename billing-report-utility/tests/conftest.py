@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the utility's modules import each other as top level modules (python billing.py)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
@@ -0,0 +1,127 @@
+import csv
+import random
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import summarize_charges
+
+accounts = [
+    {
+        "id": f"{100000000000 + i}",
+        "name": f"abc{i}-dev",
+        "billing_group": ["Ministry A", "Ministry B", "Ministry C"][i % 3],
+        "account_coding": f"CODE{i % 2}",
+        "admin_contact_name": f"Owner {i % 3}",
+        "admin_contact_email": f"owner{i % 3}@gov.bc.ca",
+        "license_plate": f"abc{i}",
+        "Environment": "dev",
+        # some accounts have no Project tag and no additional contacts
+        **({"Project": f"Proj{i}"} if i % 4 else {}),
+        **({"additional_contacts": "x@gov.bc.ca/y@gov.bc.ca"} if i % 2 else {}),
+    }
+    for i in range(12)
+]
+
+# published rates; weekends and holidays have none and take the previous day's
+daily_rates = pd.DataFrame(
+    {
+        "date": pd.to_datetime(["2023-12-29", "2024-01-02", "2024-01-15", "2024-02-01", "2024-02-20"]),
+        "rate": [1.3226, 1.3316, 1.3427, 1.3396, 1.3504],
+    }
+)
+
+
+@pytest.fixture
+def query_results_file(tmp_path):
+    # Athena shaped results over two months, with line items of an account missing from
+    # the org metadata and line items without a usage date
+    rng = random.Random(7)
+    path = tmp_path / "results.csv"
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(
+            [
+                "line_item_usage_account_id",
+                "line_item_product_code",
+                "product_product_name",
+                "line_item_blended_cost",
+                "year",
+                "month",
+                "usage_date",
+            ]
+        )
+        for _ in range(5000):
+            account_id = rng.choice([account["id"] for account in accounts] + ["999999999999"])
+            product = rng.choice(["AmazonEC2", "AmazonS3", "AWSLambda"])
+            month = rng.choice([1, 2])
+            writer.writerow(
+                [
+                    account_id,
+                    product,
+                    f"{product} name",
+                    round(rng.random() * 3, 10),
+                    2024,
+                    month,
+                    # a few line items have no usage date
+                    f"2024-{month:02d}-{rng.randint(1, 28):02d}" if rng.random() > 0.02 else "",
+                ]
+            )
+    return str(path)
+
+
+@pytest.fixture(params=["daily", "pinned"])
+def exchange_rates(request, monkeypatch):
+    monkeypatch.setattr(summarize_charges, "daily_exchange_rates", lambda start, end: daily_rates)
+    summarize_charges.get_exchange_rate.cache_clear()
+    if request.param == "pinned":
+        monkeypatch.setenv("FX_RATE", "1.35")
+    else:
+        monkeypatch.delenv("FX_RATE", raising=False)
+    yield request.param
+    summarize_charges.get_exchange_rate.cache_clear()
+
+
+def load(engine, query_results_file, monkeypatch):
+    monkeypatch.setattr(summarize_charges, "aggregation_engine", engine)
+    df = summarize_charges.load_charges(query_results_file, accounts)
+    # same row order and key representation for both engines
+    keys = summarize_charges.grouping_columns
+    df = df.astype({column: str for column in keys}).sort_values(keys, ignore_index=True)
+    return df
+
+
+def test_grouped_charges_match(query_results_file, exchange_rates, monkeypatch):
+    pandas_df = load("pandas", query_results_file, monkeypatch)
+    duckdb_df = load("duckdb", query_results_file, monkeypatch)
+
+    columns = summarize_charges.grouping_columns + summarize_charges.value_columns
+    pd.testing.assert_frame_equal(
+        pandas_df[columns], duckdb_df[columns], check_dtype=False
+    )
+    assert pandas_df.attrs["exchange_rate"] == duckdb_df.attrs["exchange_rate"]
+
+
+def test_group_totals_and_pivots_match(query_results_file, exchange_rates, monkeypatch):
+    pandas_df = load("pandas", query_results_file, monkeypatch)
+    duckdb_df = load("duckdb", query_results_file, monkeypatch)
+
+    assert summarize_charges.group_totals(pandas_df, accounts) == summarize_charges.group_totals(
+        duckdb_df, accounts
+    )
+
+    for billing_group in sorted(set(pandas_df["Billing_Group"])):
+        pivots = [
+            pd.pivot_table(
+                summarize_charges.project(df[df["Billing_Group"] == billing_group]),
+                index=summarize_charges.grouping_columns,
+                values=summarize_charges.value_columns,
+                aggfunc=[np.sum],
+                fill_value=0,
+                margins=True,
+                margins_name="Total",
+            )
+            for df in (pandas_df, duckdb_df)
+        ]
+        pd.testing.assert_frame_equal(pivots[0], pivots[1], check_dtype=False)
@@ -0,0 +1,79 @@
+import threading
+import time
+
+import pytest
+
+import async_tasks
+
+
+class InFlight:
+    # highest number of calls running at the same time
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = 0
+        self.peak = 0
+
+    def call(self, item):
+        with self.lock:
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+        time.sleep(0.02)
+        with self.lock:
+            self.running -= 1
+        return item
+
+
+@pytest.fixture
+def s3_limit(monkeypatch):
+    def set_limit(limit):
+        monkeypatch.setenv("MAX_CONCURRENT_S3", str(limit))
+        # semaphores are created on first use with the limit at the time
+        monkeypatch.setattr(async_tasks, "_semaphores", {})
+
+    return set_limit
+
+
+def test_nested_runs_share_the_service_limit(s3_limit):
+    s3_limit(2)
+    in_flight = InFlight()
+
+    def fan_out(batch):
+        return async_tasks.map_calls("s3", in_flight.call, range(batch * 4, batch * 4 + 4))
+
+    results = async_tasks.map_calls("s3", fan_out, range(3))
+
+    assert results == [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9, 10, 11]]
+    assert in_flight.peak == 2
+
+
+def test_runs_on_other_threads_share_the_service_limit(s3_limit):
+    s3_limit(3)
+    in_flight = InFlight()
+
+    threads = [
+        threading.Thread(target=async_tasks.map_calls, args=("s3", in_flight.call, range(6)))
+        for _ in range(3)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert in_flight.peak == 3
+
+
+def test_nested_run_with_a_single_slot_does_not_deadlock(s3_limit):
+    s3_limit(1)
+
+    def fan_out(batch):
+        return sum(async_tasks.map_calls("s3", lambda item: item, range(batch)))
+
+    assert async_tasks.map_calls("s3", fan_out, [2, 3]) == [1, 3]
+
+
+def test_first_failure_is_raised():
+    def fail(item):
+        raise ValueError(item)
+
+    with pytest.raises(ValueError):
+        async_tasks.map_calls("s3", fail, [1, 2])
@@ -0,0 +1,118 @@
+import os
+import zipfile
+from datetime import datetime
+from urllib.parse import urlparse
+
+import boto3
+import pytest
+import requests
+from moto import mock_aws
+
+import attachment_policy
+import aws_sessions
+
+bucket = "reports"
+start_date = datetime(2024, 1, 1)
+end_date = datetime(2024, 1, 31, 23, 59, 59)
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    for name, value in {
+        "AWS_ACCESS_KEY_ID": "testing",
+        "AWS_SECRET_ACCESS_KEY": "testing",
+        "AWS_SESSION_TOKEN": "testing",
+        "AWS_DEFAULT_REGION": "ca-central-1",
+    }.items():
+        monkeypatch.setenv(name, value)
+    monkeypatch.delenv("S3_ENDPOINT_URL", raising=False)
+    # lowered thresholds, so a few hundred KB of reports are zipped or linked
+    monkeypatch.setenv("ATTACHMENT_ZIP_THRESHOLD_MB", "0.1")
+    monkeypatch.setenv("ATTACHMENT_LINK_THRESHOLD_MB", "0.2")
+    # clients created inside the mock, not ones cached by an earlier test
+    monkeypatch.setattr(aws_sessions, "_sessions", {})
+    monkeypatch.setattr(aws_sessions, "_clients", {})
+    with mock_aws():
+        client = boto3.client("s3", region_name="ca-central-1")
+        client.create_bucket(
+            Bucket=bucket, CreateBucketConfiguration={"LocationConstraint": "ca-central-1"}
+        )
+        yield client
+
+
+def reports(directory, size, compressible=True):
+    paths = []
+    for name in ("charges-Ministry A.xlsx", "report-Ministry A.html"):
+        path = directory / name
+        path.write_bytes(b"a" * size if compressible else os.urandom(size))
+        paths.append(str(path))
+    return paths
+
+
+def test_small_attachments_are_sent_as_is(s3, tmp_path):
+    attachments = reports(tmp_path, 10_000)
+    zip_path, key_prefix = attachment_policy.locations(
+        str(tmp_path), "Ministry A", start_date, end_date, "monthly"
+    )
+
+    assert attachment_policy.prepare(attachments, zip_path, key_prefix, {"REPORTS_S3_BUCKET": bucket}) == (
+        sorted(attachments),
+        [],
+    )
+
+
+def test_large_attachments_are_zipped(s3, tmp_path):
+    attachments = reports(tmp_path, 150_000)
+    zip_path, key_prefix = attachment_policy.locations(
+        str(tmp_path), "Ministry A", start_date, end_date, "monthly", "lz1"
+    )
+
+    attached, links = attachment_policy.prepare(attachments, zip_path, key_prefix, {"REPORTS_S3_BUCKET": bucket})
+
+    assert attached == [str(tmp_path / "lz1-2024-01-01-2024-01-31-Ministry A.zip")]
+    assert links == []
+    with zipfile.ZipFile(attached[0]) as archive:
+        assert sorted(archive.namelist()) == ["charges-Ministry A.xlsx", "report-Ministry A.html"]
+    assert "Contents" not in s3.list_objects_v2(Bucket=bucket)
+
+
+def test_attachments_too_large_to_send_are_linked_per_landing_zone(s3, tmp_path):
+    # random bytes don't zip any smaller, so the files are uploaded and linked
+    links_by_landing_zone = {}
+    for landing_zone in ("lz1", "lz2"):
+        directory = tmp_path / landing_zone
+        directory.mkdir()
+        attachments = reports(directory, 150_000, compressible=False)
+        zip_path, key_prefix = attachment_policy.locations(
+            str(directory), "Ministry A", start_date, end_date, "monthly", landing_zone
+        )
+
+        attached, links = attachment_policy.prepare(
+            attachments, zip_path, key_prefix, {"REPORTS_S3_BUCKET": bucket}
+        )
+
+        assert attached == []
+        assert not os.path.exists(zip_path)
+        links_by_landing_zone[landing_zone] = dict(links)
+
+    keys = sorted(obj["Key"] for obj in s3.list_objects_v2(Bucket=bucket)["Contents"])
+    assert keys == [
+        f"reports/monthly/2024/{landing_zone}/{name}"
+        for landing_zone in ("lz1", "lz2")
+        for name in ("charges-Ministry A.xlsx", "report-Ministry A.html")
+    ]
+
+    # each link is signed for its own landing zone's copy and serves it
+    url = links_by_landing_zone["lz2"]["report-Ministry A.html"]
+    assert urlparse(url).path.endswith("/reports/monthly/2024/lz2/report-Ministry%20A.html")
+    assert "X-Amz-Signature=" in url
+    assert requests.get(url).content == (tmp_path / "lz2" / "report-Ministry A.html").read_bytes()
+
+
+def test_without_a_reports_bucket_large_attachments_stay_inline(s3, tmp_path):
+    attachments = reports(tmp_path, 150_000, compressible=False)
+    zip_path, key_prefix = attachment_policy.locations(
+        str(tmp_path), "Ministry A", start_date, end_date, "monthly"
+    )
+
+    assert attachment_policy.prepare(attachments, zip_path, key_prefix, {}) == (sorted(attachments), [])
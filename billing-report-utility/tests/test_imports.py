@@ -0,0 +1,55 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+utility_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+# only imported by the stage that needs them, so a run that fails early (e.g. on a
+# missing environment variable) or a RUN_MODE that never reaches them doesn't pay for them
+deferred_modules = ["pandas", "numpy", "pyarrow", "duckdb", "openpyxl", "jinja2", "requests"]
+
+# cumulative import time budget in milliseconds, generous enough for a slow CI runner;
+# BillingManager needs boto3 (and botocore) for its first stage
+import_budgets_ms = {"billing": 500, "BillingManager": 2000}
+
+
+def import_times(module):
+    """
+    Imports `module` in a fresh interpreter (sys.modules of the test run already holds
+    pandas and the rest) under -X importtime. Returns the cumulative import time in
+    microseconds of every module it loaded, keyed by module name.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=utility_dir,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    # import time: self [us] | cumulative | imported package
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+@pytest.mark.parametrize("module", ["billing", "BillingManager"])
+def test_heavy_modules_are_not_imported_up_front(module):
+    times = import_times(module)
+    assert sorted(name for name in deferred_modules if name in times) == []
+    assert times[module] / 1000 < import_budgets_ms[module]
+
+
+def test_billing_does_not_import_boto3():
+    # BillingManager needs boto3 for its first stage, billing only once there is work to do
+    assert "boto3" not in import_times("billing")
+
+
+def test_summarize_charges_does_not_import_the_aggregate_store():
+    # the aggregate store (and pyarrow) is only imported when history is read or recorded
+    assert "aggregate_store" not in import_times("summarize_charges")
@@ -0,0 +1,99 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import summarize_charges
+
+accounts = [
+    {
+        "id": f"{100000000000 + i}",
+        "name": f"abc{i}-dev",
+        "billing_group": ["Ministry A", "Ministry B"][i % 2],
+        "account_coding": f"CODE{i % 2}",
+        "admin_contact_name": f"Owner {i % 2}",
+        "admin_contact_email": f"owner{i % 2}@gov.bc.ca",
+        "license_plate": f"abc{i}",
+        "Environment": "dev",
+        "Project": f"Proj{i}",
+    }
+    for i in range(6)
+]
+
+daily_rates = pd.DataFrame(
+    {
+        "date": pd.to_datetime(["2023-12-29", "2024-01-02", "2024-01-15", "2024-02-01"]),
+        "rate": [1.3226, 1.3316, 1.3427, 1.3396],
+    }
+)
+
+
+@pytest.fixture
+def line_items(monkeypatch):
+    monkeypatch.setattr(summarize_charges, "daily_exchange_rates", lambda start, end: daily_rates)
+    monkeypatch.delenv("FX_RATE", raising=False)
+
+    # costs with more decimals than a float sum keeps exact, in random order
+    rows = 60_000
+    rng = np.random.default_rng(37)
+    month = rng.integers(1, 3, rows)
+    return pd.DataFrame(
+        {
+            "line_item_usage_account_id": rng.choice([account["id"] for account in accounts], rows),
+            "line_item_product_code": rng.choice(["AmazonEC2", "AmazonS3", "AWSLambda"], rows),
+            "product_product_name": "Amazon product",
+            "line_item_blended_cost": rng.random(rows) * rng.choice([0.001, 1, 1000], rows),
+            "year": 2024,
+            "month": month,
+            "usage_date": [f"2024-{m:02d}-{d:02d}" for m, d in zip(month, rng.integers(1, 29, rows))],
+        }
+    )
+
+
+def serial(df):
+    df = df.copy()
+    summarize_charges.enhance_with_metadata(df, accounts)
+    return summarize_charges.group_charges(df)
+
+
+def combine(partials):
+    # partial aggregates add up like line items do
+    return summarize_charges.group_charges(pd.concat(partials, ignore_index=True))
+
+
+def sort(df):
+    columns = summarize_charges.grouping_columns
+    return df.astype({column: str for column in columns}).sort_values(columns, ignore_index=True)
+
+
+def test_chunked_and_parallel_totals_are_bit_identical(line_items):
+    expected = sort(serial(line_items))
+
+    shuffled = line_items.sample(frac=1, random_state=7, ignore_index=True)
+    chunks = [shuffled.iloc[start:start + 10_000] for start in range(0, len(shuffled), 10_000)]
+    chunked = combine([serial(chunk) for chunk in chunks])
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        parallel = combine(list(executor.map(serial, reversed(chunks))))
+
+    for result in (chunked, parallel):
+        result = sort(result)
+        assert result[summarize_charges.value_columns].dtypes.tolist() == [np.int64, np.int64]
+        pd.testing.assert_frame_equal(result, expected, check_exact=True)
+
+
+def test_split_results_are_bit_identical(line_items, tmp_path):
+    # results of monthly queries are parsed concurrently (see read_file_into_dataframe)
+    whole = tmp_path / "query_results.csv"
+    line_items.to_csv(whole, index=False)
+    parts = []
+    for month, part in line_items.sample(frac=1, random_state=7).groupby("month"):
+        parts.append(tmp_path / f"query_results-{month}.csv")
+        part.to_csv(parts[-1], index=False)
+
+    expected = summarize_charges.group_charges(summarize_charges.read_file_into_dataframe(str(whole), accounts))
+    split = summarize_charges.group_charges(
+        summarize_charges.read_file_into_dataframe([str(part) for part in parts], accounts)
+    )
+
+    pd.testing.assert_frame_equal(sort(split), sort(expected), check_exact=True)
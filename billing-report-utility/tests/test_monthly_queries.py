@@ -0,0 +1,86 @@
+import os
+from datetime import datetime
+
+import pandas as pd
+import pytest
+
+from QueryData import QueryData
+
+line_item_columns = [
+    "line_item_usage_account_id",
+    "line_item_product_code",
+    "product_product_name",
+    "line_item_blended_cost",
+    "line_item_usage_start_date",
+    "line_item_usage_end_date",
+]
+
+
+def line_item(account_id, cost, start, end):
+    return (account_id, "AmazonEC2", "Amazon Elastic Compute Cloud", cost, start, end)
+
+
+@pytest.fixture
+def cur_path(tmp_path):
+    # the year=/month= billing period layout of the CUR table
+    partitions = {
+        1: [
+            line_item("111111111111", 1.25, datetime(2024, 1, 3), datetime(2024, 1, 3, 1)),
+            line_item("222222222222", 2.5, datetime(2024, 1, 31, 23), datetime(2024, 2, 1)),
+        ],
+        2: [
+            line_item("111111111111", 4.0, datetime(2024, 2, 10), datetime(2024, 2, 10, 1)),
+            # billed in February for usage that started in January (e.g. a late
+            # adjustment or a refund)
+            line_item("222222222222", -0.75, datetime(2024, 1, 20), datetime(2024, 1, 21)),
+        ],
+        3: [
+            line_item("111111111111", 8.0, datetime(2024, 3, 5), datetime(2024, 3, 5, 1)),
+            line_item("222222222222", 16.0, datetime(2024, 3, 30), datetime(2024, 3, 31)),
+        ],
+    }
+    for month, rows in partitions.items():
+        partition_dir = tmp_path / "cur" / "year=2024" / f"month={month}"
+        partition_dir.mkdir(parents=True)
+        pd.DataFrame(rows, columns=line_item_columns).to_parquet(partition_dir / "part.parquet")
+    return str(tmp_path / "cur")
+
+
+@pytest.fixture
+def query_data(cur_path, tmp_path, monkeypatch):
+    monkeypatch.setenv("LOCAL_QUERY_RESULTS_DIR", str(tmp_path / "results"))
+    query_parameters = {
+        "start_date": datetime(2024, 1, 1),
+        "end_date": datetime(2024, 2, 29, 23, 59, 59),
+    }
+    return QueryData(query_parameters, {"QUERY_BACKEND": "local", "LOCAL_CUR_PATH": cur_path})
+
+
+def results(query_data, query_execution_ids):
+    return pd.concat(
+        [pd.read_csv(query_data.backend.results_path(query_execution_id)) for query_execution_id in query_execution_ids],
+        ignore_index=True,
+    )
+
+
+def test_monthly_queries_add_up_to_the_single_query(query_data):
+    single = results(query_data, [query_data.query_usage_charges()])
+    monthly = results(query_data, query_data.query_usage_charges_by_month())
+
+    assert len(monthly) == len(single) == 4
+    assert monthly["line_item_blended_cost"].sum() == single["line_item_blended_cost"].sum()
+    # the adjustment billed in February is in the February query
+    assert -0.75 in monthly["line_item_blended_cost"].tolist()
+
+
+def test_monthly_queries_filter_on_their_billing_period_only(query_data):
+    start_date = query_data.query_parameters["start_date"]
+    end_date = query_data.query_parameters["end_date"]
+    windows = query_data.monthly_windows(start_date, end_date)
+    assert [window[0].month for window in windows] == [1, 2]
+
+    single = query_data.build_usage_charges_query(start_date, end_date)
+    for window in windows:
+        query = query_data.build_usage_charges_query(start_date, end_date, window)
+        assert query.startswith(single)
+        assert query[len(single):].strip() == f"AND year = '2024' AND month = '{window[0].month}'"
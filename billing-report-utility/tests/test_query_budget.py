@@ -0,0 +1,97 @@
+from datetime import datetime
+
+import pytest
+
+from QueryData import GB, QueryData, ScanBudgetExceeded
+from query_backends import query_backends
+
+
+class FakeQueryBackend:
+    # scan estimates by billing period: "window" for the single query, else the month
+    estimates = {}
+
+    def __init__(self, settings):
+        self.statistics = {}
+        self.queries = []
+
+    def estimate_scan_bytes(self, query):
+        month = next((m for m in (1, 2, 3) if f"AND month = '{m}'" in query), "window")
+        return self.estimates.get(month)
+
+    def run_query(self, query):
+        self.queries.append(query)
+        return f"execution-{len(self.queries)}"
+
+    def run_queries(self, queries):
+        return [self.run_query(query) for query in queries]
+
+
+@pytest.fixture
+def query_data(monkeypatch):
+    monkeypatch.setitem(query_backends, "fake", FakeQueryBackend)
+    monkeypatch.setenv("ATHENA_MAX_SCAN_GB", "10")
+    monkeypatch.delenv("ATHENA_ALLOW_UNESTIMATED_SCANS", raising=False)
+
+    def make(estimates, start_date=datetime(2024, 1, 1), end_date=datetime(2024, 3, 31, 23, 59, 59)):
+        FakeQueryBackend.estimates = {key: value * GB if value is not None else None for key, value in estimates.items()}
+        return QueryData({"start_date": start_date, "end_date": end_date}, {"QUERY_BACKEND": "fake"})
+
+    return make
+
+
+def test_runs_single_query_within_budget(query_data):
+    data = query_data({"window": 9})
+
+    assert data.query_usage_charges_within_budget() == ["execution-1"]
+    assert [window for _, window in data.executions] == [None]
+
+
+def test_splits_by_month_when_single_query_is_over_budget(query_data):
+    data = query_data({"window": 27, 1: 9, 2: 9, 3: 9})
+
+    assert data.query_usage_charges_within_budget() == ["execution-1", "execution-2", "execution-3"]
+    assert [window[0].month for _, window in data.executions] == [1, 2, 3]
+
+
+def test_refuses_when_a_monthly_query_is_over_budget(query_data):
+    data = query_data({"window": 27, 1: 9, 2: 11, 3: 7})
+
+    with pytest.raises(ScanBudgetExceeded):
+        data.query_usage_charges_within_budget()
+    assert data.backend.queries == []
+
+
+def test_refuses_single_month_over_budget(query_data):
+    data = query_data({"window": 11}, end_date=datetime(2024, 1, 31, 23, 59, 59))
+
+    with pytest.raises(ScanBudgetExceeded):
+        data.query_usage_charges_within_budget()
+    assert data.backend.queries == []
+
+
+def test_refuses_queries_without_an_estimate(query_data):
+    data = query_data({"window": None, 1: 9, 2: None, 3: 9})
+
+    with pytest.raises(ScanBudgetExceeded, match="ATHENA_ALLOW_UNESTIMATED_SCANS"):
+        data.query_usage_charges_within_budget()
+    assert data.backend.queries == []
+
+
+def test_splits_when_only_the_monthly_queries_have_estimates(query_data):
+    data = query_data({"window": None, 1: 9, 2: 9, 3: 9})
+
+    assert len(data.query_usage_charges_within_budget()) == 3
+
+
+def test_runs_queries_without_an_estimate_when_allowed(query_data, monkeypatch):
+    monkeypatch.setenv("ATHENA_ALLOW_UNESTIMATED_SCANS", "true")
+    data = query_data({})
+
+    assert len(data.query_usage_charges_within_budget(split_by_month=True)) == 3
+
+
+def test_rejects_window_ending_before_it_starts(query_data):
+    data = query_data({"window": 1}, start_date=datetime(2024, 3, 1), end_date=datetime(2024, 2, 1))
+
+    with pytest.raises(ValueError):
+        data.query_usage_charges_within_budget()
@@ -0,0 +1,135 @@
+import boto3
+import pytest
+from botocore.exceptions import ClientError
+from moto import mock_aws
+
+import s3_download
+from query_backends import AthenaQueryBackend
+from s3_download import DownloadIntegrityError
+
+bucket = "athena-results"
+query_execution_id = "3f1c2a9e-0000-4000-8000-000000000001"
+key = f"cur/{query_execution_id}.csv"
+
+header = b'"line_item_usage_account_id","line_item_blended_cost"\n'
+rows = [f'"{100000000000 + i}","{i * 0.25}"\n'.encode() for i in range(40)]
+result = header + b"".join(rows)
+
+
+class FakeAthena:
+    # what Athena recorded about the query: the number of rows it output
+    def __init__(self, output_rows):
+        self.output_rows = output_rows
+
+    def get_query_runtime_statistics(self, QueryExecutionId):
+        return {"QueryRuntimeStatistics": {"Rows": {"OutputRows": self.output_rows}}}
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    for name, value in {
+        "AWS_ACCESS_KEY_ID": "testing",
+        "AWS_SECRET_ACCESS_KEY": "testing",
+        "AWS_SESSION_TOKEN": "testing",
+        "AWS_DEFAULT_REGION": "ca-central-1",
+    }.items():
+        monkeypatch.setenv(name, value)
+    # small parts, so a result is fetched in several ranged GETs
+    monkeypatch.setattr(s3_download, "default_part_size_mb", 1)
+    with mock_aws():
+        client = boto3.client("s3", region_name="ca-central-1")
+        client.create_bucket(
+            Bucket=bucket, CreateBucketConfiguration={"LocationConstraint": "ca-central-1"}
+        )
+        yield client
+
+
+def athena_backend(s3_client, output_rows=len(rows)):
+    # the backend without its role assumption; downloads go to the mocked S3
+    backend = AthenaQueryBackend.__new__(AthenaQueryBackend)
+    backend.s3_output = f"s3://{bucket}/cur/"
+    backend.output_locations = {query_execution_id: f"s3://{bucket}/{key}"}
+    backend.athena = FakeAthena(output_rows)
+    backend.s3_client = lambda: s3_client
+    return backend
+
+
+def put_result(s3_client, body=result, metadata=True):
+    s3_client.put_object(Bucket=bucket, Key=key, Body=body)
+    if metadata:
+        s3_client.put_object(Bucket=bucket, Key=f"{key}.metadata", Body=b"metadata")
+
+
+def test_complete_result_is_downloaded(s3, tmp_path):
+    put_result(s3)
+    local_path = tmp_path / "query_results.csv"
+
+    athena_backend(s3).download_results(query_execution_id, str(local_path))
+
+    assert local_path.read_bytes() == result
+
+
+def test_truncated_result_fails_the_row_count(s3, tmp_path):
+    # the object is cut short after 30 rows, Athena output 40
+    put_result(s3, header + b"".join(rows[:30]))
+
+    with pytest.raises(DownloadIntegrityError, match="30 rows, Athena reported 40"):
+        athena_backend(s3).download_results(query_execution_id, str(tmp_path / "query_results.csv"))
+
+
+def test_result_without_metadata_is_refused(s3, tmp_path):
+    put_result(s3, metadata=False)
+
+    with pytest.raises(DownloadIntegrityError, match="No result metadata"):
+        athena_backend(s3).download_results(query_execution_id, str(tmp_path / "query_results.csv"))
+
+
+class RewritingS3Client:
+    # rewrites the object after the first ranged GET, as if the result was replaced mid download
+    def __init__(self, s3_client):
+        self.s3_client = s3_client
+        self.requests = []
+
+    def head_object(self, **kwargs):
+        return self.s3_client.head_object(**kwargs)
+
+    def get_object(self, **kwargs):
+        self.requests.append(kwargs)
+        if len(self.requests) == 2:
+            self.s3_client.put_object(Bucket=bucket, Key=key, Body=b"x" * (3 * 1024 * 1024))
+        return self.s3_client.get_object(**kwargs)
+
+
+def test_ranges_are_pinned_to_the_etag(s3, tmp_path):
+    s3.put_object(Bucket=bucket, Key=key, Body=b"a" * (3 * 1024 * 1024))
+    etag = s3.head_object(Bucket=bucket, Key=key)["ETag"]
+    client = RewritingS3Client(s3)
+
+    with pytest.raises(ClientError, match="PreconditionFailed"):
+        s3_download.download_object(client, bucket, key, str(tmp_path / "part.bin"), max_workers=1)
+    assert all(request["IfMatch"] == etag for request in client.requests)
+
+
+class ShortReadS3Client(RewritingS3Client):
+    # one range comes back a byte short, as from a connection closed early
+    def get_object(self, **kwargs):
+        response = self.s3_client.get_object(**kwargs)
+        if kwargs["Range"].startswith("bytes=0-"):
+            response["Body"] = TruncatedBody(response["Body"].read()[:-1])
+        return response
+
+
+class TruncatedBody:
+    def __init__(self, data):
+        self.data = data
+
+    def read(self, size=-1):
+        data, self.data = self.data[:size], self.data[size:]
+        return data
+
+
+def test_short_range_fails_the_size_check(s3, tmp_path):
+    s3.put_object(Bucket=bucket, Key=key, Body=b"a" * (3 * 1024 * 1024))
+
+    with pytest.raises(DownloadIntegrityError, match="returned 1048575 bytes"):
+        s3_download.download_object(ShortReadS3Client(s3), bucket, key, str(tmp_path / "part.bin"))
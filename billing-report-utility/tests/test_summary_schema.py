@@ -0,0 +1,66 @@
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+from openpyxl import load_workbook
+
+import summarize_charges
+
+
+@pytest.fixture(scope="module")
+def large_group():
+    # enhanced line items of one billing group, still carrying the string metadata
+    # columns (a long Additional_Contacts list on every row) next to the key columns
+    rows = 50_000
+    rng = np.random.default_rng(41)
+    account = rng.integers(0, 4, rows)
+    df = pd.DataFrame(
+        {
+            "year": 2024,
+            "month": 1,
+            "line_item_usage_account_id": [f"10000000000{a}" for a in account],
+            "line_item_product_code": rng.choice(["AmazonEC2", "AmazonS3", "AWSLambda"], rows),
+            "product_product_name": "Amazon product",
+            "usage_date": "2024-01-02",
+        }
+    )
+    for column in summarize_charges.account_metadata_columns:
+        df[column] = [f"{column} {a}" for a in account]
+    df["Billing_Group"] = "Ministry A"
+    df["Additional_Contacts"] = "/".join(f"person{i}@gov.bc.ca" for i in range(10))
+    df["line_item_blended_cost"] = rng.integers(0, 10_000_000, rows).astype("int64")
+    df["CAD"] = df["line_item_blended_cost"] * 135 // 100
+    return df
+
+
+def test_create_excel_keeps_the_summary_schema(large_group, tmp_path):
+    path = tmp_path / "charges.xlsx"
+    summarize_charges.create_excel(large_group, path)
+
+    rows = list(load_workbook(path).active.values)
+    key_columns, money_columns = summarize_charges.summary_schema
+    assert list(rows[0]) == key_columns + money_columns
+    # 4 accounts x 3 products
+    assert len(rows) == 1 + 12
+
+    cost = rows[0].index("line_item_blended_cost")
+    assert sum(row[cost] for row in rows[1:]) == pytest.approx(
+        large_group["line_item_blended_cost"].sum() / 1_000_000
+    )
+
+
+def test_projection_speeds_up_large_group(large_group):
+    # benchmark: summing the frame as is concatenates the metadata strings of every
+    # line item in a group, the projected frame only sums the money columns
+    start = time.perf_counter()
+    unprojected = large_group.groupby(summarize_charges.grouping_columns).sum()
+    unprojected_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    projected = summarize_charges.summary_frame(large_group)
+    projected_seconds = time.perf_counter() - start
+
+    print(f"\ngroupby sum: {unprojected_seconds:.3f} s unprojected, {projected_seconds:.3f} s projected")
+    assert len(projected) == len(unprojected)
+    assert projected_seconds * 5 < unprojected_seconds
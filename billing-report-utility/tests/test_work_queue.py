@@ -0,0 +1,82 @@
+import os
+import time
+from datetime import datetime
+
+import pytest
+
+from work_queue import FileWorkQueue, run_name
+
+
+@pytest.fixture
+def queue(tmp_path):
+    return FileWorkQueue(tmp_path / "queue")
+
+
+def test_each_task_is_claimed_once(queue):
+    queue.put("group-00000", {"billing_group": "Ministry A"})
+    queue.put("group-00001", {"billing_group": "Ministry B"})
+    other_worker = FileWorkQueue(queue.root)
+
+    claimed = [queue.claim(), other_worker.claim(), queue.claim()]
+
+    assert claimed == [
+        ("group-00000", {"billing_group": "Ministry A"}),
+        ("group-00001", {"billing_group": "Ministry B"}),
+        (None, None),
+    ]
+
+
+def test_stale_claims_are_requeued(queue):
+    queue.put("group-00000", {"billing_group": "Ministry A"})
+    queue.put("group-00001", {"billing_group": "Ministry B"})
+    queue.claim()
+    queue.claim()
+    # the first worker stopped sending heartbeats ten minutes ago
+    stale = time.time() - 600
+    os.utime(queue.claimed_dir / "group-00000.json", (stale, stale))
+
+    queue.requeue_stale(300)
+
+    assert queue.claim() == ("group-00000", {"billing_group": "Ministry A"})
+    assert queue.claim() == (None, None)
+
+
+def test_requeued_task_completed_meanwhile_is_not_claimed_again(queue):
+    queue.put("group-00000", {"billing_group": "Ministry A"})
+    queue.claim()
+    stale = time.time() - 600
+    os.utime(queue.claimed_dir / "group-00000.json", (stale, stale))
+    queue.requeue_stale(300)
+
+    # the stalled worker finishes after all
+    queue.complete("group-00000", {"billing_group": "Ministry A", "total": 1.5})
+
+    assert queue.claim() == (None, None)
+    assert queue.results() == {"group-00000": {"billing_group": "Ministry A", "total": 1.5}}
+
+
+def test_mark_once(queue):
+    other_worker = FileWorkQueue(queue.root)
+
+    assert queue.mark_once("delivered-group-00000")
+    assert not other_worker.mark_once("delivered-group-00000")
+
+    # a failed delivery releases the marker for the next attempt
+    queue.unmark("delivered-group-00000")
+    assert other_worker.mark_once("delivered-group-00000")
+
+
+def test_rerun_of_a_finished_window_starts_an_empty_queue(tmp_path):
+    root = tmp_path / run_name(datetime(2024, 1, 1), datetime(2024, 1, 31, 23, 59, 59))
+    queue = FileWorkQueue(root)
+    queue.write_manifest({"run_id": "first", "tasks": []})
+    queue.put("group-00000", {"billing_group": "Ministry A"})
+    queue.finish()
+
+    queue = queue.archive()
+
+    assert root.name == "2024-01-01_2024-01-31"
+    assert (tmp_path / "2024-01-01_2024-01-31-first" / "manifest.json").exists()
+    assert not queue.manifest_path.exists()
+    assert not queue.finished()
+    assert queue.claim() == (None, None)
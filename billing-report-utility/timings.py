@@ -0,0 +1,41 @@
+import threading
+import time
+from contextlib import contextmanager
+
+
+class StageTimer:
+    """
+    Records how long each stage of a run takes. Stages may run concurrently on
+    different threads; `overlap` reports how much wall clock time running a set of
+    stages together saved compared to running them back to back.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.durations = {}
+        self.started = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.durations[name] = self.durations.get(name, 0.0) + time.perf_counter() - start
+
+    def overlap(self, stage_names, wall_clock_stage):
+        serial = sum(self.durations.get(name, 0.0) for name in stage_names)
+        return serial - self.durations.get(wall_clock_stage, serial)
+
+    def log_summary(self, logger, concurrent_stages=None):
+        total = time.perf_counter() - self.started
+        stage_lines = ", ".join(f"{name}={duration:.2f}s" for name, duration in self.durations.items())
+        logger.info(f"Stage timings: {stage_lines}; total={total:.2f}s")
+
+        for wall_clock_stage, stage_names in (concurrent_stages or {}).items():
+            if wall_clock_stage in self.durations:
+                logger.info(
+                    f"'{wall_clock_stage}' ran {', '.join(stage_names)} concurrently, "
+                    f"saving {self.overlap(stage_names, wall_clock_stage):.2f}s on the critical path"
+                )
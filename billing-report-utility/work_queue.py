@@ -0,0 +1,203 @@
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+handler = logging.StreamHandler(sys.stdout)
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+
+
+def run_name(start_date, end_date):
+    # each report window gets its own queue, which the coordinator and every worker
+    # derive from the window they were started for
+    return f"{start_date:%Y-%m-%d}_{end_date:%Y-%m-%d}"
+
+
+class FileWorkQueue:
+    """
+    Work queue on a shared filesystem (a local directory for testing, EFS when the
+    coordinator and workers run as separate ECS tasks).
+
+    Tasks are json files that move pending/ -> claimed/ -> done/. Claiming is an
+    os.rename, which is atomic on a single filesystem, so each task is handed to exactly
+    one worker. Workers write their result to results/<task_id>.json, and keep the
+    claimed file's mtime fresh (heartbeat) while the task runs so that only tasks of
+    workers that died are requeued.
+
+    A task can still run twice (e.g. a worker stalls past the stale claim time), so
+    side effects that must happen once are guarded with mark_once().
+    """
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.pending_dir = self.root / "pending"
+        self.claimed_dir = self.root / "claimed"
+        self.done_dir = self.root / "done"
+        self.results_dir = self.root / "results"
+        self.partitions_dir = self.root / "partitions"
+        self.markers_dir = self.root / "markers"
+        self.manifest_path = self.root / "manifest.json"
+
+        for directory in (
+            self.pending_dir,
+            self.claimed_dir,
+            self.done_dir,
+            self.results_dir,
+            self.partitions_dir,
+            self.markers_dir,
+        ):
+            directory.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def __write_json(path, payload):
+        # write then rename so readers never see a partially written file
+        tmp_path = path.with_name(f".{path.name}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(payload, f, default=str)
+        os.replace(tmp_path, path)
+
+    def write_manifest(self, manifest):
+        self.__write_json(self.manifest_path, manifest)
+
+    def read_manifest(self):
+        with open(self.manifest_path) as f:
+            return json.load(f)
+
+    def wait_for_manifest(self, timeout_seconds, poll_seconds=5):
+        # workers may start before (or alongside) the coordinator has run the query, or
+        # while the queue still holds an earlier, finished run of the same window
+        deadline = time.time() + timeout_seconds
+        while not self.manifest_path.exists() or self.finished():
+            if time.time() > deadline:
+                raise TimeoutError(f"No manifest in '{self.root}' within {timeout_seconds}s")
+            time.sleep(poll_seconds)
+        return self.read_manifest()
+
+    def finish(self):
+        # written by the coordinator once it has every result
+        self.mark_once("run-finished")
+
+    def finished(self):
+        return (self.markers_dir / "run-finished").exists()
+
+    def archive(self):
+        """
+        Moves a finished run aside, to <root>-<run_id>, and returns an empty queue at the
+        same root for the next run.
+        """
+        run_id = self.read_manifest().get("run_id") or int(time.time())
+        os.rename(self.root, self.root.with_name(f"{self.root.name}-{run_id}"))
+        return FileWorkQueue(self.root)
+
+    def put(self, task_id, task):
+        self.__write_json(self.pending_dir / f"{task_id}.json", task)
+
+    def claim(self):
+        for task_path in sorted(self.pending_dir.glob("*.json")):
+            claimed_path = self.claimed_dir / task_path.name
+            if (self.results_dir / task_path.name).exists():
+                # completed by a worker after being requeued as stale
+                self.__retire(task_path)
+                continue
+            try:
+                os.rename(task_path, claimed_path)
+            except FileNotFoundError:
+                # another worker got there first
+                continue
+
+            # the claim time is used to detect workers that died mid task
+            os.utime(claimed_path)
+            with open(claimed_path) as f:
+                return claimed_path.stem, json.load(f)
+
+        return None, None
+
+    def __retire(self, task_path):
+        try:
+            os.replace(task_path, self.done_dir / task_path.name)
+        except FileNotFoundError:
+            pass
+
+    @contextmanager
+    def heartbeat(self, task_id, interval_seconds):
+        """
+        Touches the claimed task every `interval_seconds` while the block runs, so
+        requeue_stale only picks up tasks whose worker stopped.
+        """
+        claimed_path = self.claimed_dir / f"{task_id}.json"
+        stopped = threading.Event()
+
+        def beat():
+            while not stopped.wait(interval_seconds):
+                try:
+                    os.utime(claimed_path)
+                except FileNotFoundError:
+                    # requeued (or retired) meanwhile
+                    pass
+
+        thread = threading.Thread(target=beat, name=f"heartbeat-{task_id}", daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stopped.set()
+            thread.join()
+
+    def mark_once(self, name):
+        # True for the first caller only; the marker is created exclusively
+        try:
+            fd = os.open(self.markers_dir / name, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        os.close(fd)
+        return True
+
+    def unmark(self, name):
+        try:
+            os.remove(self.markers_dir / name)
+        except FileNotFoundError:
+            pass
+
+    def complete(self, task_id, result):
+        self.__write_json(self.results_dir / f"{task_id}.json", result)
+        # the task may have been requeued meanwhile; retire it from wherever it is now
+        self.__retire(self.claimed_dir / f"{task_id}.json")
+        self.__retire(self.pending_dir / f"{task_id}.json")
+
+    def requeue_stale(self, max_age_seconds):
+        now = time.time()
+        for claimed_path in self.claimed_dir.glob("*.json"):
+            if now - claimed_path.stat().st_mtime > max_age_seconds:
+                logger.warning(f"Requeuing task '{claimed_path.stem}' without a heartbeat for more than {max_age_seconds}s")
+                try:
+                    os.rename(claimed_path, self.pending_dir / claimed_path.name)
+                except FileNotFoundError:
+                    pass
+
+    def results(self):
+        results = {}
+        for result_path in self.results_dir.glob("*.json"):
+            with open(result_path) as f:
+                results[result_path.stem] = json.load(f)
+        return results
+
+    def wait_for_results(self, task_count, timeout_seconds, stale_claim_seconds, poll_seconds=5):
+        deadline = time.time() + timeout_seconds
+        while True:
+            results = self.results()
+            if len(results) >= task_count:
+                return results
+            if time.time() > deadline:
+                raise TimeoutError(
+                    f"Only {len(results)} of {task_count} tasks completed within {timeout_seconds}s"
+                )
+            self.requeue_stale(stale_claim_seconds)
+            time.sleep(poll_seconds)
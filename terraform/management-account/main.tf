@@ -171,7 +171,10 @@ resource "aws_iam_policy" "athena_cost_and_usage_report_policies" {
       {
         Action = [
           "athena:StartQueryExecution",
-          "athena:GetQueryExecution"
+          "athena:GetQueryExecution",
+          "athena:GetQueryRuntimeStatistics",
+          "athena:BatchGetQueryExecution",
+          "athena:GetQueryResults"
         ],
         Resource = "*",
         Effect   = "Allow"